@@ -0,0 +1,575 @@
+# Офлайн-бенчмарк bot.py: настоящие обработчики, поддельный транспорт Bot API, временная БД.
+# Сценарии — типичные пики: запуск события (массовые записи), спам рейтингом, вечерние отчёты
+# с фото, мастер создания события у админов, листание /events и /my, открытие карточек. Результат — JSON, чтобы сравнивать
+# прогоны между собой:
+#
+#   python bench.py --events 50 --users 2000 --json before.json
+#   python bench.py --events 50 --users 2000 --json after.json --compare before.json
+#   python bench.py --mode both --concurrency 200 --latency-ms 50   # TeleBot и AsyncRuntime рядом
+#   python bench.py --scenarios reminders                           # свои данные, отдельный процесс
+import os, sys, json, math, time, tracemalloc, random, asyncio, argparse, tempfile, itertools, platform, subprocess, statistics
+import datetime as dt
+from concurrent.futures import ThreadPoolExecutor
+
+ADMIN_BASE = 10 ** 9   # у каждого мастера свой админ: два мастера одного человека затирают друг другу состояние
+
+def admins():
+    return [ADMIN_BASE + i for i in range(max(1, ARGS.events // 5))]
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Офлайн-бенчмарк обработчиков бота")
+    p.add_argument("--events", type=int, default=50, help="событий в БД")
+    p.add_argument("--users", type=int, default=2000, help="пользователей, записанных на события")
+    p.add_argument("--workers", type=int, default=8, help="параллельных обработчиков (как пул telebot)")
+    p.add_argument("--mode", choices=("sync", "async", "both"), default="sync",
+                   help="sync — TeleBot в пуле из --workers потоков, async — AsyncRuntime (BOT_MODE=async)")
+    p.add_argument("--concurrency", type=int, default=200, help="одновременных пользователей в async-режиме")
+    p.add_argument("--latency-ms", type=float, default=0.0, help="задержка ответа поддельного Bot API")
+    p.add_argument("--scenarios", default="all",
+                   help="через запятую: " + ",".join([*SCENARIOS, "render", "startup", *ISOLATED]))
+    p.add_argument("--years", type=int, default=5, help="лет истории в сценарии history")
+    p.add_argument("--state-users", type=int, default=100000, help="пользователей с начатым мастером в сценарии state")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--json", help="куда записать результат")
+    p.add_argument("--compare", help="JSON прошлого прогона: показать изменения")
+    p.add_argument("--isolated", choices=ISOLATED, help=argparse.SUPPRESS)   # дочерний процесс run_isolated
+    return p.parse_args()
+
+# === Окружение: временная БД и поддельный транспорт до импорта bot
+ARGS = None
+CALLS = {"n": 0}
+_mid = itertools.count(1000)
+
+class FakeResponse:
+    status_code = 200
+    reason = "OK"
+    def __init__(self, result):
+        self._json = {"ok": True, "result": result}
+        self.text = json.dumps(self._json)
+    def json(self):
+        return self._json
+
+def fake_result(url, params):
+    # ответы в форме Bot API (поле result)
+    CALLS["n"] += 1
+    name = url.rsplit("/", 1)[-1]
+    params = params or {}
+    if name == "getMe":
+        return {"id": 9, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+    if name in ("sendMessage", "sendDocument", "editMessageText"):
+        return {"message_id": next(_mid), "date": int(time.time()), "text": params.get("text", ""),
+                "chat": {"id": int(params.get("chat_id", 1)), "type": "private"}}
+    return True
+
+def fake_sender(method, url, params=None, files=None, **kwargs):
+    # задержка имитирует сеть до Telegram: синхронный клиент держит поток
+    if ARGS.latency_ms:
+        time.sleep(ARGS.latency_ms / 1000)
+    return FakeResponse(fake_result(url, params))
+
+async def fake_async_request(token, url, method="get", params=None, files=None, **kwargs):
+    # то же для AsyncTeleBot: ожидание не держит событийный цикл
+    if ARGS.latency_ms:
+        await asyncio.sleep(ARGS.latency_ms / 1000)
+    return fake_result(url, params)
+
+def setup_env():
+    tmp = tempfile.mkdtemp(prefix="sportsbot-bench-")
+    os.environ["DB_PATH"] = os.path.join(tmp, "bench.db")
+    os.environ["ADMIN_IDS"] = ",".join(map(str, admins()))
+    os.environ["METRICS_PORT"] = "0"
+    os.environ.setdefault("BOT_TOKEN", "123456:BENCH")
+    from telebot import apihelper
+    apihelper.CUSTOM_REQUEST_SENDER = fake_sender
+    if ARGS.mode != "sync":
+        from telebot import asyncio_helper  # требует aiohttp, как и BOT_MODE=async
+        asyncio_helper._process_request = fake_async_request
+    return tmp
+
+# === Апдейты
+def user(uid):
+    return {"id": uid, "is_bot": False, "first_name": f"U{uid}", "username": f"u{uid}"}
+
+def message(uid, text=None, **extra):
+    m = {"message_id": next(_mid), "date": int(time.time()), "chat": {"id": uid, "type": "private"}, "from": user(uid)}
+    if text is not None:
+        m["text"] = text
+        if text.startswith("/"):
+            m["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    m.update(extra)
+    return {"update_id": next(_mid), "message": m}
+
+def callback(uid, data):
+    # date != 0: иначе telebot считает сообщение недоступным и кнопки не перерисовать
+    return {"update_id": next(_mid), "callback_query": {
+        "id": str(next(_mid)), "from": user(uid), "chat_instance": "bench", "data": data,
+        "message": {"message_id": next(_mid), "date": int(time.time()), "chat": {"id": uid, "type": "private"},
+                    "text": "card", "reply_markup": {"inline_keyboard": [[{"text": "↩️ К списку", "callback_data": "evp:0"}]]}}}}
+
+def photo(uid, group=None):
+    fid = f"photo-{uid}-{next(_mid)}"
+    extra = {"media_group_id": group} if group else {}
+    return message(uid, photo=[{"file_id": fid, "file_unique_id": fid, "width": 640, "height": 480}], **extra)
+
+def album(uid, n):
+    group = f"album-{uid}-{next(_mid)}"
+    return [photo(uid, group) for _ in range(n)]
+
+# === Данные
+def seed(B, rnd):
+    # половина событий идёт сейчас с ежедневными отчётами, остальные — впереди; все записаны наполовину
+    today = B.local_today()
+    con = B.db()
+    ids = []
+    for i in range(ARGS.events):
+        running = i % 2 == 0
+        d1 = today - dt.timedelta(days=rnd.randint(0, 10)) if running else today + dt.timedelta(days=rnd.randint(1, 30))
+        d2 = d1 + dt.timedelta(days=rnd.randint(14, 42))
+        cur = con.execute("""INSERT INTO events(emoji,title,date_start,date_end,location,capacity,description,rewards,
+                                               report_required,report_schedule,report_unit,is_active)
+                             VALUES('🏃',?,?,?,'Парк',NULL,'Описание события для бенчмарка','Медаль',?,?,'км',1)""",
+                          (f"Событие {i}", d1.isoformat(), d2.isoformat(), int(running), "daily" if running else "none"))
+        ids.append((cur.lastrowid, running))
+    users = range(10, 10 + ARGS.users)
+    now = dt.datetime.utcnow().isoformat()
+    con.executemany("INSERT INTO signups(event_id,tg_user_id,tg_username,tg_name,signed_at) VALUES(?,?,?,?,?)",
+                    [(eid, u, f"u{u}", f"U{u}", now) for eid, _ in ids for u in users if rnd.random() < 0.5])
+    con.commit()
+    B.events_changed()
+    return ids, list(users)
+
+# === Сценарии: список сессий, сессия — апдейты одного пользователя по порядку
+def sc_launch(B, rnd, ids, users):
+    # новое событие с лимитом мест, все кидаются записываться; часть передумывает
+    con = B.db()
+    d1 = B.local_today() + dt.timedelta(days=3)
+    cur = con.execute("""INSERT INTO events(emoji,title,date_start,date_end,capacity,is_active)
+                         VALUES('🔥','Запуск',?,?,?,1)""", (d1.isoformat(), (d1 + dt.timedelta(days=7)).isoformat(), len(users) // 2))
+    con.commit(); B.events_changed(cur.lastrowid)
+    eid = cur.lastrowid
+    return [[callback(u, f"join:{eid}")] + ([callback(u, f"leave:{eid}")] if rnd.random() < 0.1 else []) for u in users]
+
+def sc_leaderboard(B, rnd, ids, users):
+    running = [eid for eid, r in ids if r]
+    return [[callback(u, f"lb:{rnd.choice(running)}") for _ in range(3)] for u in users]
+
+def sc_reports(B, rnd, ids, users):
+    con = B.db()
+    running = {eid for eid, r in ids if r}
+    mine = {}
+    for eid, uid in con.execute("SELECT event_id, tg_user_id FROM signups"):
+        if eid in running:
+            mine.setdefault(uid, []).append(eid)
+    sessions = []
+    for uid, eids in mine.items():
+        eid = rnd.choice(eids)
+        # треть присылает альбом из трёх фото: он склеивается в один шаг, число идёт сразу за ним
+        proof = album(uid, 3) if rnd.random() < 0.33 else [photo(uid)]
+        sessions.append([callback(uid, f"report:{eid}"), *proof,
+                         message(uid, f"{rnd.randint(1000, 20000)}"), message(uid, "-")])
+    return sessions
+
+def sc_wizard(B, rnd, ids, users):
+    today = B.local_today()
+    steps = ["➕ Добавить событие", "-", "Вечерний забег", today.isoformat(), (today + dt.timedelta(days=20)).isoformat(),
+             "Парк", "100", "Описание", "Медаль", "да", "ежедневный", "км", "нет", "готово"]
+    return [[message(admin, s) for s in steps] for admin in admins()]
+
+def sc_browse(B, rnd, ids, users):
+    sessions = []
+    for u in users:
+        eid, _ = rnd.choice(ids)
+        sessions.append([message(u, "🏅 События"), callback(u, "evp:1"), callback(u, f"card:{eid}:0"),
+                         message(u, "📝 Мои регистрации")])
+    return sessions
+
+def sc_cards(B, rnd, ids, users):
+    # карточки из /events и /my: текст из кэша карточек, кнопки — одним сгруппированным запросом
+    mine = {}
+    for eid, uid in B.db().execute("SELECT event_id, tg_user_id FROM signups"):
+        mine.setdefault(uid, []).append(eid)
+    sessions = []
+    for u in users:
+        own = mine.get(u, [])
+        sessions.append([callback(u, f"card:{eid}:0") for eid, _ in rnd.sample(ids, min(5, len(ids)))] +
+                        [callback(u, f"mycard:{eid}:0") for eid in rnd.sample(own, min(3, len(own)))])
+    return sessions
+
+def sc_paging(B, rnd, ids, users):
+    # все страницы /events (общие для всех, в PAGE_CACHE) и все страницы /my (у каждого свои, из кэша карточек)
+    mine = {}
+    for (uid,) in B.db().execute("SELECT tg_user_id FROM signups"):
+        mine[uid] = mine.get(uid, 0) + 1
+    pages = math.ceil(len(B.active_events()) / B.PAGE_SIZE)
+    return [[message(u, "🏅 События"), *(callback(u, f"evp:{p}") for p in range(1, pages)),
+             message(u, "📝 Мои регистрации"),
+             *(callback(u, f"myp:{p}") for p in range(1, math.ceil(mine.get(u, 0) / B.PAGE_SIZE)))] for u in users]
+
+SCENARIOS = {"launch": sc_launch, "leaderboard": sc_leaderboard, "reports": sc_reports,
+             "wizard": sc_wizard, "browse": sc_browse, "cards": sc_cards, "paging": sc_paging}
+
+# === Прогон
+def db_queries(B) -> int:
+    with B.METRICS.lock:
+        return sum(h[-1] for (name, _), h in B.METRICS.histograms.items() if name == "sportsbot_db_seconds")
+
+def percentile(sorted_values, q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+def play_sync(B, sessions, errors):
+    def play(session):
+        out = []
+        for upd in session:
+            t0 = time.perf_counter()
+            try:
+                B.bot.process_new_updates([upd])
+            except Exception as e:
+                errors.append(type(e).__name__)
+            out.append(time.perf_counter() - t0)
+        return out
+    with ThreadPoolExecutor(ARGS.workers) as pool:
+        return list(itertools.chain.from_iterable(pool.map(play, sessions)))
+
+def play_async(runtime, sessions, errors):
+    # --concurrency пользователей одновременно, у каждого апдейты по порядку
+    class Errors:
+        def handle(self, e):
+            errors.append(type(e).__name__)
+            return True
+    runtime.bot.exception_handler = Errors()
+    async def run():
+        gate = asyncio.Semaphore(ARGS.concurrency)
+        async def play(session):
+            out = []
+            async with gate:
+                for upd in session:
+                    t0 = time.perf_counter()
+                    await runtime.bot.process_new_updates([upd])
+                    out.append(time.perf_counter() - t0)
+            return out
+        return list(itertools.chain.from_iterable(await asyncio.gather(*map(play, sessions))))
+    return asyncio.run(run())
+
+def run_scenario(B, sessions, runtime=None):
+    from telebot.types import Update
+    sessions = [[Update.de_json(u) for u in s] for s in sessions]
+    errors = []
+    q0, c0 = db_queries(B), CALLS["n"]
+    t0 = time.perf_counter()
+    lat = sorted(play_async(runtime, sessions, errors) if runtime else play_sync(B, sessions, errors))
+    wall = time.perf_counter() - t0
+    n = len(lat)
+    return {
+        "updates": n,
+        "sessions": len(sessions),
+        "wall_s": round(wall, 3),
+        "throughput_ups": round(n / wall, 1) if wall else 0.0,
+        "p50_ms": round(percentile(lat, 0.50) * 1000, 3),
+        "p99_ms": round(percentile(lat, 0.99) * 1000, 3),
+        "max_ms": round((lat[-1] if lat else 0) * 1000, 3),
+        "db_queries": db_queries(B) - q0,
+        "queries_per_update": round((db_queries(B) - q0) / n, 2) if n else 0.0,
+        "api_calls": CALLS["n"] - c0,
+        "errors": len(errors),
+    }
+
+def bench_render(B):
+    # 10k карточек: холодный проход собирает статичные части, тёплый берёт из кэша.
+    # Затем те же карточки страницами списка (cards_page): каждая десятая длинная и обрезается
+    long_desc = "Маршрут вдоль набережной. " * 40 + '<a href="https://example.com/rules">Правила</a>'
+    today = B.local_today()
+    events = [B.Event((100000 + i, "🏃", f"Карточка {i}", (today + dt.timedelta(days=i % 30)).isoformat(),
+                       (today + dt.timedelta(days=i % 30 + 10)).isoformat(), "Парк", None,
+                       long_desc if i % 10 == 0 else "Описание", "Медаль",
+                       1, "daily", "км", 0, 1)) for i in range(10000)]
+    B.CARD_CACHE["day"] = None
+    t0 = time.perf_counter(); [B.fmt_event_row(ev, today) for ev in events]; cold = time.perf_counter() - t0
+    t0 = time.perf_counter(); [B.fmt_event_row(ev, today) for ev in events]; warm = time.perf_counter() - t0
+    pages = range(math.ceil(len(events) / B.PAGE_SIZE))
+    def render_pages():
+        t0 = time.perf_counter()
+        for p in pages:
+            B.cards_page(events, p, "🏅 <b>События</b>", "card", "evp")
+        return time.perf_counter() - t0
+    B.CARD_CACHE["day"] = None
+    pages_cold = render_pages(); pages_warm = render_pages()
+    return {"cards": len(events), "cold_ms": round(cold * 1000, 2), "warm_ms": round(warm * 1000, 2),
+            "pages": len(pages), "pages_cold_ms": round(pages_cold * 1000, 2), "pages_warm_ms": round(pages_warm * 1000, 2)}
+
+# === Сценарии на своих данных: каждый в отдельном процессе с новой БД (run_isolated),
+# чтобы их объёмы не искажали остальные прогоны. Возвращают словарь результата.
+def bench_reminders(B, tmp):
+    # один тик напоминаний: 200 событий × 2000 записей, всех видов; отправка — заглушка без лимитов
+    today = B.local_today()
+    day = lambda k: (today + dt.timedelta(days=k)).isoformat()
+    shapes = [(day(0), day(3), 0, "none"),          # start
+              (day(2), day(5), 0, "none"),          # start-2
+              (day(-1), day(3), 1, "daily"),        # report-daily
+              (day(-3), day(0), 1, "final")]        # report-final
+    con = B.db()
+    ids = []
+    for i in range(200):
+        d1, d2, req, sched = shapes[i % len(shapes)]
+        ids.append(con.execute("""INSERT INTO events(emoji,title,date_start,date_end,report_required,report_schedule,is_active)
+                                  VALUES('🏃',?,?,?,?,?,1)""", (f"Напоминание {i}", d1, d2, req, sched)).lastrowid)
+    now = dt.datetime.utcnow().isoformat()
+    con.executemany("INSERT INTO signups(event_id,tg_user_id,signed_at) VALUES(?,?,?)",
+                    [(eid, u, now) for eid in ids for u in range(10, 2010)])
+    con.commit()
+    B.events_changed()
+    sent = itertools.count()
+    B.OUTBOX = B.Outbox(lambda chat_id, text, **kw: next(sent), workers=8, global_rate=1e9, chat_rate=1e9)
+    q0 = db_queries(B)
+    t0 = time.perf_counter()
+    failed = B.reminders_tick(today)
+    tick = time.perf_counter() - t0
+    return {"events": len(ids), "signups": len(ids) * 2000, "reminders": next(sent), "failed": failed,
+            "tick_s": round(tick, 3), "db_queries": db_queries(B) - q0}
+
+def median_ms(fn, runs: int = 20) -> float:
+    fn()
+    samples = []
+    for _ in range(runs):
+        t0 = time.perf_counter(); fn(); samples.append(time.perf_counter() - t0)
+    return round(statistics.median(samples) * 1000, 3)
+
+def bench_history(B, tmp):
+    # ARGS.years лет завершённых событий (600 в год, по 100 записей, 30 отчитываются каждый день)
+    # и 20 текущих; /events, /my самого активного участника и загрузка кэша событий — до и после
+    # ночного обслуживания (архив, ANALYZE, VACUUM)
+    rnd = random.Random(ARGS.seed)
+    today = B.local_today()
+    con = B.db()
+    heavy = 1000   # записан на всё подряд
+    for i in range(ARGS.years * 600):
+        d1 = today - dt.timedelta(days=ARGS.years * 365 - i * 365 // 600)
+        d2 = d1 + dt.timedelta(days=rnd.randint(0, 9))
+        eid = con.execute("""INSERT INTO events(emoji,title,date_start,date_end,location,description,rewards,
+                                                report_required,report_schedule,report_unit,is_active)
+                             VALUES('🏃',?,?,?,'Парк','Описание','Медаль',1,'daily','км',1)""",
+                          (f"История {i}", d1.isoformat(), d2.isoformat())).lastrowid
+        users = [heavy, *rnd.sample(range(1001, 6000), 99)]
+        con.executemany("INSERT INTO signups(event_id,tg_user_id,tg_username,tg_name,signed_at) VALUES(?,?,?,?,?)",
+                        [(eid, u, f"u{u}", f"U{u}", d1.isoformat()) for u in users])
+        con.executemany("INSERT INTO notifications_sent(event_id,tg_user_id,kind,sent_at) VALUES(?,?,'start',?)",
+                        [(eid, u, d1.isoformat()) for u in users])
+        con.executemany("INSERT INTO reports(event_id,tg_user_id,date,value,text,photos,created_at) VALUES(?,?,?,?,'','',?)",
+                        [(eid, u, (d1 + dt.timedelta(days=k)).isoformat(), rnd.uniform(1, 20), d1.isoformat())
+                         for u in users[:30] for k in range((d2 - d1).days + 1)])
+    for i in range(20):
+        d1 = today + dt.timedelta(days=i - 5)
+        eid = con.execute("""INSERT INTO events(emoji,title,date_start,date_end,is_active) VALUES('🏅',?,?,?,1)""",
+                          (f"Сейчас {i}", d1.isoformat(), (d1 + dt.timedelta(days=14)).isoformat())).lastrowid
+        con.execute("INSERT INTO signups(event_id,tg_user_id,signed_at) VALUES(?,?,?)", (eid, heavy, d1.isoformat()))
+    con.commit()
+    B.events_changed()
+    def measure():
+        def events_page():
+            B.PAGE_CACHE.clear(); B.events_page(0)
+        con.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return {"events_load_ms": median_ms(B.EVENTS.load, 5), "events_page_ms": median_ms(events_page),
+                "my_page_ms": median_ms(lambda: B.my_page(heavy, 0)), "db_mb": round(os.path.getsize(B.DB) / 1e6, 1)}
+    before = measure()
+    t0 = time.perf_counter()
+    B.run_maintenance(vacuum=True)
+    maintenance = time.perf_counter() - t0
+    after = measure()
+    return {"years": ARGS.years, "maintenance_s": round(maintenance, 2),
+            **{f"{k}_before": v for k, v in before.items()}, **{f"{k}_after": v for k, v in after.items()}}
+
+def bench_dispatch(B, tmp, n: int = 20000):
+    # цена маршрутизации одного апдейта, мкс: поиск обработчика и диспетчеризация на обработчики-заглушки,
+    # плюс полный путь telebot (process_new_updates) для текста мимо всех маршрутов и noop-кнопки
+    from telebot.types import Update
+    r = B.router
+    for i in range(20):   # заглушки сверх настоящих маршрутов: таблицы заведомо больше 30
+        r.command(f"bench{i}")(lambda m: None)
+        r.callback(f"bench{i}")(lambda c, eid: None)
+    routes = len(r.commands) + len(r.buttons) + len(r.modes) + len(r.callbacks)
+    msg = lambda text: Update.de_json(message(77, text)).message
+    cb = lambda data: Update.de_json(callback(77, data)).callback_query
+    text, command, button = msg("просто текст"), msg("/bench7"), msg("🏅 События")
+    join, stub, noop = cb("join:5"), cb("bench7:5"), cb("noop")
+    def per_update(fn, arg, count=n):
+        t0 = time.perf_counter()
+        for _ in range(count):
+            fn(arg)
+        return round((time.perf_counter() - t0) / count * 1e6, 2)
+    updates = lambda make: [Update.de_json(make()) for _ in range(n // 4)]
+    texts, noops = updates(lambda: message(77, "просто текст")), updates(lambda: callback(77, "noop"))
+    return {"routes": routes,
+            "resolve_text_miss_us": per_update(r.resolve_message, text),
+            "resolve_command_us": per_update(r.resolve_message, command),
+            "resolve_button_us": per_update(r.resolve_message, button),
+            "resolve_callback_us": per_update(r.resolve_callback, join),
+            "dispatch_command_us": per_update(r.dispatch_message, command),
+            "dispatch_callback_us": per_update(r.dispatch_callback, stub),
+            "telebot_text_miss_us": round(per_update(B.bot.process_new_updates, texts, 1) / len(texts), 2),
+            "telebot_noop_us": round(per_update(B.bot.process_new_updates, noops, 1) / len(noops), 2)}
+
+def bench_state(B, tmp):
+    # память под состояние мастеров: --state-users пользователей, половина в мастере события, половина в отчёте
+    def flow(uid):
+        if uid % 2 == 0:
+            return {"mode": "addevent", "step": 5, "data": {"emoji": "", "title": f"Событие {uid}",
+                                                            "date_start": "2030-01-01", "date_end": "2030-01-05"}}
+        return {"mode": "report", "event_id": uid % 50, "step": 2, "photo_req": 0, "photo_ids": [f"AgACAgIAAxkBAAIB{uid}"]}
+    traced_mb = lambda: round(tracemalloc.get_traced_memory()[0] / 1e6, 1)
+    def fill(store):
+        t0 = time.perf_counter()
+        for uid in range(ARGS.state_users):
+            store.save(uid, flow(uid))
+        return round(time.perf_counter() - t0, 2)
+    result = {"users": ARGS.state_users}
+    tracemalloc.start()
+    memory = B.MemoryStateStore()
+    fill(memory); result["memory_mb"] = traced_mb()
+    tracemalloc.stop()
+    del memory
+    # sqlite_mb — вместе с ещё не записанной пачкой dirty, sqlite_flushed_mb — после flush (обычное состояние)
+    tracemalloc.start()
+    store = B.SqliteStateStore(maxsize=20000)   # как STATE при STATE_BACKEND=sqlite
+    fill(store); result["sqlite_mb"] = traced_mb()
+    store.flush(); result["sqlite_flushed_mb"] = traced_mb()
+    tracemalloc.stop()
+    # время — вторым проходом без трассировки: она замедляет и заполнение, и flush в разы
+    result["memory_fill_s"] = fill(B.MemoryStateStore())
+    result["sqlite_fill_s"] = fill(store)
+    t0 = time.perf_counter(); store.flush(); result["flush_s"] = round(time.perf_counter() - t0, 2)
+    con = B.db()
+    con.execute("VACUUM"); con.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    result["db_mb"] = round(os.path.getsize(B.DB) / 1e6, 1)
+    cold = B.SqliteStateStore(maxsize=10000)   # новый процесс: состояния только в conv_state
+    tracemalloc.start()
+    for uid in range(0, ARGS.state_users, 7):
+        cold.get(uid)
+    result["cold_reads"], result["cold_mb"] = len(range(0, ARGS.state_users, 7)), traced_mb()
+    tracemalloc.stop()
+    return result
+
+ISOLATED = {"reminders": bench_reminders, "history": bench_history, "dispatch": bench_dispatch, "state": bench_state}
+
+def run_isolated(name):
+    out = subprocess.run([sys.executable, os.path.abspath(__file__), *sys.argv[1:], "--isolated", name],
+                         capture_output=True, text=True, check=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+# Старт: отдельный процесс на каждый замер. Холодный — новая БД (все миграции), тёплый — та же БД
+# ещё раз (совпал отпечаток схемы). import — тело модуля bot, wall — процесс целиком с интерпретатором.
+STARTUP_PROBE = """import json, sys, time
+t0 = time.perf_counter()
+import bot
+bot.APP.prepare()
+print(json.dumps(dict(bot.APP.timings, import_=time.perf_counter() - t0, warm=bot.SCHEMA["warm"])))
+"""
+
+def bench_startup(tmp, runs: int = 5):
+    def probe(path):
+        env = dict(os.environ, DB_PATH=path)
+        t0 = time.perf_counter()
+        out = subprocess.run([sys.executable, "-c", STARTUP_PROBE], env=env, capture_output=True, text=True,
+                             check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+        return dict(json.loads(out.strip().splitlines()[-1]), wall=time.perf_counter() - t0)
+    result = {}
+    warm_db = os.path.join(tmp, "startup.db")
+    probe(warm_db)   # первый запуск создаёт схему — дальше по этой БД только тёплые
+    for kind in ("cold", "warm"):
+        path, samples = warm_db, []
+        for i in range(runs):
+            if kind == "cold":
+                path = os.path.join(tmp, f"startup-cold-{i}.db")
+            samples.append(probe(path))
+        for key in ("wall", "import_", "schema", "bot", "events"):
+            result[f"{kind}_{key.rstrip('_')}_ms"] = round(statistics.median(s[key] for s in samples) * 1000, 2)
+    return result
+
+def compare(result, path):
+    with open(path, encoding="utf-8") as f:
+        prev = json.load(f)["scenarios"]
+    print("\nИзменения относительно", path)
+    for name, cur in result["scenarios"].items():
+        old = prev.get(name)
+        if not old:
+            continue
+        for key in ("throughput_ups", "p50_ms", "p99_ms", "queries_per_update", "cold_ms", "warm_ms", "tick_s",
+                    "memory_mb", "sqlite_flushed_mb", "flush_s", "resolve_text_miss_us", "dispatch_command_us", "dispatch_callback_us", "telebot_text_miss_us",
+                    "events_page_ms_before", "events_page_ms_after", "my_page_ms_after", "events_load_ms_after",
+                    "pages_cold_ms", "pages_warm_ms",
+                    "cold_wall_ms", "warm_wall_ms", "cold_schema_ms", "warm_schema_ms"):
+            if key in cur and old.get(key):
+                print(f"  {name:12} {key:20} {old[key]:>10} -> {cur[key]:>10}  ({(cur[key] / old[key] - 1) * 100:+.1f}%)")
+
+def main():
+    global ARGS
+    ARGS = parse_args()
+    tmp = setup_env()
+    import bot as B
+    if ARGS.isolated:
+        print(json.dumps(ISOLATED[ARGS.isolated](B, tmp)))
+        return
+    # APP.threaded по умолчанию False: апдейты раздаёт пул бенчмарка, а не воркеры telebot
+    rnd = random.Random(ARGS.seed)
+    t0 = time.perf_counter()
+    ids, users = seed(B, rnd)
+    seeded = time.perf_counter() - t0
+    names = list(SCENARIOS) if ARGS.scenarios == "all" else [s.strip() for s in ARGS.scenarios.split(",")]
+    result = {
+        "meta": {"python": platform.python_version(), "sqlite": B.sqlite3.sqlite_version,
+                 "events": ARGS.events, "users": ARGS.users, "workers": ARGS.workers,
+                 "mode": ARGS.mode, "concurrency": ARGS.concurrency,
+                 "latency_ms": ARGS.latency_ms, "seed": ARGS.seed, "seed_s": round(seeded, 3),
+                 "at": dt.datetime.utcnow().isoformat(timespec="seconds")},
+        "scenarios": {},
+    }
+    # async-сценарии пишутся в результат с суффиксом @async, чтобы --compare сравнивал однотипное
+    runtimes = []
+    if ARGS.mode in ("sync", "both"):
+        runtimes.append(("", None))
+    if ARGS.mode in ("async", "both"):
+        runtimes.append(("@async", B.make_async_runtime()))
+    for suffix, runtime in runtimes:
+        for name in (n for n in names if n in SCENARIOS):
+            r = run_scenario(B, SCENARIOS[name](B, rnd, ids, users), runtime)
+            result["scenarios"][name + suffix] = r
+            print(f"{name + suffix:18} {r['updates']:>7} апд.  {r['throughput_ups']:>9} апд/с  p50 {r['p50_ms']:>8} мс  "
+                  f"p99 {r['p99_ms']:>8} мс  {r['queries_per_update']:>5} запр/апд  ошибок {r['errors']}")
+    if "render" in names or ARGS.scenarios == "all":
+        result["scenarios"]["render"] = r = bench_render(B)
+        print(f"{'render':12} {r['cards']} карточек: холодно {r['cold_ms']} мс, тепло {r['warm_ms']} мс; "
+              f"{r['pages']} страниц: холодно {r['pages_cold_ms']} мс, тепло {r['pages_warm_ms']} мс")
+    if "startup" in names or ARGS.scenarios == "all":
+        result["scenarios"]["startup"] = r = bench_startup(tmp)
+        print(f"{'startup':12} холодный {r['cold_wall_ms']} мс (схема {r['cold_schema_ms']}), "
+              f"тёплый {r['warm_wall_ms']} мс (схема {r['warm_schema_ms']}), модуль bot {r['warm_import_ms']} мс")
+    if "reminders" in names or ARGS.scenarios == "all":
+        result["scenarios"]["reminders"] = r = run_isolated("reminders")
+        print(f"{'reminders':12} {r['events']} событий × 2000 записей: тик {r['tick_s']} с, {r['reminders']} напоминаний, "
+              f"{r['db_queries']} запросов к БД")
+    if "history" in names or ARGS.scenarios == "all":
+        result["scenarios"]["history"] = r = run_isolated("history")
+        print(f"{'history':12} {r['years']} лет: обслуживание {r['maintenance_s']} с, БД {r['db_mb_before']} -> {r['db_mb_after']} МБ; "
+              f"/events {r['events_page_ms_before']} -> {r['events_page_ms_after']} мс, "
+              f"/my {r['my_page_ms_before']} -> {r['my_page_ms_after']} мс, "
+              f"кэш событий {r['events_load_ms_before']} -> {r['events_load_ms_after']} мс")
+    if "dispatch" in names or ARGS.scenarios == "all":
+        result["scenarios"]["dispatch"] = r = run_isolated("dispatch")
+        print(f"{'dispatch':12} {r['routes']} маршрутов, мкс/апдейт: поиск текст мимо {r['resolve_text_miss_us']}, "
+              f"команда {r['resolve_command_us']}, кнопка {r['resolve_button_us']}, callback {r['resolve_callback_us']}; "
+              f"диспетчеризация команды {r['dispatch_command_us']}, callback {r['dispatch_callback_us']}; "
+              f"telebot текст {r['telebot_text_miss_us']}, noop {r['telebot_noop_us']}")
+    if "state" in names or ARGS.scenarios == "all":
+        result["scenarios"]["state"] = r = run_isolated("state")
+        print(f"{'state':12} {r['users']} начатых мастеров: memory {r['memory_mb']} МБ ({r['memory_fill_s']} с), "
+              f"sqlite {r['sqlite_mb']} МБ ({r['sqlite_fill_s']} с), после flush {r['sqlite_flushed_mb']} МБ ({r['flush_s']} с), conv_state {r['db_mb']} МБ; "
+              f"{r['cold_reads']} холодных чтений — {r['cold_mb']} МБ")
+    if ARGS.json:
+        with open(ARGS.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    if ARGS.compare:
+        compare(result, ARGS.compare)
+    print(f"\nБД прогона: {tmp}")
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,19 @@
-import os, sqlite3, datetime as dt, threading, time
+import os, sqlite3, datetime as dt, threading, time, queue, random, heapq, json, atexit, functools, hmac, asyncio
+import bisect, csv, html, io, logging, math, re, secrets, sys, tempfile
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
+import requests
 from dateutil import tz
 from dotenv import load_dotenv
 import telebot
-from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton
+from telebot import apihelper
+from telebot.apihelper import ApiTelegramException, ApiHTTPException
+from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton, Update
+
+IMPORT_STARTED = time.perf_counter()
 
 # === ENV ===
 load_dotenv()
@@ -10,118 +21,679 @@ BOT_TOKEN = os.getenv("BOT_TOKEN", "7539551272:AAEM1etW4CGIveFZMNpn_v29NrQe9nTFF
 ADMIN_IDS = {int(x.strip()) for x in os.getenv("ADMIN_IDS", "176867232").split(",") if x.strip().isdigit()}
 TZ = tz.gettz(os.getenv("TZ", "Europe/Moscow"))
 DB = os.getenv("DB_PATH", "./sportsbot.db")
+STATE_BACKEND = os.getenv("STATE_BACKEND", "sqlite")   # sqlite|memory
+STATE_TTL = int(os.getenv("STATE_TTL", "86400"))        # брошенный мастер живёт сутки
+STATE_CACHE_TTL = float(os.getenv("STATE_CACHE_TTL", "2"))   # sqlite: сколько верим копии в памяти процесса
+# окна рассылки напоминаний (локальное время TZ)
+REMIND_AT = {
+    "start": os.getenv("REMIND_START_AT", "10:00"),
+    "start-2": os.getenv("REMIND_START_AT", "10:00"),
+    "report-daily": os.getenv("REMIND_DAILY_AT", "20:00"),
+    "report-final": os.getenv("REMIND_FINAL_AT", "12:00"),
+}
+# режим приёма апдейтов: polling (по умолчанию), webhook или async (AsyncTeleBot, нужен aiohttp)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")            # публичный https-адрес, который отдаём Telegram
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")   # за reverse proxy; наружу — только осознанно
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")      # X-Telegram-Bot-Api-Secret-Token; пусто — сгенерируем
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "8"))
+WEBHOOK_QUEUE = int(os.getenv("WEBHOOK_QUEUE", "1000"))
+# метрики в формате Prometheus: http://METRICS_LISTEN:METRICS_PORT/metrics (0 — выключить)
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+# архив завершённых событий: отдельный файл, переезд через ARCHIVE_AFTER_DAYS дней после окончания
+ARCHIVE_DB = os.getenv("ARCHIVE_DB", os.path.splitext(DB)[0] + "-archive.db")
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "90"))
+MAINTENANCE_AT = os.getenv("MAINTENANCE_AT", "04:00")  # ночное обслуживание БД (локальное время TZ)
 if not BOT_TOKEN:
     raise RuntimeError("BOT_TOKEN is required in .env")
-bot = telebot.TeleBot(BOT_TOKEN, parse_mode="HTML")
+log = logging.getLogger("sportsbot")
+
+# === App
+# Импорт модуля ничего не запускает: TeleBot создаётся при первом обращении к bot, соединение
+# с БД и проверка схемы — при первом запросе (db()), фоновые потоки, сервер метрик и обёртка
+# Bot API — в App.start(). Обработчики можно импортировать и гонять в тестах и bench.py.
+class App:
+    def __init__(self):
+        self.threaded = False   # пул воркеров telebot нужен только long polling, см. start()
+        self.started = False
+        self.timings = {}       # этап старта -> секунды
+        self._bot = None
+        self._lock = threading.Lock()
+
+    @property
+    def bot(self) -> telebot.TeleBot:
+        if self._bot is None:
+            with self._lock:
+                if self._bot is None:
+                    tbot = telebot.TeleBot(BOT_TOKEN, parse_mode="HTML", threaded=self.threaded)
+                    tbot.register_message_handler(router.dispatch_message, content_types=["text","photo","document"])
+                    tbot.register_callback_query_handler(router.dispatch_callback, func=None)
+                    self._bot = tbot
+        return self._bot
+
+    def _stage(self, name: str, fn, *args):
+        t0 = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            self.timings[name] = time.perf_counter() - t0
+
+    def prepare(self):
+        # всё, что нужно до первого апдейта, но без потоков и сети: схема, бот, кэш событий
+        self._stage("schema", db)
+        self._stage("bot", lambda: self.bot)
+        self._stage("events", EVENTS.load)
+        return self
+
+    def start(self, mode: str = BOT_MODE):
+        if self.started:
+            return self
+        self.started = True
+        self.threaded = mode == "polling"   # вебхук и async раздают апдейты своими воркерами
+        self.prepare()
+        t0 = time.perf_counter()
+        _time_api()
+        if isinstance(STATE, SqliteStateStore):
+            atexit.register(STATE.flush)
+        threading.Thread(target=REMINDERS.run, name="reminders", daemon=True).start()
+        threading.Thread(target=maintenance_loop, name="maintenance", daemon=True).start()
+        start_metrics_server()
+        self.timings["threads"] = time.perf_counter() - t0
+        self.timings["total"] = time.perf_counter() - IMPORT_STARTED
+        log.info("startup (%s schema): %s", "warm" if SCHEMA["warm"] else "cold",
+                 ", ".join(f"{k} {v * 1000:.1f} ms" for k, v in self.timings.items()))
+        return self
+
+class BotProxy:
+    # `bot` в обработчиках — это APP.bot; прокси нужен, чтобы TeleBot не создавался при импорте
+    __slots__ = ()
+    def __getattr__(self, name):
+        return getattr(APP.bot, name)
+    def __setattr__(self, name, value):
+        setattr(APP.bot, name, value)
+
+APP = App()
+bot = BotProxy()
+
+# === Metrics
+# Счётчики и гистограммы живут в памяти процесса. Таймеры стоят на трёх горячих границах:
+# обработчик апдейта (Router/AsyncRuntime), запрос к SQLite (TimedConnection) и вызов Bot API
+# (apihelper._make_request). Наружу всё отдаётся текстом Prometheus, см. MetricsServer.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}     # (name, labels) -> число
+        self.histograms = {}   # (name, labels) -> [счётчики по корзинам..., +Inf, сумма, количество]
+        self.buckets = {}      # name -> границы корзин
+        self.gauges = {}       # name -> функция без аргументов
+
+    # метки не сортируются: у каждого места вызова порядок один и тот же, а это горячий путь
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(labels.items()))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, tuple(labels.items()))
+        with self.lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = [0] * (len(buckets) + 3)
+                self.buckets[name] = buckets
+            h[bisect.bisect_left(buckets, value)] += 1
+            h[-2] += value
+            h[-1] += 1
+
+    def error(self, where: str, e: BaseException):
+        # вместо молчаливого except: посчитать по типу исключения и записать в лог со стеком
+        self.inc("sportsbot_errors_total", where=where, type=type(e).__name__)
+        log.error("%s: %r", where, e, exc_info=e)
+
+    @contextmanager
+    def timer(self, name: str, where: str, **labels):
+        t0 = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.error(where, e)
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - t0, **labels)
+
+    def render(self) -> str:
+        def fmt(labels, extra=()):
+            pairs = [*labels, *extra]
+            if not pairs:
+                return ""
+            esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in pairs) + "}"
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((k, list(v)) for k, v in self.histograms.items())
+        out, typed = [], set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name); out.append(f"# TYPE {name} counter")
+            out.append(f"{name}{fmt(labels)} {value}")
+        for (name, labels), h in histograms:
+            if name not in typed:
+                typed.add(name); out.append(f"# TYPE {name} histogram")
+            acc = 0
+            for bound, n in zip((*self.buckets[name], "+Inf"), h):
+                acc += n
+                out.append(f"{name}_bucket{fmt(labels, [('le', bound)])} {acc}")
+            out.append(f"{name}_sum{fmt(labels)} {h[-2]}")
+            out.append(f"{name}_count{fmt(labels)} {h[-1]}")
+        for name, fn in sorted(self.gauges.items()):
+            out.append(f"# TYPE {name} gauge")
+            out.append(f"{name} {fn()}")
+        return "\n".join(out) + "\n"
+
+METRICS = Metrics()
+
+def _time_api():
+    request = apihelper._make_request
+    if getattr(request, "timed", False):
+        return
+    def timed(token, method_name, *args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return request(token, method_name, *args, **kwargs)
+        except Exception as e:
+            METRICS.inc("sportsbot_telegram_errors_total", method=method_name,
+                        type=str(getattr(e, "error_code", "") or type(e).__name__))
+            raise
+        finally:
+            METRICS.observe("sportsbot_telegram_seconds", time.perf_counter() - t0, method=method_name)
+    timed.timed = True
+    apihelper._make_request = timed
+
+def instrumented(handler, *args):
+    # время обработчика, ошибки по типам и число запросов к БД на один апдейт
+    _db_local.queries = 0
+    try:
+        with METRICS.timer("sportsbot_handler_seconds", handler.__name__, handler=handler.__name__):
+            return handler(*args)
+    finally:
+        METRICS.observe("sportsbot_update_queries", _db_local.queries, QUERY_BUCKETS, handler=handler.__name__)
 
 # === DB ===
+# Одно долгоживущее соединение на поток (воркеры telebot + поток напоминаний).
+# WAL: читатели не блокируют писателя, поэтому пуллинг и напоминания не дерутся за лок.
+DB_STATS = {"opened": 0, "reused": 0}
+_db_local = threading.local()
+
+@functools.lru_cache(maxsize=1024)
+def _query_op(sql: str) -> str:
+    return sql.lstrip()[:8].split(None, 1)[0].upper()
+
+def _observe_query(sql: str, t0: float):
+    METRICS.observe("sportsbot_db_seconds", time.perf_counter() - t0, op=_query_op(sql))
+    _db_local.queries = getattr(_db_local, "queries", 0) + 1
+
+class TimedCursor(sqlite3.Cursor):
+    def execute(self, sql, params=()):
+        t0 = time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        except sqlite3.Error as e:
+            METRICS.inc("sportsbot_db_errors_total", type=type(e).__name__)
+            raise
+        finally:
+            _observe_query(sql, t0)
+
+    def executemany(self, sql, seq):
+        t0 = time.perf_counter()
+        try:
+            return super().executemany(sql, seq)
+        except sqlite3.Error as e:
+            METRICS.inc("sportsbot_db_errors_total", type=type(e).__name__)
+            raise
+        finally:
+            _observe_query(sql, t0)
+
+class TimedConnection(sqlite3.Connection):
+    # Connection.execute в C не идёт через cursor(), поэтому переопределены оба пути
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+    def executemany(self, sql, seq):
+        return self.cursor().executemany(sql, seq)
+
+def _connect():
+    con = sqlite3.connect(DB, check_same_thread=False, timeout=15, cached_statements=256, factory=TimedConnection)
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("PRAGMA synchronous=NORMAL")      # в WAL достаточно, fsync только на чекпоинте
+    con.execute("PRAGMA cache_size=-16000")       # ~16 МБ страничного кэша
+    con.execute("PRAGMA mmap_size=134217728")     # 128 МБ
+    con.execute("PRAGMA temp_store=MEMORY")
+    con.execute("PRAGMA busy_timeout=15000")
+    con.execute("PRAGMA foreign_keys=ON")         # ON DELETE CASCADE от events, см. миграцию 5
+    return con
+
 def db():
-    return sqlite3.connect(DB, check_same_thread=False)
+    con = getattr(_db_local, "con", None)
+    if con is None:
+        con = _connect()
+        if not SCHEMA["ready"]:
+            ensure_schema(con)
+        _db_local.con = con
+        DB_STATS["opened"] += 1
+    else:
+        DB_STATS["reused"] += 1
+    return con
 
-def ensure_schema():
-    with db() as con:
-        cur = con.cursor()
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS events(
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                emoji TEXT,
-                title TEXT NOT NULL,
-                date_start TEXT NOT NULL,         -- YYYY-MM-DD (локальная)
-                date_end TEXT NOT NULL,           -- YYYY-MM-DD (локальная)
-                location TEXT,
-                capacity INTEGER,
-                description TEXT,
-                rewards TEXT,
-                report_required INTEGER DEFAULT 0,
-                report_schedule TEXT DEFAULT 'none',   -- none|daily|final
-                report_unit TEXT,
-                report_photo_required INTEGER DEFAULT 0, -- 0=не обяз., 1=обяз.
-                is_active INTEGER DEFAULT 1
-            )
-        """)
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS signups(
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                event_id INTEGER NOT NULL,
-                tg_user_id INTEGER NOT NULL,
-                tg_username TEXT,
-                tg_name TEXT,
-                signed_at TEXT NOT NULL,          -- UTC ISO
-                UNIQUE(event_id, tg_user_id)
-            )
-        """)
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS reports(
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                event_id INTEGER NOT NULL,
-                tg_user_id INTEGER NOT NULL,
-                date TEXT NOT NULL,               -- YYYY-MM-DD (локальная дата)
-                value REAL,
-                text TEXT,
-                photos TEXT,                      -- одиночный file_id (строка)
-                created_at TEXT NOT NULL,         -- UTC ISO
-                UNIQUE(event_id, tg_user_id, date)
-            )
-        """)
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS notifications_sent(
-                event_id INTEGER NOT NULL,
-                tg_user_id INTEGER NOT NULL,
-                kind TEXT NOT NULL,               -- start|start-2|report-daily|report-final
-                sent_at TEXT NOT NULL,
-                PRIMARY KEY (event_id, tg_user_id, kind)
-            )
-        """)
-        # лёгкая миграция на случай старой БД
-        cur.execute("PRAGMA table_info(events)")
-        cols = {row[1] for row in cur.fetchall()}
-        alters = []
-        if "report_required" not in cols: alters.append("ALTER TABLE events ADD COLUMN report_required INTEGER DEFAULT 0")
-        if "report_schedule" not in cols: alters.append("ALTER TABLE events ADD COLUMN report_schedule TEXT DEFAULT 'none'")
-        if "report_unit" not in cols: alters.append("ALTER TABLE events ADD COLUMN report_unit TEXT")
-        if "report_photo_required" not in cols: alters.append("ALTER TABLE events ADD COLUMN report_photo_required INTEGER DEFAULT 0")
-        for sql in alters:
-            cur.execute(sql)
-        con.commit()
+def _migration_1(cur):
+    # базовая схема: таблицы, колонки старых БД, счётчик мест
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS events(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            emoji TEXT,
+            title TEXT NOT NULL,
+            date_start TEXT NOT NULL,         -- YYYY-MM-DD (локальная)
+            date_end TEXT NOT NULL,           -- YYYY-MM-DD (локальная)
+            location TEXT,
+            capacity INTEGER,
+            description TEXT,
+            rewards TEXT,
+            report_required INTEGER DEFAULT 0,
+            report_schedule TEXT DEFAULT 'none',   -- none|daily|final
+            report_unit TEXT,
+            report_photo_required INTEGER DEFAULT 0, -- 0=не обяз., 1=обяз.
+            is_active INTEGER DEFAULT 1,
+            taken INTEGER NOT NULL DEFAULT 0       -- занято мест, ведут триггеры на signups
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS signups(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            event_id INTEGER NOT NULL,
+            tg_user_id INTEGER NOT NULL,
+            tg_username TEXT,
+            tg_name TEXT,
+            signed_at TEXT NOT NULL,          -- UTC ISO
+            UNIQUE(event_id, tg_user_id)
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS reports(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            event_id INTEGER NOT NULL,
+            tg_user_id INTEGER NOT NULL,
+            date TEXT NOT NULL,               -- YYYY-MM-DD (локальная дата)
+            value REAL,
+            text TEXT,
+            photos TEXT,                      -- одиночный file_id (строка)
+            created_at TEXT NOT NULL,         -- UTC ISO
+            UNIQUE(event_id, tg_user_id, date)
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS notifications_sent(
+            event_id INTEGER NOT NULL,
+            tg_user_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,               -- start|start-2|report-daily|report-final
+            sent_at TEXT NOT NULL,
+            PRIMARY KEY (event_id, tg_user_id, kind)
+        )
+    """)
+    # БД, созданные до появления миграций, дотягиваем по PRAGMA table_info (один раз)
+    cur.execute("PRAGMA table_info(events)")
+    cols = {row[1] for row in cur.fetchall()}
+    alters = []
+    if "report_required" not in cols: alters.append("ALTER TABLE events ADD COLUMN report_required INTEGER DEFAULT 0")
+    if "report_schedule" not in cols: alters.append("ALTER TABLE events ADD COLUMN report_schedule TEXT DEFAULT 'none'")
+    if "report_unit" not in cols: alters.append("ALTER TABLE events ADD COLUMN report_unit TEXT")
+    if "report_photo_required" not in cols: alters.append("ALTER TABLE events ADD COLUMN report_photo_required INTEGER DEFAULT 0")
+    if "taken" not in cols:
+        alters.append("ALTER TABLE events ADD COLUMN taken INTEGER NOT NULL DEFAULT 0")
+        alters.append("UPDATE events SET taken=(SELECT COUNT(*) FROM signups WHERE event_id=events.id)")
+    for sql in alters:
+        cur.execute(sql)
+    _taken_triggers(cur)
 
-ensure_schema()
-# === Seed: добавляем событие "Осенний вызов" один раз ===
-def seed_autumn_challenge_once():
-    title = "Челлендж «Осенний вызов»"
-    ds = "2025-10-20"   # дата начала (YYYY-MM-DD)
-    de = "2025-10-24"   # дата окончания (YYYY-MM-DD)
-    with db() as con:
-        cur = con.cursor()
-        # проверяем, не добавлено ли уже (по названию и датам)
-        cur.execute("SELECT 1 FROM events WHERE title=? AND date_start=? AND date_end=?", (title, ds, de))
-        if cur.fetchone():
-            return  # уже есть — ничего не делаем
-        # вставляем событие
-        cur.execute("""
-            INSERT INTO events(
-                emoji, title, date_start, date_end, location, capacity, description, rewards, is_active
-            ) VALUES (?,?,?,?,?,?,?,?,1)
-        """, (
-            "🔥",
-            title,
-            ds,
-            de,
-            "Онлайн",
-            None,  # без лимита
-            "5 дней, 3 активности: планка, баланс на 1 ноге, отжимания",
-            ""     # награды (можно заполнить позже)
-        ))
-        con.commit()
+def _taken_triggers(cur):
+    # счётчик мест: обновляется в той же транзакции, что и запись/отписка
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS signups_taken_ins AFTER INSERT ON signups BEGIN
+            UPDATE events SET taken=taken+1 WHERE id=NEW.event_id;
+        END
+    """)
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS signups_taken_del AFTER DELETE ON signups BEGIN
+            UPDATE events SET taken=taken-1 WHERE id=OLD.event_id;
+        END
+    """)
+
+def _migration_2(cur):
+    # индексы под горячие запросы: /events, /my и напоминания, рейтинг, списки участников
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_events_active_end ON events(is_active, date_end, date_start)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_events_active_start ON events(is_active, date_start)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_signups_user ON signups(tg_user_id, event_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_signups_event_signed ON signups(event_id, signed_at)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_reports_event_user ON reports(event_id, tg_user_id, value)")
+
+def _migration_3(cur):
+    # итоги рейтинга: upsert_report двигает total на дельту, рейтинг читается по индексу
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS standings(
+            event_id INTEGER NOT NULL,
+            tg_user_id INTEGER NOT NULL,
+            total REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (event_id, tg_user_id)
+        ) WITHOUT ROWID
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_standings_event_total ON standings(event_id, total DESC)")
+    cur.execute("""INSERT OR REPLACE INTO standings(event_id, tg_user_id, total)
+                   SELECT event_id, tg_user_id, COALESCE(SUM(value), 0) FROM reports GROUP BY event_id, tg_user_id""")
+
+def _migration_4(cur):
+    # состояние диалогов (мастера, правка, отчёт) — переживает рестарт, см. SqliteStateStore
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS conv_state(
+            tg_user_id INTEGER PRIMARY KEY,
+            data TEXT NOT NULL,               -- компактный JSON
+            expires REAL NOT NULL             -- unix time
+        ) WITHOUT ROWID
+    """)
+
+# Дочерние таблицы events с ON DELETE CASCADE (миграция 5); {name} — имя создаваемой таблицы.
+CASCADE_TABLES = [
+    ("signups", """
+        CREATE TABLE {name}(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            event_id INTEGER NOT NULL REFERENCES events(id) ON DELETE CASCADE,
+            tg_user_id INTEGER NOT NULL,
+            tg_username TEXT,
+            tg_name TEXT,
+            signed_at TEXT NOT NULL,
+            UNIQUE(event_id, tg_user_id)
+        )"""),
+    ("reports", """
+        CREATE TABLE {name}(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            event_id INTEGER NOT NULL REFERENCES events(id) ON DELETE CASCADE,
+            tg_user_id INTEGER NOT NULL,
+            date TEXT NOT NULL,
+            value REAL,
+            text TEXT,
+            photos TEXT,
+            created_at TEXT NOT NULL,
+            UNIQUE(event_id, tg_user_id, date)
+        )"""),
+    ("notifications_sent", """
+        CREATE TABLE {name}(
+            event_id INTEGER NOT NULL REFERENCES events(id) ON DELETE CASCADE,
+            tg_user_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            sent_at TEXT NOT NULL,
+            PRIMARY KEY (event_id, tg_user_id, kind)
+        )"""),
+    ("standings", """
+        CREATE TABLE {name}(
+            event_id INTEGER NOT NULL REFERENCES events(id) ON DELETE CASCADE,
+            tg_user_id INTEGER NOT NULL,
+            total REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (event_id, tg_user_id)
+        ) WITHOUT ROWID"""),
+]
+
+def _migration_5(cur):
+    # внешние ключи с каскадным удалением: ALTER их не добавляет, поэтому таблицы пересоздаются.
+    # Сироты — строки давно удалённых событий — при переносе отбрасываются.
+    for table, create in CASCADE_TABLES:
+        cur.execute(create.format(name=f"{table}_new"))
+        cur.execute(f"PRAGMA table_info({table}_new)")
+        new_cols = [row[1] for row in cur.fetchall()]
+        cur.execute(f"PRAGMA table_info({table})")
+        old_cols = {row[1] for row in cur.fetchall()}
+        cols = ",".join(c for c in new_cols if c in old_cols)
+        cur.execute(f"""INSERT INTO {table}_new({cols}) SELECT {cols} FROM {table}
+                        WHERE event_id IN (SELECT id FROM events)""")
+        cur.execute(f"DROP TABLE {table}")
+        cur.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+    # индексы и триггеры удалились вместе со старыми таблицами
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_signups_user ON signups(tg_user_id, event_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_signups_event_signed ON signups(event_id, signed_at)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_reports_event_user ON reports(event_id, tg_user_id, value)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_standings_event_total ON standings(event_id, total DESC)")
+    _taken_triggers(cur)
+    cur.execute("UPDATE events SET taken=(SELECT COUNT(*) FROM signups WHERE event_id=events.id)")
+
+def _migration_6(cur):
+    # «Осенний вызов» добавляется один раз. Раньше проверка шла на каждом старте,
+    # и после архивации событие вставлялось бы заново.
+    title, ds, de = "Челлендж «Осенний вызов»", "2025-10-20", "2025-10-24"
+    cur.execute("SELECT 1 FROM events WHERE title=? AND date_start=? AND date_end=?", (title, ds, de))
+    if cur.fetchone():
+        return  # уже есть — ничего не делаем
+    cur.execute("""
+        INSERT INTO events(
+            emoji, title, date_start, date_end, location, capacity, description, rewards, is_active
+        ) VALUES (?,?,?,?,?,?,?,?,1)
+    """, (
+        "🔥",
+        title,
+        ds,
+        de,
+        "Онлайн",
+        None,  # без лимита
+        "5 дней, 3 активности: планка, баланс на 1 ноге, отжимания",
+        ""     # награды (можно заполнить позже)
+    ))
+
+def _migration_7(cur):
+    # журнал ежедневных напоминаний: строка на (событие, день, участник). notifications_sent
+    # ключуется без даты и для report-daily срабатывал только в первый день.
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS daily_notified(
+            event_id INTEGER NOT NULL REFERENCES events(id) ON DELETE CASCADE,
+            day TEXT NOT NULL,                -- YYYY-MM-DD (локальная дата)
+            tg_user_id INTEGER NOT NULL,
+            PRIMARY KEY (event_id, day, tg_user_id)
+        ) WITHOUT ROWID
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_reports_event_date ON reports(event_id, date, tg_user_id)")
+    cur.execute("DELETE FROM notifications_sent WHERE kind='report-daily'")
+
+def _migration_8(cur):
+    # все фото-пруфы отчёта: строка на фото, pos — порядок в альбоме. В reports.photos
+    # по-прежнему первое фото, чтобы старые выгрузки и архив читались как раньше.
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS report_photos(
+            event_id INTEGER NOT NULL REFERENCES events(id) ON DELETE CASCADE,
+            tg_user_id INTEGER NOT NULL,
+            date TEXT NOT NULL,               -- YYYY-MM-DD (локальная дата), как в reports
+            pos INTEGER NOT NULL,
+            file_id TEXT NOT NULL,
+            PRIMARY KEY (event_id, tg_user_id, date, pos)
+        ) WITHOUT ROWID
+    """)
+    cur.execute("""INSERT OR IGNORE INTO report_photos(event_id,tg_user_id,date,pos,file_id)
+                   SELECT event_id, tg_user_id, date, 0, photos FROM reports WHERE photos<>''""")
+
+# Сводки для /stats: по событию и дню — сколько отчиталось, сумма, максимум и фото; по событию —
+# сколько вообще отчитывалось (разных авторов в reports). Ведут триггеры на reports в той же транзакции,
+# что и запись отчёта; число записавшихся уже есть в events.taken. STATS_*_SQL — полный пересчёт
+# по исходным таблицам для сверки.
+STATS_DAY_SQL = """SELECT r.event_id, r.date, COUNT(*), SUM(COALESCE(r.value,0)), MAX(r.value), COALESCE(p.n,0)
+                    FROM reports r
+                    LEFT JOIN (SELECT event_id, date, COUNT(*) AS n FROM report_photos {where} GROUP BY event_id, date) p
+                           ON p.event_id=r.event_id AND p.date=r.date
+                    {where_r} GROUP BY r.event_id, r.date"""
+STATS_EVENT_SQL = "SELECT event_id, COUNT(DISTINCT tg_user_id) FROM reports {where} GROUP BY event_id"
+
+def stats_recompute(cur, eid: int | None = None):
+    # -> ({(event_id, date): (reporters, total, max_value, photos)}, {event_id: reporters})
+    where, where_r, args = ("WHERE event_id=?", "WHERE r.event_id=?", (eid, eid)) if eid else ("", "", ())
+    cur.execute(STATS_DAY_SQL.format(where=where, where_r=where_r), args)
+    days = {(e, d): rest for e, d, *rest in cur.fetchall()}
+    cur.execute(STATS_EVENT_SQL.format(where=where), args[:1])
+    return days, dict(cur.fetchall())
+
+def stats_rebuild(cur, eid: int | None = None):
+    days, events = stats_recompute(cur, eid)
+    where, args = ("WHERE event_id=?", (eid,)) if eid else ("", ())
+    cur.execute(f"DELETE FROM event_day_stats {where}", args)
+    cur.execute(f"DELETE FROM event_stats {where}", args)
+    cur.executemany("INSERT INTO event_day_stats(event_id,date,reporters,total,max_value,photos) VALUES(?,?,?,?,?,?)",
+                    [(*key, *row) for key, row in days.items()])
+    cur.executemany("INSERT INTO event_stats(event_id,reporters) VALUES(?,?)", events.items())
+
+def _migration_9(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS event_day_stats(
+            event_id INTEGER NOT NULL REFERENCES events(id) ON DELETE CASCADE,
+            date TEXT NOT NULL,               -- YYYY-MM-DD (локальная дата), как в reports
+            reporters INTEGER NOT NULL DEFAULT 0,
+            total REAL NOT NULL DEFAULT 0,
+            max_value REAL,
+            photos INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (event_id, date)
+        ) WITHOUT ROWID
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS event_stats(
+            event_id INTEGER PRIMARY KEY REFERENCES events(id) ON DELETE CASCADE,
+            reporters INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    day = "WHERE event_id=NEW.event_id AND date=NEW.date"
+    # максимум пересчитывается по дню, только когда уменьшили или удалили сам максимум
+    remax = "(SELECT MAX(value) FROM reports WHERE event_id={0}.event_id AND date={0}.date)"
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS reports_stats_ins AFTER INSERT ON reports BEGIN
+            INSERT OR IGNORE INTO event_day_stats(event_id,date) VALUES(NEW.event_id,NEW.date);
+            UPDATE event_day_stats SET reporters=reporters+1, total=total+COALESCE(NEW.value,0),
+                   max_value=CASE WHEN max_value IS NULL OR NEW.value>max_value THEN NEW.value ELSE max_value END
+             {day};
+        END
+    """)
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS reports_stats_upd AFTER UPDATE OF value ON reports BEGIN
+            UPDATE event_day_stats SET total=total-COALESCE(OLD.value,0)+COALESCE(NEW.value,0),
+                   max_value=CASE WHEN max_value IS NULL OR NEW.value>=max_value THEN NEW.value
+                                  WHEN OLD.value<max_value THEN max_value
+                                  ELSE {remax.format("NEW")} END
+             {day};
+        END
+    """)
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS reports_stats_del AFTER DELETE ON reports BEGIN
+            UPDATE event_day_stats SET reporters=reporters-1, total=total-COALESCE(OLD.value,0),
+                   max_value=CASE WHEN OLD.value<max_value THEN max_value ELSE {remax.format("OLD")} END
+             WHERE event_id=OLD.event_id AND date=OLD.date;
+        END
+    """)
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS report_photos_stats_ins AFTER INSERT ON report_photos BEGIN
+            UPDATE event_day_stats SET photos=photos+1 {day};
+        END
+    """)
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS report_photos_stats_del AFTER DELETE ON report_photos BEGIN
+            UPDATE event_day_stats SET photos=photos-1 WHERE event_id=OLD.event_id AND date=OLD.date;
+        END
+    """)
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS standings_stats_ins AFTER INSERT ON standings BEGIN
+            INSERT OR IGNORE INTO event_stats(event_id) VALUES(NEW.event_id);
+            UPDATE event_stats SET reporters=reporters+1 WHERE event_id=NEW.event_id;
+        END
+    """)
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS standings_stats_del AFTER DELETE ON standings BEGIN
+            UPDATE event_stats SET reporters=reporters-1 WHERE event_id=OLD.event_id;
+        END
+    """)
+    stats_rebuild(cur)
+
+def _migration_10(cur):
+    # event_stats.reporters вели триггеры на standings — производной таблице, которую обновляет код
+    # записи отчёта. Отчёт, удалённый мимо него, сводку не менял. Теперь счёт идёт по самим reports:
+    # автор добавляется с первым своим отчётом в событии и уходит с последним
+    cur.execute("DROP TRIGGER IF EXISTS standings_stats_ins")
+    cur.execute("DROP TRIGGER IF EXISTS standings_stats_del")
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS reports_reporters_ins AFTER INSERT ON reports
+        WHEN NOT EXISTS (SELECT 1 FROM reports WHERE event_id=NEW.event_id AND tg_user_id=NEW.tg_user_id AND date<>NEW.date)
+        BEGIN
+            INSERT OR IGNORE INTO event_stats(event_id) VALUES(NEW.event_id);
+            UPDATE event_stats SET reporters=reporters+1 WHERE event_id=NEW.event_id;
+        END
+    """)
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS reports_reporters_del AFTER DELETE ON reports
+        WHEN NOT EXISTS (SELECT 1 FROM reports WHERE event_id=OLD.event_id AND tg_user_id=OLD.tg_user_id)
+        BEGIN
+            UPDATE event_stats SET reporters=reporters-1 WHERE event_id=OLD.event_id;
+        END
+    """)
+    stats_rebuild(cur)
 
-seed_autumn_challenge_once()
+# Нумерованные миграции: каждая выполняется один раз в своей транзакции, номер пишется в schema_version.
+# Новые — только добавлять в конец списка.
+MIGRATIONS = [
+    (1, _migration_1),
+    (2, _migration_2),
+    (3, _migration_3),
+    (4, _migration_4),
+    (5, _migration_5),
+    (6, _migration_6),
+    (7, _migration_7),
+    (8, _migration_8),
+    (9, _migration_9),
+    (10, _migration_10),
+]
+
+# Отпечаток схемы — номер последней миграции в PRAGMA user_version (лежит в заголовке файла БД).
+# Совпал — тёплый старт: одно чтение заголовка вместо schema_version и миграций. Проверка идёт
+# один раз на процесс, при первом соединении (db()).
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+SCHEMA = {"ready": False, "warm": None, "applied": 0}
+_schema_lock = threading.Lock()
+
+def ensure_schema(con):
+    with _schema_lock:
+        if SCHEMA["ready"]:
+            return
+        cur = con.cursor()
+        warm = cur.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION
+        applied = 0
+        if not warm:
+            cur.execute("CREATE TABLE IF NOT EXISTS schema_version(version INTEGER PRIMARY KEY, applied_at TEXT NOT NULL)")
+            cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+            current = cur.fetchone()[0]
+            for version, migrate in MIGRATIONS:
+                if version <= current:
+                    continue
+                with con:
+                    cur.execute("BEGIN IMMEDIATE")
+                    migrate(cur)
+                    cur.execute("INSERT INTO schema_version(version, applied_at) VALUES(?,?)",
+                                (version, dt.datetime.utcnow().isoformat()))
+                applied += 1
+            cur.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+        SCHEMA.update(ready=True, warm=warm, applied=applied)
 
 # === Utils ===
 RU_MONTHS_GEN = {
     1:"января",2:"февраля",3:"марта",4:"апреля",5:"мая",6:"июня",
     7:"июля",8:"августа",9:"сентября",10:"октября",11:"ноября",12:"декабря"
 }
+_TODAY = [None, 0.0]   # [сегодняшняя дата в TZ, unix-время ближайшей полуночи]
 def local_today() -> dt.date:
-    return dt.datetime.now(TZ).date()
+    # datetime.now(TZ) с dateutil-зоной дорогой, а дата меняется раз в сутки
+    if time.time() >= _TODAY[1]:
+        d = dt.datetime.now(TZ).date()
+        _TODAY[:] = [d, dt.datetime.combine(d + dt.timedelta(days=1), dt.time(), tzinfo=TZ).timestamp()]
+    return _TODAY[0]
 def today_str() -> str:
     return local_today().strftime("%Y-%m-%d")
 def parse_date(s: str) -> dt.date:
@@ -162,28 +734,128 @@ WELCOME_TEXT = (
 def is_admin(uid: int) -> bool:
     return uid in ADMIN_IDS
 
-def fmt_event_row(row) -> str:
-    # (id,emoji,title,date_start,date_end,location,capacity,description,rewards,
-    #  rep_req,rep_sched,rep_unit,rep_photo,is_active)
-    (eid, emoji, title, ds, de, loc, cap, desc, rew,
-     rep_req, rep_sched, rep_unit, rep_photo, _) = row
-    d1 = dt.datetime.strptime(ds, "%Y-%m-%d").date()
-    d2 = dt.datetime.strptime(de, "%Y-%m-%d").date()
-    emj = (emoji or "🏅").strip() or "🏅"
+# Карточка события: всё, кроме статуса, собирается один раз на объект Event (объект
+# заменяется при любой правке события), готовый текст с подставленным статусом кэшируется
+# до локальной полуночи — дальше статус мог смениться, и кэш сбрасывается целиком.
+CARD_CACHE = {"day": None, "cards": {}}   # cards: id -> (Event, text)
+
+def card_parts(ev):
+    emj = (ev.emoji or "🏅").strip() or "🏅"
     extras = []
-    if rep_req:
-        s = "ежедневные" if rep_sched == "daily" else "в финале"
-        if rep_unit: s += f" ({rep_unit})"
+    if ev.report_required:
+        s = "ежедневные" if ev.report_schedule == "daily" else "в финале"
+        if ev.report_unit: s += f" ({ev.report_unit})"
         extras.append(f"Отчёты: {s}")
-        if rep_photo: extras.append("Фото-пруф обязателен")
-    lines = [
-        f"{emj} <b>{title}</b> | {ru_range(d1,d2)} | {status_for(d1,d2,local_today())}",
-        f"Описание: {desc or '—'}",
-        f"Награды: {rew or '—'}"
-    ]
+        if ev.report_photo_required: extras.append("Фото-пруф обязателен")
+    tail = [f"Описание: {ev.description or '—'}", f"Награды: {ev.rewards or '—'}"]
     if extras:
-        lines.append(" · ".join(extras))
-    return "\n".join(lines)
+        tail.append(" · ".join(extras))
+    return f"{emj} <b>{ev.title}</b> | {ru_range(ev.d1, ev.d2)} | ", "\n" + "\n".join(tail)
+
+def fmt_event_row(ev, today: dt.date | None = None) -> str:
+    today = today or local_today()
+    if CARD_CACHE["day"] != today:
+        CARD_CACHE["cards"] = {}; CARD_CACHE["day"] = today
+    hit = CARD_CACHE["cards"].get(ev.id)
+    if hit and hit[0] is ev:
+        return hit[1]
+    if ev.parts is None:
+        ev.parts = card_parts(ev)
+    head, tail = ev.parts
+    text = head + status_for(ev.d1, ev.d2, today) + tail
+    CARD_CACHE["cards"][ev.id] = (ev, text)
+    return text
+
+# === Event cache
+# Метаданные событий меняет только админ, а читают их на каждом нажатии. Поэтому все строки
+# events держим в памяти: загружаем целиком, сбрасываем явно из админских путей записи
+# (events_changed) и на всякий случай перечитываем раз в EVENT_CACHE_TTL секунд.
+# Счётчик taken сюда не входит — он меняется на каждой записи и читается из БД.
+EVENT_COLUMNS = ("id", "emoji", "title", "date_start", "date_end", "location", "capacity", "description",
+                 "rewards", "report_required", "report_schedule", "report_unit", "report_photo_required",
+                 "is_active")
+EVENT_CACHE_TTL = 300
+
+class Event:
+    # d1/d2 — даты, разобранные один раз при загрузке; parts — статичная часть карточки
+    __slots__ = EVENT_COLUMNS + ("d1", "d2", "parts")
+
+    def __init__(self, row):
+        for name, value in zip(EVENT_COLUMNS, row):
+            setattr(self, name, value)
+        self.d1 = dt.date.fromisoformat(self.date_start)
+        self.d2 = dt.date.fromisoformat(self.date_end)
+        self.parts = None
+
+    def __repr__(self):
+        return f"Event({self.id}, {self.title!r})"
+
+class EventCache:
+    def __init__(self, ttl: float = EVENT_CACHE_TTL):
+        self.ttl = ttl
+        self.events = {}          # id -> Event
+        self.expires = 0.0
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "loads": 0}
+
+    def load(self):
+        with db() as con:
+            cur=con.cursor()
+            cur.execute(f"SELECT {','.join(EVENT_COLUMNS)} FROM events")
+            events = {row[0]: Event(row) for row in cur.fetchall()}
+        with self.lock:
+            self.events = events
+            self.expires = time.monotonic() + self.ttl
+            self.stats["loads"] += 1
+
+    def _fresh(self):
+        if self.expires <= time.monotonic():
+            self.load()
+        return self.events
+
+    def _read(self, eid: int):
+        with db() as con:
+            cur=con.cursor()
+            cur.execute(f"SELECT {','.join(EVENT_COLUMNS)} FROM events WHERE id=?", (eid,))
+            row=cur.fetchone()
+        with self.lock:
+            if row:
+                self.events[eid] = Event(row)
+            else:
+                self.events.pop(eid, None)
+        return self.events.get(eid)
+
+    def get(self, eid: int):
+        ev = self._fresh().get(eid)
+        if ev is not None:
+            self.stats["hits"] += 1
+            return ev
+        # нет в кэше — вдруг событие добавили мимо бота; читаем точечно
+        self.stats["misses"] += 1
+        return self._read(eid)
+
+    def active(self, today: str):
+        events = self._fresh()
+        self.stats["hits"] += 1
+        return sorted((ev for ev in events.values() if ev.is_active and ev.date_end >= today),
+                      key=lambda ev: (ev.date_start, ev.id))
+
+    def invalidate(self, eid: int | None = None):
+        # None — перечитать всё при следующем обращении; иначе сразу перечитать одно событие
+        if eid is None:
+            with self.lock:
+                self.expires = 0.0
+        else:
+            self._read(eid)
+
+    def stats_text(self) -> str:
+        st = self.stats
+        total = st["hits"] + st["misses"]
+        rate = f"{100 * st['hits'] / total:.1f}%" if total else "—"
+        return (f"Кэш событий: {len(self.events)} шт., попаданий {st['hits']}, промахов {st['misses']} ({rate}), "
+                f"загрузок {st['loads']}")
+
+EVENTS = EventCache()
 
 # === Keyboards ===
 def main_menu_kb(is_admin_flag: bool):
@@ -193,15 +865,32 @@ def main_menu_kb(is_admin_flag: bool):
         kb.add(KeyboardButton("➕ Добавить событие"))
     return kb
 
-def event_keyboard(event_id: int, user_id: int):
+# Горячие запросы обработчиков вынесены в константы: их планы проверяет tests/test_query_plans.py
+EVENT_KEYBOARDS_SQL = """SELECT e.id, e.taken,
+                                EXISTS(SELECT 1 FROM signups s WHERE s.event_id=e.id AND s.tg_user_id=?)
+                         FROM events e
+                         WHERE e.id IN ({marks})"""
+
+def event_keyboards(event_ids, user_id: int) -> dict:
+    # один запрос на всю пачку карточек: из БД — только живые taken и своя запись, остальное из кэша
+    if not event_ids:
+        return {}
+    marks = ",".join("?" * len(event_ids))
     with db() as con:
         cur = con.cursor()
-        cur.execute("SELECT COUNT(*) FROM signups WHERE event_id=?", (event_id,))
-        taken = cur.fetchone()[0]
-        cur.execute("SELECT capacity, report_required FROM events WHERE id=?", (event_id,))
-        cap, rep_req = cur.fetchone()
-        cur.execute("SELECT 1 FROM signups WHERE event_id=? AND tg_user_id=?", (event_id, user_id))
-        already = cur.fetchone() is not None
+        cur.execute(EVENT_KEYBOARDS_SQL.format(marks=marks), (user_id, *event_ids))
+        rows = cur.fetchall()
+    kbs = {}
+    for eid, taken, mine in rows:
+        ev = EVENTS.get(eid)
+        if ev:
+            kbs[eid] = build_event_keyboard(eid, user_id, ev.capacity, ev.report_required, taken, bool(mine))
+    return kbs
+
+def event_keyboard(event_id: int, user_id: int):
+    return event_keyboards([event_id], user_id)[event_id]
+
+def build_event_keyboard(event_id: int, user_id: int, cap, rep_req, taken: int, already: bool):
     kb = InlineKeyboardMarkup()
     if already:
         kb.add(InlineKeyboardButton("❌ Отписаться", callback_data=f"leave:{event_id}"))
@@ -220,22 +909,351 @@ def event_keyboard(event_id: int, user_id: int):
     return kb
 
 # === State ===
-STATE = {}  # user_id -> dict
-def reset_state(uid): STATE.pop(uid, None)
+# Хранилище состояний диалогов: user_id -> dict. Память — LRU с TTL, брошенные мастера
+# вытесняются сами. SQLite-бэкенд держит тот же LRU как кэш и пишет изменения пачками в фоне.
+class MemoryStateStore:
+    cache_misses = True   # память — единственная копия, «состояния нет» тоже точный ответ
+
+    def __init__(self, ttl: int = STATE_TTL, maxsize: int = 200000):
+        self.ttl = ttl; self.maxsize = maxsize
+        self.cache_ttl = ttl
+        self.items = OrderedDict()   # uid -> (expires, state | None)
+        self.gens = OrderedDict()    # uid -> номер последней записи (save/pop), см. keeps_state
+        self.seq = 0
+        self.lock = threading.RLock()
+
+    def _load(self, uid):
+        return None
+
+    def get(self, uid):
+        now = time.time()
+        with self.lock:
+            item = self.items.get(uid)
+            if item is not None and item[0] > now:
+                self.items.move_to_end(uid)
+                return item[1]
+        st = self._load(uid)
+        with self.lock:
+            item = self.items.get(uid)
+            if item is not None and item[0] > now:   # пока читали, save/pop записал свежее — его и отдаём
+                return item[1]
+            if st is not None or self.cache_misses:
+                self._remember(uid, st, now)
+        return st
+
+    def _remember(self, uid, st, now):
+        self.items[uid] = (now + self.cache_ttl, st)
+        self.items.move_to_end(uid)
+        while len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+    def mode(self, uid):
+        st = self.get(uid)
+        return st.get("mode") if st else None
+
+    def _bump(self, uid):
+        self.seq += 1
+        self.gens[uid] = self.seq
+        self.gens.move_to_end(uid)
+        while len(self.gens) > self.maxsize:
+            self.gens.popitem(last=False)
+
+    def generation(self, uid):
+        with self.lock:
+            return self.gens.get(uid)
+
+    def save(self, uid, st):
+        with self.lock:
+            self._remember(uid, st, time.time())
+            self._bump(uid)
+
+    def pop(self, uid):
+        with self.lock:
+            self._remember(uid, None, time.time())
+            self._bump(uid)
+
+    def __len__(self):
+        with self.lock:
+            return sum(1 for _, st in self.items.values() if st is not None)
+
+    def __contains__(self, uid):
+        return self.get(uid) is not None
+
+    def __getitem__(self, uid):
+        return self.get(uid)
+
+    def __setitem__(self, uid, st):
+        self.save(uid, st)
+
+class SqliteStateStore(MemoryStateStore):
+    # Источник правды — conv_state: её же читают другие воркеры. Копия в памяти живёт
+    # cache_ttl секунд, промахи не запоминаются — иначе состояние, начатое в соседнем
+    # процессе, здесь не увидели бы до истечения STATE_TTL.
+    FLUSH_EVERY = 1.0   # секунды
+    FLUSH_BATCH = 500
+    cache_misses = False
+
+    def __init__(self, cache_ttl: float = STATE_CACHE_TTL, **kw):
+        super().__init__(**kw)
+        self.cache_ttl = cache_ttl
+        self.dirty = {}     # uid -> state | None (удалить)
+        self.flushing = {}  # пачка, которая сейчас пишется в БД: до коммита читаем её, а не conv_state
+        self.flush_lock = threading.Lock()   # фоновый flush и flush при выходе не пересекаются
+        self.kick = threading.Event()
+        self.thread = None
+        self.last_sweep = 0.0
+
+    def _load(self, uid):
+        with self.lock:
+            for pending in (self.dirty, self.flushing):
+                if uid in pending:
+                    return pending[uid]
+        with db() as con:
+            cur = con.cursor()
+            cur.execute("SELECT data FROM conv_state WHERE tg_user_id=? AND expires>?", (uid, time.time()))
+            row = cur.fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save(self, uid, st):
+        super().save(uid, st)
+        self._mark(uid, st)
+
+    def pop(self, uid):
+        with self.lock:
+            self.items.pop(uid, None)
+            self._bump(uid)
+        self._mark(uid, None)
+
+    def _mark(self, uid, st):
+        with self.lock:
+            self.dirty[uid] = st
+            size = len(self.dirty)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._flusher, name="state-flush", daemon=True)
+                self.thread.start()
+        if size >= self.FLUSH_BATCH:
+            self.kick.set()
+
+    def _flusher(self):
+        while True:
+            self.kick.wait(self.FLUSH_EVERY)
+            self.kick.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                METRICS.error("state-flush", e)
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                batch, self.dirty = self.dirty, {}
+                self.flushing = batch
+            try:
+                self._write(batch)
+            except Exception:
+                with self.lock:   # не теряем пачку: вернём в dirty, более свежие записи не трогаем
+                    for uid, st in batch.items():
+                        self.dirty.setdefault(uid, st)
+                raise
+            finally:
+                with self.lock:
+                    self.flushing = {}
+
+    def _write(self, batch):
+        now = time.time()
+        upserts = [(uid, json.dumps(st, ensure_ascii=False, separators=(",", ":")), now + self.ttl)
+                   for uid, st in batch.items() if st is not None]
+        deletes = [(uid,) for uid, st in batch.items() if st is None]
+        with db() as con:
+            if upserts:
+                con.executemany("INSERT OR REPLACE INTO conv_state(tg_user_id,data,expires) VALUES(?,?,?)", upserts)
+            if deletes:
+                con.executemany("DELETE FROM conv_state WHERE tg_user_id=?", deletes)
+            if now - self.last_sweep > 3600:
+                con.execute("DELETE FROM conv_state WHERE expires<=?", (now,))
+                self.last_sweep = now
+
+STATE = SqliteStateStore(maxsize=20000) if STATE_BACKEND == "sqlite" else MemoryStateStore()
+
+def reset_state(uid): STATE.pop(uid)
+
+def keeps_state(fn):
+    # шаг мастера получает словарь состояния один раз и меняет его на месте; после шага сохраняем
+    # этот же словарь, если шаг не сбросил (reset_state) и не заменил (STATE[uid] = …) состояние.
+    # Сравниваем номер записи, а не объект: копия в кэше SqliteStateStore может истечь посреди шага
+    @functools.wraps(fn)
+    def wrapper(m):
+        uid = m.from_user.id
+        st = STATE.get(uid)
+        if st is None:
+            return None
+        gen = STATE.generation(uid)
+        try:
+            return fn(m, st)
+        finally:
+            if STATE.generation(uid) == gen:
+                STATE.save(uid, st)
+    return wrapper
+
+# === Albums
+# Альбом приходит отдельными апдейтами с общим media_group_id. Копим их ALBUM_WINDOW секунд после
+# последнего фото и отдаём обработчику одним сообщением — первым в альбоме, с file_id всех фото
+# в m.album. Один шаг мастера и один ответ на альбом вместо ответа на каждое фото.
+# Копим только в режиме отчёта: в остальных (например, /import с пачкой файлов) каждое сообщение — своё.
+ALBUM_WINDOW = 1.0
+ALBUM_MAX = 10   # больше Telegram в один альбом не кладёт
+
+def message_photo_id(m) -> str | None:
+    if m.content_type=="photo" and m.photo:
+        return m.photo[-1].file_id
+    if m.content_type=="document" and (getattr(m.document,"mime_type","") or "").startswith("image/"):
+        return m.document.file_id
+    return None
+
+class AlbumBuffer:
+    def __init__(self, window: float = ALBUM_WINDOW):
+        self.window = window
+        self.pending = {}   # media_group_id -> [срок, первое сообщение, [(message_id, file_id)], deliver]
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.thread = None
+
+    def add(self, m, deliver, collect: bool = True) -> bool:
+        # False — не альбом, уже склеенный альбом или новый альбом при collect=False: обрабатывать как обычно.
+        # collect решает только за новый альбом — остальные сообщения уже начатого идут в него же
+        gid = m.media_group_id
+        if not gid or getattr(m, "album", None) is not None:
+            return False
+        fid = message_photo_id(m)
+        with self.lock:
+            entry = self.pending.get(gid)
+            if entry is None and not collect:
+                return False
+            if entry is None:
+                entry = self.pending[gid] = [0.0, m, [], deliver]
+                METRICS.inc("sportsbot_albums_total")
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self._run, name="albums", daemon=True)
+                    self.thread.start()
+            elif m.message_id < entry[1].message_id:
+                entry[1] = m
+            if fid:
+                entry[2].append((m.message_id, fid))
+            entry[0] = time.monotonic() + self.window
+        METRICS.inc("sportsbot_album_updates_total")
+        self.wake.set()
+        return True
+
+    def take_user(self, uid: int) -> list:
+        # следующее сообщение пользователя не должно обогнать его альбом
+        if not self.pending:
+            return []
+        with self.lock:
+            gids = [gid for gid, e in self.pending.items() if e[1].from_user.id == uid]
+            return [self._finish(self.pending.pop(gid)) for gid in gids]
+
+    @staticmethod
+    def _finish(entry):
+        _, first, items, _ = entry
+        first.album = [fid for _, fid in sorted(items)][:ALBUM_MAX]
+        return first
+
+    def _run(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                ready = [(e[3], self._finish(self.pending.pop(gid)))
+                         for gid, e in list(self.pending.items()) if e[0] <= now]
+                nxt = min((e[0] for e in self.pending.values()), default=None)
+            for deliver, first in ready:
+                try:
+                    deliver(first)
+                except Exception as e:
+                    METRICS.error("album", e)
+            self.wake.wait(None if nxt is None else max(0.0, nxt - time.monotonic()))
+            self.wake.clear()
+
+ALBUMS = AlbumBuffer()
+
+# === Routing
+# Один обработчик telebot на сообщения и один на колбэки: команда, кнопка меню и режим
+# мастера находятся поиском в словаре, callback_data разбирается один раз в (действие, id).
+class Router:
+    def __init__(self):
+        self.commands = {}   # "events" -> handler(m)
+        self.buttons = {}    # текст кнопки меню -> handler(m)
+        self.modes = {}      # STATE["mode"] -> handler(m)
+        self.callbacks = {}  # "join" -> handler(c, event_id, ...), числа из callback_data через «:»
+
+    def _register(self, table, keys):
+        def deco(fn):
+            for k in keys:
+                table[k] = fn
+            return fn
+        return deco
+
+    def command(self, *names): return self._register(self.commands, names)
+    def button(self, *texts): return self._register(self.buttons, texts)
+    def mode(self, *modes): return self._register(self.modes, modes)
+    def callback(self, *actions): return self._register(self.callbacks, actions)
+
+    def resolve_static(self, m):
+        # команды и кнопки меню — без обращения к состоянию пользователя
+        text = m.text or ""
+        if text.startswith("/"):
+            name = text.split(maxsplit=1)[0][1:].split("@", 1)[0].lower()
+            handler = self.commands.get(name)
+            if handler:
+                return handler
+        return self.buttons.get(text)
+
+    def resolve_message(self, m):
+        return self.resolve_static(m) or self.modes.get(STATE.mode(m.from_user.id))
+
+    def resolve_callback(self, c):
+        # (handler, (id, ...)); args=None — битые данные; None — noop и неизвестные
+        action, _, arg = (c.data or "").partition(":")
+        handler = self.callbacks.get(action)
+        if handler is None:
+            return None
+        try:
+            return handler, tuple(int(x) for x in arg.split(":"))
+        except ValueError:
+            return handler, None
+
+    def dispatch_message(self, m):
+        if m.media_group_id and ALBUMS.add(m, self.dispatch_message, STATE.mode(m.from_user.id) == "report"):
+            return
+        for first in ALBUMS.take_user(m.from_user.id):
+            self.dispatch_message(first)
+        handler = self.resolve_message(m)
+        if handler:
+            return instrumented(handler, m)
+
+    def dispatch_callback(self, c):
+        route = self.resolve_callback(c)
+        if route is None:
+            return
+        handler, args = route
+        if args is None:
+            bot.answer_callback_query(c.id,"Ошибка."); return
+        return instrumented(handler, c, *args)
+
+router = Router()
 
 # === Start & menu
-@bot.message_handler(commands=["start","help"])
+@router.command("start","help")
 def start_cmd(m):
     bot.send_message(m.chat.id, WELCOME_TEXT, reply_markup=main_menu_kb(is_admin(m.from_user.id)))
 
-@bot.message_handler(func=lambda m: m.text == "🏅 События")
+@router.button("🏅 События")
 def btn_events(m): list_events(m)
 
-@bot.message_handler(func=lambda m: m.text == "📝 Мои регистрации")
+@router.button("📝 Мои регистрации")
 def btn_my(m): my_signups(m)
 
 # === Create wizard (admin)
-@bot.message_handler(func=lambda m: m.text == "➕ Добавить событие")
+@router.button("➕ Добавить событие")
 def add_wizard_start(m):
     if not is_admin(m.from_user.id):
         bot.reply_to(m, "Эта кнопка только для админов.")
@@ -243,9 +1261,10 @@ def add_wizard_start(m):
     STATE[m.from_user.id] = {"mode": "addevent", "step": 1, "data": {}}
     bot.send_message(m.chat.id, "Шаг 1/11 — введи эмодзи (или «-»):")
 
-@bot.message_handler(func=lambda m: m.from_user.id in STATE and STATE[m.from_user.id].get("mode")=="addevent")
-def add_wizard_flow(m):
-    uid=m.from_user.id; st=STATE[uid]; step=st["step"]; d=st["data"]; txt=(m.text or "").strip()
+@router.mode("addevent")
+@keeps_state
+def add_wizard_flow(m, st):
+    uid=m.from_user.id; step=st["step"]; d=st["data"]; txt=(m.text or "").strip()
     if txt.lower() in {"отмена","/cancel","cancel"}:
         reset_state(uid); bot.reply_to(m,"Ок, отменяю."); return
     try:
@@ -313,53 +1332,216 @@ def add_wizard_flow(m):
                              d.get("report_required",0), d.get("report_schedule","none"),
                              d.get("report_unit",""), d.get("report_photo_required",0)))
                 con.commit()
+            events_changed(cur.lastrowid)
             reset_state(uid)
             bot.reply_to(m,"Событие добавлено ✅ Нажми «🏅 События», чтобы посмотреть.", reply_markup=main_menu_kb(is_admin(uid)))
     except ValueError as e:
         bot.reply_to(m, f"⚠️ {e}")
-    except Exception:
+    except Exception as e:
+        METRICS.error("add_wizard_flow", e)
         bot.reply_to(m, "Что-то пошло не так. Напиши «Отмена» и начни заново.")
 
 # === Lists
-@bot.message_handler(commands=["events"])
-def list_events(m):
+def active_events():
+    return EVENTS.active(today_str())
+
+MY_EVENTS_SQL = "SELECT event_id FROM signups WHERE tg_user_id=?"
+
+def my_events(uid: int):
+    # из БД — только id своих записей (покрывающий индекс), карточки — из кэша
     with db() as con:
         cur=con.cursor()
-        cur.execute("""SELECT id,emoji,title,date_start,date_end,location,capacity,description,rewards,
-                              report_required,report_schedule,report_unit,report_photo_required,is_active
-                       FROM events
-                       WHERE is_active=1 AND date_end>=?
-                       ORDER BY date_start ASC
-                       LIMIT 50""", (today_str(),))
-        rows=cur.fetchall()
+        cur.execute(MY_EVENTS_SQL, (uid,))
+        ids=[r[0] for r in cur.fetchall()]
+    today = today_str()
+    events = [ev for ev in map(EVENTS.get, ids) if ev and ev.date_end >= today]
+    return sorted(events, key=lambda ev: (ev.date_start, ev.id))
+
+def event_row(eid: int):
+    return EVENTS.get(eid)
+
+def events_changed(eid: int | None = None):
+    # любая админская правка событий: сбросить кэши и перевзвести напоминания
+    EVENTS.invalidate(eid)
+    invalidate_pages()
+    REMINDERS.rearm()
+
+# === Paging
+# Списки — одно сообщение-карусель: страница карточек, кнопки открытия карточки и ◀️/▶️.
+# Листание и открытие карточки — edit_message_text того же сообщения.
+# Страницы /events одинаковы для всех, поэтому кэшируются по (страница, сегодня) на PAGE_TTL секунд.
+PAGE_SIZE = 5
+PARTICIPANTS_PAGE = 50
+PAGE_TTL = 60
+PAGE_CACHE = {}   # (page, today) -> (expires, text, kb)
+
+def invalidate_pages():
+    PAGE_CACHE.clear()
+
+def clamp_page(page: int, count: int, size: int):
+    pages = max(1, -(-count // size))
+    return min(max(page, 0), pages - 1), pages
+
+def nav_row(kb, action: str, page: int, pages: int, key: str = ""):
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("◀️", callback_data=f"{action}:{key}{page-1}"))
+    if pages > 1:
+        nav.append(InlineKeyboardButton(f"{page+1}/{pages}", callback_data="noop"))
+    if page < pages - 1:
+        nav.append(InlineKeyboardButton("▶️", callback_data=f"{action}:{key}{page+1}"))
+    if nav:
+        kb.row(*nav)
+    return kb
+
+CARD_IN_LIST_LIMIT = 700   # 5 карточек и заголовок укладываются в TG_TEXT_LIMIT
+HTML_TOKEN = re.compile(r"<[^<>]*>|&#?\w+;|[^<&]+|[<&]")
+HTML_TAG_NAME = re.compile(r"</?([a-zA-Z][\w-]*)")
+
+def html_cut(text: str, limit: int) -> str:
+    # обрезка HTML-текста карточки: не посреди тега (<b>, <a href=…>) и не посреди сущности (&amp;),
+    # незакрытые теги закрываются — иначе Telegram отвергнет всё сообщение «can't parse entities»
+    if len(text) <= limit:
+        return text
+    out, opened, size = [], [], 0
+    limit -= 1   # место под «…»
+    for tok in HTML_TOKEN.findall(text):
+        tag = HTML_TAG_NAME.match(tok) if tok[0] == "<" else None
+        if tag is None and not (tok[0] == "&" and len(tok) > 1):
+            out.append(tok[:limit - size]); size += len(out[-1])   # обычный текст режется где угодно
+            if size >= limit:
+                break
+            continue
+        if size + len(tok) > limit:
+            break
+        out.append(tok); size += len(tok)
+        if tag and tok.startswith("</"):
+            if tag.group(1) in opened:
+                del opened[len(opened) - 1 - opened[::-1].index(tag.group(1))]
+        elif tag and not tok.endswith("/>"):
+            opened.append(tag.group(1))
+    return "".join(out) + "…" + "".join(f"</{name}>" for name in reversed(opened))
+
+def cards_page(rows, page: int, header: str, open_action: str, nav_action: str):
+    page, pages = clamp_page(page, len(rows), PAGE_SIZE)
+    chunk = rows[page*PAGE_SIZE:(page+1)*PAGE_SIZE]
+    today = local_today()
+    cards = []
+    kb = InlineKeyboardMarkup()
+    for i, ev in enumerate(chunk, page*PAGE_SIZE + 1):
+        card = fmt_event_row(ev, today)
+        cards.append(f"{i}. " + html_cut(card, CARD_IN_LIST_LIMIT))
+        kb.add(InlineKeyboardButton(f"{i}. {ev.title[:40]}", callback_data=f"{open_action}:{ev.id}:{page}"))
+    return header + "\n\n" + "\n\n".join(cards), nav_row(kb, nav_action, page, pages)
+
+def events_page(page: int):
+    key = (page, today_str())
+    hit = PAGE_CACHE.get(key)
+    if hit and hit[0] > time.monotonic():
+        return hit[1], hit[2]
+    rows = active_events()
     if not rows:
-        bot.send_message(m.chat.id, "Сейчас нет активных событий.", reply_markup=main_menu_kb(is_admin(m.from_user.id)))
-        return
-    for row in rows:
-        bot.send_message(m.chat.id, fmt_event_row(row), reply_markup=event_keyboard(row[0], m.from_user.id))
-    try:
-        bot.send_message(m.chat.id, "Выбирай действие ниже ⤵️", reply_markup=main_menu_kb(is_admin(m.from_user.id)))
-    except:
-        pass
+        return None, None
+    text, kb = cards_page(rows, page, "🏅 <b>События</b>", "card", "evp")
+    if len(PAGE_CACHE) > 256:
+        PAGE_CACHE.clear()
+    PAGE_CACHE[key] = (time.monotonic() + PAGE_TTL, text, kb)
+    return text, kb
 
-@bot.message_handler(commands=["my"])
-def my_signups(m):
+def my_page(uid: int, page: int):
+    rows = my_events(uid)
+    if not rows:
+        return None, None
+    return cards_page(rows, page, "🧾 <b>Твои регистрации</b>", "mycard", "myp")
+
+def card_view(eid: int, uid: int, back: str):
+    ev = event_row(eid)
+    if not ev:
+        return None, None
+    kb = event_keyboard(eid, uid)
+    kb.add(InlineKeyboardButton("↩️ К списку", callback_data=back))
+    return fmt_event_row(ev), kb
+
+PARTICIPANTS_SQL = "SELECT tg_name,tg_username FROM signups WHERE event_id=? ORDER BY signed_at LIMIT ? OFFSET ?"
+
+def participants_page(eid: int, page: int):
+    # None — нет такого события; (text, None) — список пуст
     with db() as con:
         cur=con.cursor()
-        cur.execute("""SELECT e.id,e.emoji,e.title,e.date_start,e.date_end,e.location,e.capacity,e.description,e.rewards,
-                              e.report_required,e.report_schedule,e.report_unit,e.report_photo_required,e.is_active
-                       FROM signups s JOIN events e ON e.id=s.event_id
-                       WHERE s.tg_user_id=? AND e.date_end>=?
-                       ORDER BY e.date_start ASC""", (m.from_user.id, today_str()))
+        cur.execute("SELECT title, taken FROM events WHERE id=?", (eid,))
+        ev=cur.fetchone()
+        if not ev:
+            return None
+        title, total = ev
+        if not total:
+            return f"На «{title}» пока никто не записан.", None
+        page, pages = clamp_page(page, total, PARTICIPANTS_PAGE)
+        cur.execute(PARTICIPANTS_SQL, (eid, PARTICIPANTS_PAGE, page*PARTICIPANTS_PAGE))
         rows=cur.fetchall()
-    if not rows:
+    lines=[f"{i}. {n} {'@'+u if u else ''}".strip() for i,(n,u) in enumerate(rows, page*PARTICIPANTS_PAGE + 1)]
+    text = f"Участники «{title}»:\n" + "\n".join(lines) + f"\n\nВсего: {total}"
+    kb = InlineKeyboardMarkup()
+    kb.add(InlineKeyboardButton("📄 CSV", callback_data=f"pcsv:{eid}"),
+           InlineKeyboardButton("📊 XLSX", callback_data=f"pxlsx:{eid}"))
+    return text, nav_row(kb, "pp", page, pages, f"{eid}:")
+
+def edit_page(c, text: str, kb):
+    try:
+        bot.edit_message_text(text, chat_id=c.message.chat.id, message_id=c.message.message_id, reply_markup=kb)
+    except ApiTelegramException as e:
+        if "message is not modified" not in e.description:
+            raise
+
+@router.command("events")
+def list_events(m):
+    text, kb = events_page(0)
+    if text is None:
+        bot.send_message(m.chat.id, "Сейчас нет активных событий.", reply_markup=main_menu_kb(is_admin(m.from_user.id)))
+        return
+    bot.send_message(m.chat.id, text, reply_markup=kb)
+
+@router.command("my")
+def my_signups(m):
+    text, kb = my_page(m.from_user.id, 0)
+    if text is None:
         bot.send_message(m.chat.id, "У тебя пока нет активных регистраций.", reply_markup=main_menu_kb(is_admin(m.from_user.id)))
         return
-    for row in rows:
-        bot.send_message(m.chat.id, "🧾 Твоя регистрация\n"+fmt_event_row(row), reply_markup=event_keyboard(row[0], m.from_user.id))
+    bot.send_message(m.chat.id, text, reply_markup=kb)
+
+@router.callback("evp")
+def cb_events_page(c, page: int):
+    text, kb = events_page(page)
+    bot.answer_callback_query(c.id)
+    if text is None:
+        edit_page(c, "Сейчас нет активных событий.", None); return
+    edit_page(c, text, kb)
+
+@router.callback("myp")
+def cb_my_page(c, page: int):
+    text, kb = my_page(c.from_user.id, page)
+    bot.answer_callback_query(c.id)
+    if text is None:
+        edit_page(c, "У тебя пока нет активных регистраций.", None); return
+    edit_page(c, text, kb)
+
+@router.callback("card")
+def cb_card(c, eid: int, page: int = 0):
+    text, kb = card_view(eid, c.from_user.id, f"evp:{page}")
+    if text is None:
+        bot.answer_callback_query(c.id,"Событие не найдено."); return
+    bot.answer_callback_query(c.id)
+    edit_page(c, text, kb)
+
+@router.callback("mycard")
+def cb_my_card(c, eid: int, page: int = 0):
+    text, kb = card_view(eid, c.from_user.id, f"myp:{page}")
+    if text is None:
+        bot.answer_callback_query(c.id,"Событие не найдено."); return
+    bot.answer_callback_query(c.id)
+    edit_page(c, "🧾 Твоя регистрация\n" + text, kb)
 
 # === One-line add (без отчётных настроек — удобнее мастером)
-@bot.message_handler(commands=["addevent"])
+@router.command("addevent")
 def add_event_one_line(m):
     if not is_admin(m.from_user.id):
         bot.reply_to(m,"Команда только для админов.")
@@ -396,10 +1578,32 @@ def add_event_one_line(m):
         cur.execute("""INSERT INTO events(emoji,title,date_start,date_end,location,capacity,description,rewards,is_active)
                        VALUES(?,?,?,?,?,?,?,?,1)""", (emoji,title,ds,de,loc,cap,desc,rew))
         con.commit()
+    events_changed(cur.lastrowid)
     bot.reply_to(m,"Готово, добавила событие ✅")
 
+@router.command("toggle")
+def toggle_event(m):
+    if not is_admin(m.from_user.id):
+        bot.reply_to(m,"Команда только для админов."); return
+    try:
+        _, eid = m.text.split(" ",1); eid=int(eid.strip())
+    except:
+        bot.reply_to(m,"Укажи ID: /toggle 2"); return
+    # отвечаем после with: UPDATE открыл транзакцию, и держать лок записи на время запроса к Telegram нельзя
+    with db() as con:
+        cur=con.cursor()
+        cur.execute("UPDATE events SET is_active=1-COALESCE(is_active,1) WHERE id=?", (eid,))
+        found = cur.rowcount > 0
+        if found:
+            cur.execute("SELECT is_active FROM events WHERE id=?", (eid,))
+            active=cur.fetchone()[0]
+    if not found:
+        bot.reply_to(m,"Не нашла событие."); return
+    events_changed(eid)
+    bot.reply_to(m, f"Событие #{eid} {'включено ✅' if active else 'выключено ⏸'}")
+
 # === Participants (admin)
-@bot.message_handler(commands=["participants"])
+@router.command("participants")
 def participants(m):
     if not is_admin(m.from_user.id):
         bot.reply_to(m,"Только для админов."); return
@@ -407,69 +1611,110 @@ def participants(m):
         _, eid = m.text.split(" ",1); eid=int(eid.strip())
     except:
         bot.reply_to(m,"Укажи ID: /participants 2"); return
+    page = participants_page(eid, 0)
+    if page is None:
+        bot.reply_to(m,"Не нашла событие."); return
+    text, kb = page
+    bot.reply_to(m, text, reply_markup=kb)
+
+@router.command("dbstats")
+def db_stats_cmd(m):
+    if not is_admin(m.from_user.id):
+        bot.reply_to(m,"Только для админов."); return
+    bot.reply_to(m, f"Соединений открыто: {DB_STATS['opened']}\nПереиспользовано: {DB_STATS['reused']}\n"
+                    + EVENTS.stats_text())
+
+def check_taken(fix: bool = False):
+    # сверка счётчика мест с фактическим числом записей; fix=True пересчитывает расхождения
     with db() as con:
         cur=con.cursor()
-        cur.execute("SELECT title FROM events WHERE id=?", (eid,))
-        ev=cur.fetchone()
-        if not ev:
-            bot.reply_to(m,"Не нашла событие."); return
-        title=ev[0]
-        cur.execute("SELECT tg_name,tg_username FROM signups WHERE event_id=? ORDER BY signed_at ASC",(eid,))
-        rows=cur.fetchall()
-    if not rows:
-        bot.reply_to(m,f"На «{title}» пока никто не записан."); return
-    lines=[f"{i}. {name} {'@'+username if username else ''}".strip() for i,(name,username) in enumerate(rows,1)]
-    bot.reply_to(m, f"Участники «{title}»:\n" + "\n".join(lines) + f"\n\nВсего: {len(rows)}")
+        cur.execute("""SELECT e.id, e.taken, (SELECT COUNT(*) FROM signups s WHERE s.event_id=e.id) AS real
+                       FROM events e WHERE e.taken != real""")
+        bad=cur.fetchall()
+        if fix and bad:
+            cur.executemany("UPDATE events SET taken=? WHERE id=?", [(real, eid) for eid, _, real in bad])
+            con.commit()
+    return bad
+
+def check_stats(eid: int | None = None, fix: bool = False):
+    # сверка сводок /stats с полным пересчётом по reports/report_photos; fix=True пересобирает
+    # сводки событий с расхождениями. -> отсортированный список id таких событий
+    with db() as con:
+        cur=con.cursor()
+        days, events = stats_recompute(cur, eid)
+        where, args = ("WHERE event_id=?", (eid,)) if eid else ("", ())
+        cur.execute(f"SELECT event_id,date,reporters,total,max_value,photos FROM event_day_stats {where}", args)
+        # строки с нулём отчётов остаются после удалений — их в пересчёте нет, и это не расхождение
+        have = {(e, d): rest for e, d, *rest in cur.fetchall() if rest[0]}
+        cur.execute(f"SELECT event_id,reporters FROM event_stats {where}", args)
+        have_events = {e: n for e, n in cur.fetchall() if n}
+        same = lambda a, b: a == b or (a is not None and b is not None and math.isclose(a, b, rel_tol=1e-9, abs_tol=1e-6))
+        bad = {key[0] for key in days.keys() | have.keys()
+               if key not in days or key not in have or not all(map(same, days[key], have[key]))}
+        bad |= {e for e in events.keys() | have_events.keys() if events.get(e) != have_events.get(e)}
+        if fix and bad:
+            for e in bad:
+                stats_rebuild(cur, e)
+            con.commit()
+    return sorted(bad)
+
+@router.command("recount")
+def recount_cmd(m):
+    if not is_admin(m.from_user.id):
+        bot.reply_to(m,"Только для админов."); return
+    bad=check_taken(fix=True)
+    stats=check_stats(fix=True)
+    if not bad and not stats:
+        bot.reply_to(m,"Счётчики мест и сводки в порядке ✅"); return
+    lines=[f"#{eid}: было {taken}, стало {real}" for eid, taken, real in bad]
+    if stats:
+        lines.append("Пересобрала сводки событий: " + ", ".join(f"#{eid}" for eid in stats))
+    bot.reply_to(m,"Пересчитала:\n" + "\n".join(lines))
 
 # === Edit/Delete (admin)
-@bot.callback_query_handler(func=lambda c: c.data.startswith("del:"))
-def cb_delete_confirm(c):
+@router.callback("del")
+def cb_delete_confirm(c, eid: int):
     if not is_admin(c.from_user.id):
         bot.answer_callback_query(c.id,"Только админ."); return
-    _, eid = c.data.split(":"); eid=int(eid)
     kb=InlineKeyboardMarkup()
     kb.add(InlineKeyboardButton("✅ Удалить", callback_data=f"delok:{eid}"),
            InlineKeyboardButton("↩️ Отмена", callback_data="noop"))
     bot.answer_callback_query(c.id,"Подтверди удаление")
     bot.send_message(c.message.chat.id, f"Точно удалить событие #{eid}? Будут удалены записи и отчёты.", reply_markup=kb)
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("delok:"))
-def cb_delete_do(c):
+@router.callback("delok")
+def cb_delete_do(c, eid: int):
     if not is_admin(c.from_user.id):
         bot.answer_callback_query(c.id,"Только админ."); return
-    _, eid = c.data.split(":"); eid=int(eid)
     with db() as con:
         cur=con.cursor()
-        cur.execute("DELETE FROM reports WHERE event_id=?", (eid,))
-        cur.execute("DELETE FROM signups WHERE event_id=?", (eid,))
+        # записи, отчёты, итоги и отметки напоминаний удаляются каскадом
         cur.execute("DELETE FROM events WHERE id=?", (eid,))
         con.commit()
+    invalidate_leaderboard(eid)
+    events_changed(eid)
     bot.answer_callback_query(c.id,"Удалено")
     bot.send_message(c.message.chat.id, f"Событие #{eid} удалено 🗑")
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("edit:"))
-def cb_edit_start(c):
+@router.callback("edit")
+def cb_edit_start(c, eid: int):
     if not is_admin(c.from_user.id):
         bot.answer_callback_query(c.id,"Только админ."); return
-    _, eid = c.data.split(":"); eid=int(eid)
     STATE[c.from_user.id] = {"mode":"edit","event_id":eid,"step":1,"data":{}}
     bot.answer_callback_query(c.id,"Редактирование")
     bot.send_message(c.message.chat.id, "Редактирование: отправь новое <b>название</b> или «-», чтобы оставить прежнее.")
 
-@bot.message_handler(func=lambda m: m.from_user.id in STATE and STATE[m.from_user.id].get("mode")=="edit")
-def edit_flow(m):
-    uid=m.from_user.id; st=STATE[uid]; step=st["step"]; eid=st["event_id"]; txt=(m.text or "").strip()
+@router.mode("edit")
+@keeps_state
+def edit_flow(m, st):
+    uid=m.from_user.id; step=st["step"]; eid=st["event_id"]; txt=(m.text or "").strip()
     if txt.lower() in {"отмена","/cancel","cancel"}:
         reset_state(uid); bot.reply_to(m,"Ок, отменяю."); return
-    with db() as con:
-        cur=con.cursor()
-        cur.execute("""SELECT title,date_start,date_end,location,capacity,description,rewards,
-                              report_required,report_schedule,report_unit,report_photo_required
-                       FROM events WHERE id=?""", (eid,))
-        row=cur.fetchone()
-        if not row:
-            reset_state(uid); bot.reply_to(m,"Не нашла событие."); return
-        title, ds, de, loc, cap, desc, rew, rep_req, rep_sched, rep_unit, rep_photo = row
+    ev=EVENTS.get(eid)
+    if not ev:
+        reset_state(uid); bot.reply_to(m,"Не нашла событие."); return
+    title, ds, de, loc, cap, desc, rew = ev.title, ev.date_start, ev.date_end, ev.location, ev.capacity, ev.description, ev.rewards
+    rep_req, rep_sched, rep_unit, rep_photo = ev.report_required, ev.report_schedule, ev.report_unit, ev.report_photo_required
     try:
         if step==1:
             st["data"]["title"] = title if txt in {"-","—",""} else txt
@@ -541,34 +1786,50 @@ def edit_flow(m):
                              vals.get("report_schedule",rep_sched), vals.get("report_unit",rep_unit),
                              vals.get("report_photo_required",rep_photo), eid))
                 con.commit()
+            events_changed(eid)
             reset_state(uid); bot.reply_to(m,"Сохранила ✅")
     except ValueError as e:
         bot.reply_to(m, f"⚠️ {e}")
-    except Exception:
+    except Exception as e:
+        METRICS.error("edit_flow", e)
         bot.reply_to(m,"Что-то пошло не так, попробуй ещё раз.")
 
-# === Reports (ОДНО фото)
-def upsert_report(event_id: int, user, date_str: str, value, text, photo_id: str | None):
-    with db() as con:
+# === Reports (фото-пруф, альбом склеивает AlbumBuffer)
+REPORT_LOOKUP_SQL = "SELECT value FROM reports WHERE event_id=? AND tg_user_id=? AND date=?"
+
+def upsert_report(event_id: int, user, date_str: str, value, text, photo_ids=()):
+    key=(event_id, user.id, date_str)
+    con=db()
+    with con:
         cur=con.cursor()
-        cur.execute("INSERT OR REPLACE INTO reports(event_id,tg_user_id,date,value,text,photos,created_at) VALUES(?,?,?,?,?,?,?)",
-                    (event_id, user.id, date_str, value, text, photo_id or "", dt.datetime.utcnow().isoformat()))
-        con.commit()
+        cur.execute("BEGIN IMMEDIATE")
+        # отчёт за тот же день перезаписывается — в рейтинг идёт только разница
+        cur.execute(REPORT_LOOKUP_SQL, key)
+        old=cur.fetchone()
+        # upsert, а не INSERT OR REPLACE: REPLACE удаляет строку мимо триггеров сводок (миграция 9)
+        cur.execute("""INSERT INTO reports(event_id,tg_user_id,date,value,text,photos,created_at) VALUES(?,?,?,?,?,?,?)
+                       ON CONFLICT(event_id,tg_user_id,date) DO UPDATE SET value=excluded.value, text=excluded.text,
+                                                                           photos=excluded.photos, created_at=excluded.created_at""",
+                    (*key, value, text, photo_ids[0] if photo_ids else "", dt.datetime.utcnow().isoformat()))
+        cur.execute("DELETE FROM report_photos WHERE event_id=? AND tg_user_id=? AND date=?", key)
+        if photo_ids:
+            cur.executemany("INSERT INTO report_photos(event_id,tg_user_id,date,pos,file_id) VALUES(?,?,?,?,?)",
+                            [(*key, pos, fid) for pos, fid in enumerate(photo_ids)])
+        delta=(value or 0) - ((old[0] or 0) if old else 0)
+        cur.execute("""INSERT INTO standings(event_id,tg_user_id,total) VALUES(?,?,?)
+                       ON CONFLICT(event_id,tg_user_id) DO UPDATE SET total=total+excluded.total""",
+                    (event_id, user.id, delta))
+    invalidate_leaderboard(event_id)
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("report:"))
-def cb_report_start(c):
+@router.callback("report")
+def cb_report_start(c, eid: int):
     user=c.from_user
-    try:
-        _, eid = c.data.split(":"); eid=int(eid)
-    except:
-        bot.answer_callback_query(c.id,"Ошибка."); return
+    ev=EVENTS.get(eid)
+    if not ev:
+        bot.answer_callback_query(c.id,"Событие не найдено."); return
+    sched, photo_req, de = ev.report_schedule, ev.report_photo_required, ev.date_end
     with db() as con:
         cur=con.cursor()
-        cur.execute("SELECT report_required,report_schedule,report_unit,report_photo_required,date_start,date_end FROM events WHERE id=?", (eid,))
-        row=cur.fetchone()
-        if not row:
-            bot.answer_callback_query(c.id,"Событие не найдено."); return
-        req,sched,unit,photo_req,ds,de = row
         cur.execute("SELECT 1 FROM signups WHERE event_id=? AND tg_user_id=?", (eid,user.id))
         if not cur.fetchone():
             bot.answer_callback_query(c.id,"Сначала запишись на событие."); return
@@ -578,39 +1839,33 @@ def cb_report_start(c):
     STATE[user.id] = {"mode":"report","event_id":eid,"step":1,"photo_req":photo_req}
     bot.answer_callback_query(c.id,"Ок!")
     if photo_req:
-        bot.send_message(c.message.chat.id,"Пришли одно фото-пруф (обязательно).")
+        bot.send_message(c.message.chat.id,"Пришли фото-пруф (обязательно, можно альбомом).")
     else:
-        bot.send_message(c.message.chat.id,"Пришли одно фото-пруф или напиши «-», если без фото.")
+        bot.send_message(c.message.chat.id,"Пришли фото-пруф (можно альбомом) или напиши «-», если без фото.")
 
-@bot.message_handler(
-    func=lambda m: m.from_user.id in STATE and STATE[m.from_user.id].get("mode")=="report",
-    content_types=['text','photo','document']
-)
-def report_flow(m):
-    st=STATE[m.from_user.id]; step=st["step"]; eid=st["event_id"]; txt=(m.text or "").strip()
+@router.mode("report")
+@keeps_state
+def report_flow(m, st):
+    step=st["step"]; eid=st["event_id"]; txt=(m.text or "").strip()
     if txt.lower() in {"отмена","/cancel","cancel"}:
         reset_state(m.from_user.id); bot.reply_to(m,"Ок, отменяю отчёт."); return
 
     if step==1:
-        photo_id=None
-        if m.content_type=="photo" and m.photo:
-            photo_id=m.photo[-1].file_id
-        elif m.content_type=="document" and getattr(m.document,"mime_type","").startswith("image/"):
-            photo_id=m.document.file_id
-
-        if st.get("photo_req") and not photo_id:
-            bot.reply_to(m,"Нужно одно фото-пруф. Пришли фото.")
+        photo_id=message_photo_id(m)
+        photo_ids=getattr(m,"album",None) or ([photo_id] if photo_id else [])  # альбом склеен в AlbumBuffer
+
+        if st.get("photo_req") and not photo_ids:
+            bot.reply_to(m,"Нужно фото-пруф. Пришли фото.")
             return
-        if not photo_id and txt not in {"-","—"}:
+        if not photo_ids and txt not in {"-","—"}:
             bot.reply_to(m,"Пришли фото или «-».")
             return
 
-        st["photo_id"]=photo_id
+        st["photo_ids"]=photo_ids
         st["step"]=2
-        with db() as con:
-            cur=con.cursor(); cur.execute("SELECT report_unit FROM events WHERE id=?", (eid,))
-            unit=(cur.fetchone() or [""])[0] or ""
-        bot.reply_to(m, f"Введи числовой результат{(' ('+unit+')') if unit else ''}. Пример: 12345")
+        ev=EVENTS.get(eid); unit=(ev.report_unit if ev else "") or ""
+        got=f"Сохранила {len(photo_ids)} фото. " if len(photo_ids)>1 else ""
+        bot.reply_to(m, f"{got}Введи числовой результат{(' ('+unit+')') if unit else ''}. Пример: 12345")
         return
 
     if step==2:
@@ -626,7 +1881,9 @@ def report_flow(m):
 
     if step==3:
         comment = "" if txt in {"-","—"} else txt
-        upsert_report(eid, m.from_user, today_str(), st.get("value"), comment, st.get("photo_id"))
+        # photo_id — состояние, сохранённое до альбомов
+        photos = st.get("photo_ids") or ([st["photo_id"]] if st.get("photo_id") else [])
+        upsert_report(eid, m.from_user, today_str(), st.get("value"), comment, photos)
         reset_state(m.from_user.id)
         bot.reply_to(m,"Отчёт сохранён ✅")
         return
@@ -635,15 +1892,38 @@ def report_flow(m):
     bot.reply_to(m,"Давай начнём заново: нажми «📥 Отчёт» под событием.")
 
 # === Leaderboard
+# Готовый текст рейтинга на событие; сбрасывается только когда меняются итоги или состав участников.
+LB_CACHE = {}   # event_id -> text
+_lb_gen = {}    # event_id -> номер поколения, чтобы не положить в кэш текст, посчитанный до сброса
+_lb_lock = threading.Lock()
+
+def invalidate_leaderboard(eid: int):
+    with _lb_lock:
+        _lb_gen[eid] = _lb_gen.get(eid, 0) + 1
+        LB_CACHE.pop(eid, None)
+
 def leaderboard_text(eid: int) -> str:
+    text = LB_CACHE.get(eid)
+    if text is not None:
+        return text
+    gen = _lb_gen.get(eid, 0)
+    text = _render_leaderboard(eid)
+    with _lb_lock:
+        if _lb_gen.get(eid, 0) == gen:
+            LB_CACHE[eid] = text
+    return text
+
+LEADERBOARD_SQL = """SELECT s.tg_name,s.tg_username,st.total
+                     FROM standings st
+                     JOIN signups s ON s.event_id=st.event_id AND s.tg_user_id=st.tg_user_id
+                     WHERE st.event_id=?
+                     ORDER BY st.total DESC
+                     LIMIT 20"""
+
+def _render_leaderboard(eid: int) -> str:
     with db() as con:
         cur=con.cursor()
-        cur.execute("""SELECT s.tg_name,s.tg_username,SUM(r.value)
-                       FROM reports r
-                       JOIN signups s ON s.event_id=r.event_id AND s.tg_user_id=r.tg_user_id
-                       WHERE r.event_id=?
-                       GROUP BY r.tg_user_id
-                       ORDER BY SUM(r.value) DESC""", (eid,))
+        cur.execute(LEADERBOARD_SQL, (eid,))
         rows=cur.fetchall()
     if not rows:
         return "Пока нет данных для рейтинга."
@@ -653,140 +1933,1175 @@ def leaderboard_text(eid: int) -> str:
         if total is None: total = 0
         total_str = f"{int(total) if abs(total-int(total))<1e-9 else round(total,2)}"
         lines.append(f"{i}. {name}{uname} — {total_str}")
-    return "🏆 Рейтинг\n" + "\n".join(lines[:20])
+    return "🏆 Рейтинг\n" + "\n".join(lines)
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("lb:"))
-def cb_leaderboard(c):
-    try:
-        _, eid = c.data.split(":"); eid=int(eid)
-    except:
-        bot.answer_callback_query(c.id,"Ошибка.")
-        return
+@router.callback("lb")
+def cb_leaderboard(c, eid: int):
     bot.answer_callback_query(c.id,"Показываю рейтинг")
     bot.send_message(c.message.chat.id, leaderboard_text(eid))
 
+# === Stats (admin)
+# Только сводные таблицы (миграция 9): ответ не зависит от числа отчётов, только от числа дней.
+STATS_DAYS_SHOWN = 31
+
+def stats_text(eid: int) -> str | None:
+    ev=EVENTS.get(eid)
+    if not ev:
+        return None
+    with db() as con:
+        cur=con.cursor()
+        cur.execute("SELECT taken FROM events WHERE id=?", (eid,))
+        signups=cur.fetchone()[0]
+        cur.execute("SELECT reporters FROM event_stats WHERE event_id=?", (eid,))
+        row=cur.fetchone(); reporters=row[0] if row else 0
+        cur.execute("""SELECT date,reporters,total,max_value,photos FROM event_day_stats
+                       WHERE event_id=? AND reporters>0 ORDER BY date DESC LIMIT ?""", (eid, STATS_DAYS_SHOWN))
+        days=cur.fetchall()[::-1]
+    pct = lambda n: f" ({n*100//signups}%)" if signups else ""
+    unit = f" {ev.report_unit}" if ev.report_unit else ""
+    lines=[f"📊 <b>{ev.title}</b>", f"Записано: {signups}", f"Отчитывались: {reporters}{pct(reporters)}"]
+    if not days:
+        lines.append("Отчётов пока нет.")
+        return "\n".join(lines)
+    lines.append(f"\nПо дням (отчётов · сумма · среднее · максимум{unit} · фото):")
+    for day, n, total, best, photos in days:
+        d=dt.date.fromisoformat(day)
+        lines.append(f"{d:%d.%m}: {n}{pct(n)} · {total:g} · {total/n:.4g} · {(best or 0):g} · {photos}")
+    return "\n".join(lines)
+
+@router.command("stats")
+def stats_cmd(m):
+    if not is_admin(m.from_user.id):
+        bot.reply_to(m,"Только для админов."); return
+    try:
+        _, eid = m.text.split(" ",1); eid=int(eid.strip())
+    except:
+        bot.reply_to(m,"Укажи ID: /stats 2"); return
+    text=stats_text(eid)
+    bot.reply_to(m, text or "Не нашла событие.")
+
 # === Participants list (admin)
-@bot.callback_query_handler(func=lambda c: c.data.startswith("plist:"))
-def cb_participants(c):
+@router.callback("plist")
+def cb_participants(c, eid: int):
+    if not is_admin(c.from_user.id):
+        bot.answer_callback_query(c.id,"Только админ."); return
+    page = participants_page(eid, 0)
+    if page is None:
+        bot.answer_callback_query(c.id,"Не нашла событие."); return
+    text, kb = page
+    bot.send_message(c.message.chat.id, text, reply_markup=kb)
+    bot.answer_callback_query(c.id,"Готово ✅" if kb is not None else "Пусто.")
+
+@router.callback("pp")
+def cb_participants_page(c, eid: int, page: int):
     if not is_admin(c.from_user.id):
         bot.answer_callback_query(c.id,"Только админ."); return
+    result = participants_page(eid, page)
+    if result is None:
+        bot.answer_callback_query(c.id,"Не нашла событие."); return
+    bot.answer_callback_query(c.id)
+    edit_page(c, *result)
+
+# === Export (admin)
+# Выгрузка участников идёт потоком: курсор SQLite отдаёт строки по одной, текст режется на
+# сообщения по лимиту Telegram, CSV/XLSX пишутся построчно во временный файл и уходят документом.
+TG_TEXT_LIMIT = 4096
+EXPORT_TEXT_CHUNKS = 10   # длиннее — только файлом
+EXPORT_HEADER = ("№", "tg_user_id", "Имя", "Username", "Записан (UTC)", "Отчётов", "Итог")
+
+def iter_participants(eid: int):
+    with db() as con:
+        cur=con.cursor()
+        cur.execute("""SELECT s.tg_user_id, s.tg_name, s.tg_username, s.signed_at,
+                              (SELECT COUNT(*) FROM reports r WHERE r.event_id=s.event_id AND r.tg_user_id=s.tg_user_id),
+                              COALESCE(st.total, 0)
+                       FROM signups s
+                       LEFT JOIN standings st ON st.event_id=s.event_id AND st.tg_user_id=s.tg_user_id
+                       WHERE s.event_id=?
+                       ORDER BY s.signed_at""", (eid,))
+        for i, row in enumerate(cur, 1):
+            yield (i, *row)
+
+def tg_len(text: str) -> int:
+    # Telegram считает длину в UTF-16: эмодзи в имени — два символа
+    return len(text.encode("utf-16-le")) // 2
+
+def text_chunks(lines, limit: int = TG_TEXT_LIMIT):
+    buf, size = [], 0
+    for line in lines:
+        n = tg_len(line) + 1
+        if buf and size + n > limit:
+            yield "\n".join(buf); buf, size = [], 0
+        buf.append(line); size += n
+    if buf:
+        yield "\n".join(buf)
+
+def participant_line(row) -> str:
+    i, _, name, uname, _, reports, total = row
+    line = f"{i}. {name or '—'} {'@'+uname if uname else ''}".strip()
+    return line + (f" — отчётов {reports}, итог {total:g}" if reports else "")
+
+def export_text(eid: int, title: str):
+    # None — не влезло в EXPORT_TEXT_CHUNKS сообщений
+    lines = (html.escape(participant_line(row)) for row in iter_participants(eid))
+    chunks = []
+    for chunk in text_chunks(lines, TG_TEXT_LIMIT - tg_len(title) - 32):
+        if len(chunks) == EXPORT_TEXT_CHUNKS:
+            return None
+        chunks.append(chunk)
+    n = len(chunks)
+    return [f"Участники «{html.escape(title)}» ({i}/{n}):\n{chunk}" for i, chunk in enumerate(chunks, 1)]
+
+def csv_file(header, rows):
+    f = tempfile.TemporaryFile()
+    w = io.TextIOWrapper(f, encoding="utf-8-sig", newline="")
+    writer = csv.writer(w, delimiter=";")   # «;» — так файл сразу открывается в русском Excel
+    writer.writerow(header)
+    writer.writerows(rows)
+    w.flush(); w.detach(); f.seek(0)
+    return f
+
+def export_csv(eid: int):
+    return csv_file(EXPORT_HEADER, iter_participants(eid))
+
+def export_xlsx(eid: int):
+    from openpyxl import Workbook  # опционально: pip install openpyxl
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Участники")
+    ws.append(EXPORT_HEADER)
+    for row in iter_participants(eid):
+        ws.append(row)
+    f = tempfile.TemporaryFile()
+    wb.save(f); f.seek(0)
+    return f
+
+EXPORTERS = {"csv": export_csv, "xlsx": export_xlsx}
+
+def send_chunks(chat_id, chunks):
+    # через OUTBOX, но строго по порядку: следующий кусок уходит, когда доставлен предыдущий
+    if not chunks:
+        return
+    def next_chunk(fut):
+        if fut.exception() is None:
+            send_chunks(chat_id, chunks[1:])
+    OUTBOX.submit(chat_id, chunks[0]).add_done_callback(next_chunk)
+
+def send_export(chat_id, eid: int, fmt: str) -> str:
+    # возвращает короткий ответ для админа
+    ev = EVENTS.get(eid)
+    if not ev:
+        return "Не нашла событие."
+    if fmt == "text":
+        chunks = export_text(eid, ev.title)
+        if chunks is not None:
+            if not chunks:
+                return "Пока никто не записан."
+            send_chunks(chat_id, chunks)
+            return "Отправляю списком ✅"
+        fmt, done = "csv", "Список длинный — отправила файлом ✅"
+    else:
+        done = "Готово ✅"
+    try:
+        f = EXPORTERS[fmt](eid)
+    except ImportError:
+        return "Для XLSX нужен openpyxl (pip install openpyxl). CSV доступен всегда."
+    with f:
+        bot.send_document(chat_id, f, visible_file_name=f"participants_{eid}.{fmt}",
+                          caption=f"Участники «{html.escape(ev.title)}»")
+    return done
+
+@router.command("export")
+def export_cmd(m):
+    if not is_admin(m.from_user.id):
+        bot.reply_to(m,"Только для админов."); return
     try:
-        _, eid=c.data.split(":"); eid=int(eid)
+        parts = m.text.split()
+        eid = int(parts[1]); fmt = parts[2].lower() if len(parts) > 2 else "csv"
+        if fmt not in {"text", *EXPORTERS}: raise ValueError
     except:
-        bot.answer_callback_query(c.id,"Некорректно."); return
+        bot.reply_to(m,"Формат: /export <id> [csv|xlsx|text]"); return
+    bot.reply_to(m, send_export(m.chat.id, eid, fmt))
+
+@router.callback("pcsv")
+def cb_export_csv(c, eid: int):
+    if not is_admin(c.from_user.id):
+        bot.answer_callback_query(c.id,"Только админ."); return
+    bot.answer_callback_query(c.id, send_export(c.message.chat.id, eid, "csv"))
+
+@router.callback("pxlsx")
+def cb_export_xlsx(c, eid: int):
+    if not is_admin(c.from_user.id):
+        bot.answer_callback_query(c.id,"Только админ."); return
+    bot.answer_callback_query(c.id, send_export(c.message.chat.id, eid, "xlsx"))
+
+# === Reports import/export (admin)
+# Результаты, собранные вне бота (шагомер, трекер), загружаются файлом CSV/JSON со строками
+# (user, date, value, comment). Строки проверяются по записям и датам события и пишутся одной
+# транзакцией через executemany; standings события после этого пересобираются агрегатом.
+# /reports <id> выгружает отчёты в том же формате — файл можно поправить и загрузить обратно.
+REPORTS_HEADER = ("user", "date", "value", "comment", "username", "name")
+IMPORT_COLUMNS = {"user": "user", "tg_user_id": "user", "username": "username", "date": "date",
+                  "value": "value", "comment": "comment", "text": "comment"}
+IMPORT_ERRORS_SHOWN = 20
+
+def iter_reports(eid: int):
     with db() as con:
         cur=con.cursor()
-        cur.execute("SELECT title FROM events WHERE id=?", (eid,))
-        ev=cur.fetchone()
-        if not ev:
-            bot.answer_callback_query(c.id,"Не нашла событие."); return
-        title=ev[0]
-        cur.execute("SELECT tg_name,tg_username FROM signups WHERE event_id=? ORDER BY signed_at",(eid,))
-        rows=cur.fetchall()
-    if not rows:
-        bot.send_message(c.message.chat.id, f"На «{title}» пока никто не записан.")
-        bot.answer_callback_query(c.id,"Пусто.")
+        cur.execute("""SELECT r.tg_user_id, r.date, r.value, r.text, s.tg_username, s.tg_name
+                       FROM reports r
+                       LEFT JOIN signups s ON s.event_id=r.event_id AND s.tg_user_id=r.tg_user_id
+                       WHERE r.event_id=?
+                       ORDER BY r.tg_user_id, r.date""", (eid,))
+        yield from cur
+
+def import_rows(data: bytes, filename: str):
+    # -> итератор (номер строки, dict) с ключами user/username/date/value/comment
+    text = data.decode("utf-8-sig")
+    if filename.lower().endswith(".json") or text.lstrip()[:1] in "[{":
+        items = json.loads(text)
+        if isinstance(items, dict):
+            items = items.get("reports", [])
+        if not isinstance(items, list):
+            raise ValueError("В JSON нужен список отчётов или объект с полем reports — списком.")
+        for n, item in enumerate(items, 1):
+            if isinstance(item, list):
+                item = dict(zip(REPORTS_HEADER, item))
+            if not isinstance(item, dict):
+                item = {}
+            yield n, {IMPORT_COLUMNS[k]: v for k, v in item.items() if k in IMPORT_COLUMNS}
         return
-    lines=[f"{i}. {n} {'@'+u if u else ''}".strip() for i,(n,u) in enumerate(rows,1)]
-    bot.send_message(c.message.chat.id, f"Участники «{title}»:\n" + "\n".join(lines) + f"\n\nВсего: {len(rows)}")
-    bot.answer_callback_query(c.id,"Готово ✅")
+    first = text.split("\n", 1)[0]
+    reader = csv.reader(io.StringIO(text), delimiter=";" if first.count(";") >= first.count(",") else ",")
+    header = [IMPORT_COLUMNS.get(h.strip().lower()) for h in next(reader, [])]
+    if "date" not in header or "value" not in header:
+        raise ValueError("В первой строке нужны колонки user, date, value (и, если есть, comment).")
+    for n, cells in enumerate(reader, 2):
+        if any(c.strip() for c in cells):
+            yield n, {k: v for k, v in zip(header, cells) if k}
 
-# === Join/Leave
-@bot.callback_query_handler(func=lambda c: c.data.startswith(("join:","leave:")))
-def cb_join_leave(c):
-    user=c.from_user; cmd,eid=c.data.split(":"); eid=int(eid)
+def validate_reports(eid: int, rows):
+    # -> (строки для executemany, список ошибок)
+    ev = EVENTS.get(eid)
     with db() as con:
         cur=con.cursor()
-        cur.execute("SELECT capacity,date_end,is_active FROM events WHERE id=?", (eid,))
-        row=cur.fetchone()
-        if not row:
-            bot.answer_callback_query(c.id,"Событие не найдено."); return
-        cap,de,active=row
-        if not active:
-            bot.answer_callback_query(c.id,"Событие выключено."); return
-        if de < today_str():
-            bot.answer_callback_query(c.id,"Событие уже завершено."); return
-        if cmd=="join":
-            if cap is not None:
-                cur.execute("SELECT COUNT(*) FROM signups WHERE event_id=?", (eid,))
-                taken=cur.fetchone()[0]
-                if taken>=cap:
-                    bot.answer_callback_query(c.id,"Мест нет 😕"); return
-            cur.execute("SELECT 1 FROM signups WHERE event_id=? AND tg_user_id=?", (eid,user.id))
-            if cur.fetchone():
-                bot.answer_callback_query(c.id,"Ты уже записан(а)."); return
-            cur.execute("INSERT INTO signups(event_id,tg_user_id,tg_username,tg_name,signed_at) VALUES(?,?,?,?,?)",
-                        (eid,user.id,user.username or "", f"{user.first_name or ''} {user.last_name or ''}".strip(), dt.datetime.utcnow().isoformat()))
-            con.commit()
-            bot.answer_callback_query(c.id,"Готово! Ты записан(а) ✍️")
-        else:
-            cur.execute("DELETE FROM signups WHERE event_id=? AND tg_user_id=?", (eid,user.id))
-            con.commit()
-            bot.answer_callback_query(c.id,"Ты отписался(ась).")
+        cur.execute("SELECT tg_user_id, tg_username FROM signups WHERE event_id=?", (eid,))
+        signed = dict(cur.fetchall())
+    by_username = {(u or "").lower(): uid for uid, u in signed.items() if u}
+    now = dt.datetime.utcnow().isoformat()
+    good, errors = {}, []
+    for n, row in rows:
+        try:
+            who = str(row.get("user") or row.get("username") or "").strip().lstrip("@")
+            uid = int(who) if who.isdigit() else by_username.get(who.lower())
+            if not who:
+                raise ValueError("не указан user")
+            if uid not in signed:
+                raise ValueError(f"«{who}» не записан(а) на событие")
+            day = parse_date(str(row.get("date") or ""))
+            if not ev.d1 <= day <= ev.d2:
+                raise ValueError(f"дата {day} вне события ({ev.date_start} — {ev.date_end})")
+            raw = str(row.get("value", "")).strip()
+            try:
+                value = float(raw.replace(",", ".").replace(" ", ""))
+            except ValueError:
+                value = math.nan
+            if not math.isfinite(value):
+                raise ValueError(f"значение «{raw}» не число")
+        except ValueError as e:
+            errors.append(f"строка {n}: {e}"); continue
+        except Exception:
+            errors.append(f"строка {n}: не разобрала"); continue
+        # повтор того же дня в файле — побеждает последняя строка, как и при отчёте из бота
+        good[(uid, day)] = (eid, uid, day.strftime("%Y-%m-%d"), value, str(row.get("comment") or ""), now)
+    return list(good.values()), errors
+
+def import_reports(eid: int, rows) -> int:
+    con=db()
+    with con:
+        cur=con.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        # фото-пруф уже присланного отчёта не затираем
+        cur.executemany("""INSERT INTO reports(event_id,tg_user_id,date,value,text,photos,created_at)
+                           VALUES(?,?,?,?,?,'',?)
+                           ON CONFLICT(event_id,tg_user_id,date)
+                           DO UPDATE SET value=excluded.value, text=excluded.text, created_at=excluded.created_at""",
+                        rows)
+        cur.execute("DELETE FROM standings WHERE event_id=?", (eid,))
+        cur.execute("""INSERT INTO standings(event_id,tg_user_id,total)
+                       SELECT event_id, tg_user_id, SUM(COALESCE(value,0)) FROM reports
+                       WHERE event_id=? GROUP BY tg_user_id""", (eid,))
+    invalidate_leaderboard(eid)
+    return len(rows)
+
+@router.command("import")
+def import_cmd(m):
+    if not is_admin(m.from_user.id):
+        bot.reply_to(m,"Только для админов."); return
     try:
-        bot.edit_message_reply_markup(chat_id=c.message.chat.id, message_id=c.message.message_id, reply_markup=event_keyboard(eid,user.id))
+        _, eid = m.text.split(" ",1); eid=int(eid.strip())
     except:
-        pass
+        bot.reply_to(m,"Укажи ID: /import 2"); return
+    if not EVENTS.get(eid):
+        bot.reply_to(m,"Не нашла событие."); return
+    STATE[m.from_user.id] = {"mode":"import","event_id":eid}
+    bot.reply_to(m,"Пришли файл CSV или JSON со столбцами user, date, value, comment "
+                   "(user — Telegram ID или @username). «Отмена» — выйти.")
+
+@router.mode("import")
+def import_flow(m):
+    uid=m.from_user.id; eid=STATE[uid]["event_id"]; txt=(m.text or "").strip()
+    if txt.lower() in {"отмена","/cancel","cancel"}:
+        reset_state(uid); bot.reply_to(m,"Ок, отменяю."); return
+    if m.content_type != "document":
+        bot.reply_to(m,"Жду файл CSV или JSON (или «Отмена»)."); return
+    if not EVENTS.get(eid):
+        reset_state(uid); bot.reply_to(m,"Не нашла событие."); return
+    try:
+        data = bot.download_file(bot.get_file(m.document.file_id).file_path)
+        rows, errors = validate_reports(eid, import_rows(data, m.document.file_name or ""))
+    except (ValueError, UnicodeDecodeError) as e:
+        bot.reply_to(m, f"⚠️ Не смогла прочитать файл: {html.escape(str(e))}"); return
+    except ApiTelegramException:
+        bot.reply_to(m, "⚠️ Не смогла скачать файл (Telegram отдаёт ботам файлы до 20 МБ)."); return
+    reset_state(uid)
+    saved = import_reports(eid, rows) if rows else 0
+    text = f"Загружено отчётов: {saved}" + (f", ошибок: {len(errors)}" if errors else " ✅")
+    if errors:
+        text += "\n" + "\n".join(html.escape(e) for e in errors[:IMPORT_ERRORS_SHOWN])
+        if len(errors) > IMPORT_ERRORS_SHOWN:
+            text += f"\n… и ещё {len(errors) - IMPORT_ERRORS_SHOWN}"
+    bot.reply_to(m, text[:TG_TEXT_LIMIT])
+
+@router.command("reports")
+def reports_export_cmd(m):
+    if not is_admin(m.from_user.id):
+        bot.reply_to(m,"Только для админов."); return
+    try:
+        _, eid = m.text.split(" ",1); eid=int(eid.strip())
+    except:
+        bot.reply_to(m,"Укажи ID: /reports 2"); return
+    ev = EVENTS.get(eid)
+    if not ev:
+        bot.reply_to(m,"Не нашла событие."); return
+    with csv_file(REPORTS_HEADER, iter_reports(eid)) as f:
+        bot.send_document(m.chat.id, f, visible_file_name=f"reports_{eid}.csv",
+                          caption=f"Отчёты «{html.escape(ev.title)}»")
+
+# === Join/Leave
+# Запись — один условный INSERT под BEGIN IMMEDIATE: место проверяется и занимается атомарно,
+# поэтому параллельные нажатия не могут «перепродать» лимит.
+JOIN_ANSWERS = {
+    "joined": "Готово! Ты записан(а) ✍️",
+    "left": "Ты отписался(ась).",
+    "already": "Ты уже записан(а).",
+    "full": "Мест нет 😕",
+    "inactive": "Событие выключено.",
+    "finished": "Событие уже завершено.",
+    "missing": "Событие не найдено.",
+}
+
+def _join_failure(cur, eid: int, uid: int) -> str:
+    cur.execute("""SELECT is_active, date_end, capacity, taken,
+                          EXISTS(SELECT 1 FROM signups WHERE event_id=? AND tg_user_id=?)
+                   FROM events WHERE id=?""", (eid, uid, eid))
+    row=cur.fetchone()
+    if not row: return "missing"
+    active, de, cap, taken, already = row
+    if not active: return "inactive"
+    if de < today_str(): return "finished"
+    if already: return "already"
+    return "full"
+
+def join_event(eid: int, user) -> str:
+    con=db()
+    with con:
+        cur=con.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        cur.execute("""INSERT OR IGNORE INTO signups(event_id,tg_user_id,tg_username,tg_name,signed_at)
+                       SELECT id,?,?,?,? FROM events
+                       WHERE id=? AND is_active=1 AND date_end>=? AND (capacity IS NULL OR taken<capacity)""",
+                    (user.id, user.username or "", f"{user.first_name or ''} {user.last_name or ''}".strip(),
+                     dt.datetime.utcnow().isoformat(), eid, today_str()))
+        if cur.rowcount == 1:
+            return "joined"
+        return _join_failure(cur, eid, user.id)
+
+def leave_event(eid: int, uid: int) -> str:
+    con=db()
+    with con:
+        cur=con.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        cur.execute("""DELETE FROM signups WHERE event_id=? AND tg_user_id=?
+                       AND EXISTS(SELECT 1 FROM events WHERE id=? AND is_active=1 AND date_end>=?)""",
+                    (eid, uid, eid, today_str()))
+        if cur.rowcount == 1:
+            return "left"
+        outcome=_join_failure(cur, eid, uid)
+        return "left" if outcome in {"already","full"} else outcome
+
+@router.callback("join")
+def cb_join(c, eid: int):
+    answer_join_leave(c, eid, join_event(eid, c.from_user))
+
+@router.callback("leave")
+def cb_leave(c, eid: int):
+    answer_join_leave(c, eid, leave_event(eid, c.from_user.id))
+
+def answer_join_leave(c, eid: int, outcome: str):
+    user=c.from_user
+    bot.answer_callback_query(c.id, JOIN_ANSWERS[outcome])
+    if outcome not in {"joined","left"}:
+        return
+    invalidate_leaderboard(eid)  # в рейтинге только записанные участники
+    try:
+        bot.edit_message_reply_markup(chat_id=c.message.chat.id, message_id=c.message.message_id,
+                                      reply_markup=keep_back_button(event_keyboard(eid,user.id), c.message))
+    except ApiTelegramException as e:
+        # запись уже прошла — битая перерисовка кнопок не повод ронять обработчик
+        if "message is not modified" not in e.description:
+            METRICS.error("join-leave-markup", e)
+
+def keep_back_button(kb, message):
+    # карточка, открытая из списка, после записи/отписки сохраняет кнопку «к списку»
+    markup = getattr(message, "reply_markup", None)
+    for row in (markup.keyboard if markup else []):
+        for b in row:
+            if (b.callback_data or "").startswith(("evp:","myp:")):
+                kb.add(b)
+                return kb
+    return kb
+
+# === Outbound: очередь исходящих сообщений (напоминания, рассылки)
+# Лимиты Telegram: ~30 сообщений/с на бота и ~1/с в один чат. Воркеры берут токены из общего
+# и почат-ного ведра, на 429 ждут retry_after, на сетевые/5xx ошибки — повтор с backoff.
+# Future из submit() завершается только после подтверждённой доставки (или с исключением).
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate; self.burst = burst
+        self.tokens = burst; self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self) -> float:
+        # забирает токен (возможно, в долг) и возвращает, сколько секунд подождать перед отправкой
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+class Outbox:
+    def __init__(self, send, workers: int = 8, global_rate: float = 30, chat_rate: float = 1,
+                 retries: int = 5, maxsize: int = 100000):
+        self.send = send; self.workers = workers; self.retries = retries
+        self.chat_rate = chat_rate
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_buckets = {}
+        self.queue = queue.Queue(maxsize)
+        self.stats = {"queued": 0, "sent": 0, "failed": 0, "retried": 0, "rate_limited": 0,
+                      "latency_sum": 0.0, "latency_max": 0.0}
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def submit(self, chat_id, text, **kwargs) -> Future:
+        self._start()
+        fut = Future()
+        self.queue.put((fut, chat_id, text, kwargs, time.monotonic()))
+        self._count("queued")
+        return fut
+
+    def _start(self):
+        if self._threads: return
+        with self._lock:
+            if self._threads: return
+            for i in range(self.workers):
+                t = threading.Thread(target=self._worker, name=f"outbox-{i}", daemon=True)
+                t.start(); self._threads.append(t)
+
+    def _count(self, key, value=1):
+        with self._lock:
+            self.stats[key] += value
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        with self._lock:
+            b = self.chat_buckets.get(chat_id)
+            if b is None:
+                if len(self.chat_buckets) > 50000:
+                    self.chat_buckets.clear()  # старые вёдра давно полные, терять нечего
+                b = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, 1)
+            return b
+
+    def _worker(self):
+        while True:
+            fut, chat_id, text, kwargs, queued_at = self.queue.get()
+            try:
+                result = self._deliver(chat_id, text, kwargs)
+            except Exception as e:
+                self._count("failed")
+                fut.set_exception(e)
+            else:
+                latency = time.monotonic() - queued_at
+                with self._lock:
+                    self.stats["sent"] += 1
+                    self.stats["latency_sum"] += latency
+                    self.stats["latency_max"] = max(self.stats["latency_max"], latency)
+                fut.set_result(result)
+
+    def _deliver(self, chat_id, text, kwargs):
+        attempt = 0
+        while True:
+            time.sleep(self._chat_bucket(chat_id).reserve())
+            time.sleep(self.global_bucket.reserve())
+            try:
+                return self.send(chat_id, text, **kwargs)
+            except ApiTelegramException as e:
+                if e.error_code == 429:
+                    self._count("rate_limited")
+                    wait = (e.result_json.get("parameters") or {}).get("retry_after", 1)
+                elif e.error_code >= 500:
+                    wait = 0.5 * 2 ** attempt
+                else:
+                    raise  # 400/403: чат не найден, бот заблокирован — повтор не поможет
+            except (ApiHTTPException, requests.exceptions.RequestException):
+                wait = 0.5 * 2 ** attempt
+            attempt += 1
+            if attempt > self.retries:
+                raise RuntimeError(f"не доставлено в {chat_id} за {attempt} попыток")
+            self._count("retried")
+            time.sleep(wait + random.random() * 0.1)
+
+    def stats_text(self) -> str:
+        st = dict(self.stats)
+        avg = st["latency_sum"] / st["sent"] if st["sent"] else 0.0
+        return (f"В очереди: {self.queue.qsize()}\nОтправлено: {st['sent']}\nОшибок: {st['failed']}\n"
+                f"Повторов: {st['retried']} (из них 429: {st['rate_limited']})\n"
+                f"Задержка: средняя {avg:.2f} с, макс. {st['latency_max']:.2f} с")
+
+OUTBOX = Outbox(lambda chat_id, text, **kw: bot.send_message(chat_id, text, **kw))
+
+@router.command("broadcast")
+def broadcast_cmd(m):
+    if not is_admin(m.from_user.id):
+        bot.reply_to(m,"Только для админов."); return
+    try:
+        _, payload = m.text.split(" ",1)
+        eid, text = [p.strip() for p in payload.split("|",1)]
+        eid=int(eid)
+        if not text: raise ValueError
+    except:
+        bot.reply_to(m,"Формат: /broadcast <id> | текст"); return
+    with db() as con:
+        cur=con.cursor()
+        cur.execute("SELECT tg_user_id FROM signups WHERE event_id=?", (eid,))
+        uids=[u for (u,) in cur.fetchall()]
+    for uid in uids:
+        OUTBOX.submit(uid, text)
+    bot.reply_to(m, f"Поставила в очередь {len(uids)} сообщений 📣")
+
+@router.command("outbox")
+def outbox_cmd(m):
+    if not is_admin(m.from_user.id):
+        bot.reply_to(m,"Только для админов."); return
+    bot.reply_to(m, OUTBOX.stats_text())
 
 # === Reminders loop (старт и отчёты)
-def reminders_loop():
+# Кому слать — одним анти-join'ом на вид напоминания: записанные минус уже уведомлённые.
+# Ежедневные — разность множеств по каждому событию: записанные минус отчитавшиеся сегодня
+# минус уже напомненные сегодня (журнал daily_notified по дням, старые дни чистит обслуживание).
+# Пока идут запросы в Telegram, транзакция не держится.
+REMINDER_TEXTS = {
+    "start": "{emj} Напоминание: «<b>{title}</b>» стартует сегодня.",
+    "start-2": "{emj} Напоминание: «<b>{title}</b>» стартует через 2 дня.",
+    "report-daily": "{emj} Напомню: пришли отчёт по «<b>{title}</b>» — нажми «📥 Отчёт» в карточке.",
+    "report-final": "{emj} Напомню: пришли отчёт по «<b>{title}</b>» — нажми «📥 Отчёт» в карточке.",
+}
+REMINDER_CONDITIONS = {
+    "start": "e.date_start=:today",
+    "start-2": "e.date_start=:plus2",
+    "report-final": "e.report_required=1 AND e.report_schedule='final' AND e.date_end=:today",
+}
+DUE_REMINDERS_SQL = """SELECT e.id, e.title, e.emoji, s.tg_user_id
+                       FROM events e JOIN signups s ON s.event_id=e.id
+                       WHERE e.is_active=1 AND {cond}
+                         AND NOT EXISTS(SELECT 1 FROM notifications_sent n
+                                        WHERE n.event_id=e.id AND n.tg_user_id=s.tg_user_id AND n.kind=:kind)"""
+DUE_DAILY_SQL = """SELECT tg_user_id FROM signups WHERE event_id=:eid
+                   EXCEPT SELECT tg_user_id FROM reports WHERE event_id=:eid AND date=:today
+                   EXCEPT SELECT tg_user_id FROM daily_notified WHERE event_id=:eid AND day=:today"""
+DAILY_LEDGER_DAYS = 7   # сколько дней хранить журнал ежедневных напоминаний
+
+def due_reminders(kind: str, today: dt.date):
+    params = {"kind": kind, "today": today.strftime("%Y-%m-%d"),
+              "plus2": (today + dt.timedelta(days=2)).strftime("%Y-%m-%d")}
+    with db() as con:
+        cur=con.cursor()
+        if kind != "report-daily":
+            cur.execute(DUE_REMINDERS_SQL.format(cond=REMINDER_CONDITIONS[kind]), params)
+            return cur.fetchall()
+        rows=[]
+        for ev in EVENTS.active(params["today"]):
+            if ev.report_required and ev.report_schedule == "daily" and ev.date_start <= params["today"]:
+                cur.execute(DUE_DAILY_SQL, {"eid": ev.id, "today": params["today"]})
+                rows.extend((ev.id, ev.title, ev.emoji, uid) for (uid,) in cur.fetchall())
+        return rows
+
+TERMINAL_API_CODES = (400, 403)   # чат не найден / бот заблокирован — как и в Outbox, без повторов
+
+def reminders_tick(today: dt.date | None = None, kinds=None) -> int:
+    # возвращает, сколько напоминаний не доставлено из-за временных сбоев (их стоит повторить)
+    today = today or local_today()
+    failed = 0
+    for kind in kinds or REMINDER_TEXTS:
+        pending=[]
+        for eid,title,emoji,uid in due_reminders(kind, today):
+            emj = (emoji or "🏅").strip() or "🏅"
+            pending.append((eid, uid, OUTBOX.submit(uid, REMINDER_TEXTS[kind].format(emj=emj, title=title))))
+        # отмечаем доставленные и безнадёжные (бот заблокирован, чата нет): повтор им не поможет.
+        # Временные сбои (429, 5xx, сеть — Outbox уже исчерпал попытки) попадут в выборку повтора.
+        sent=[]
+        for eid,uid,fut in pending:
+            e=fut.exception()
+            if e is None:
+                sent.append((eid,uid))
+            elif isinstance(e, ApiTelegramException) and e.error_code in TERMINAL_API_CODES:
+                sent.append((eid,uid))
+                METRICS.inc("sportsbot_reminders_unreachable_total", kind=kind, code=e.error_code)
+            else:
+                failed += 1
+        if sent:
+            with db() as con:
+                if kind == "report-daily":
+                    day=today.strftime("%Y-%m-%d")
+                    con.executemany("INSERT OR IGNORE INTO daily_notified(event_id,day,tg_user_id) VALUES(?,?,?)",
+                                    [(eid,day,uid) for eid,uid in sent])
+                else:
+                    now=dt.datetime.utcnow().isoformat()
+                    con.executemany("INSERT OR IGNORE INTO notifications_sent(event_id,tg_user_id,kind,sent_at) VALUES(?,?,?,?)",
+                                    [(eid,uid,kind,now) for eid,uid in sent])
+    return failed
+
+# Планировщик: для каждого события и вида напоминания считается ближайший момент в TZ,
+# поток спит ровно до ближайшего из них (куча по времени). Админские правки событий
+# вызывают rearm() — план пересобирается, пропущенные сегодня окна догоняются сразу.
+def remind_time(kind: str) -> dt.time:
+    h, mnt = REMIND_AT[kind].split(":")
+    return dt.time(int(h), int(mnt))
+
+def remind_at(kind: str, day: dt.date) -> dt.datetime:
+    return dt.datetime.combine(day, remind_time(kind), tzinfo=TZ)
+
+class ReminderScheduler:
+    RETRY_AFTER = 1800   # недоставленное — повторить через 30 минут
+    MAX_SLEEP = 6 * 3600 # страховка от сдвига часов
+
+    def __init__(self):
+        self.plan = []   # heap: (when, kind, event_id)
+        self.wake = threading.Event()
+        self.catch_up = True
+        self.retry_at = None
+
+    def rearm(self):
+        self.catch_up = True
+        self.wake.set()
+
+    def build_plan(self, now: dt.datetime):
+        today = now.date()
+        plan=[]
+        for ev in EVENTS.active(today.strftime("%Y-%m-%d")):
+            eid, req, sched = ev.id, ev.report_required, ev.report_schedule
+            d1, d2 = ev.d1, ev.d2
+            cand = [("start-2", remind_at("start-2", d1 - dt.timedelta(days=2))),
+                    ("start", remind_at("start", d1))]
+            if req and sched=="daily":
+                day = max(d1, today)
+                when = remind_at("report-daily", day)
+                if when <= now and day < d2:
+                    when = remind_at("report-daily", day + dt.timedelta(days=1))
+                cand.append(("report-daily", when))
+            elif req and sched=="final":
+                cand.append(("report-final", remind_at("report-final", d2)))
+            plan.extend((when, kind, eid) for kind, when in cand if when > now)
+        heapq.heapify(plan)
+        self.plan = plan
+
+    def run(self):
+        while True:
+            try:
+                now = dt.datetime.now(TZ)
+                kinds = set()
+                if self.catch_up or (self.retry_at and self.retry_at <= now):
+                    # старт, перевзвод или повтор недоставленного: все виды, чьё окно сегодня уже наступило
+                    self.catch_up = False; self.retry_at = None
+                    kinds = {k for k in REMINDER_TEXTS if now.time() >= remind_time(k)}
+                while self.plan and self.plan[0][0] <= now:
+                    kinds.add(heapq.heappop(self.plan)[1])
+                if kinds and reminders_tick(now.date(), [k for k in REMINDER_TEXTS if k in kinds]):
+                    self.retry_at = now + dt.timedelta(seconds=self.RETRY_AFTER)
+                self.build_plan(now)
+                wake_at = [w for w in (self.plan[0][0] if self.plan else None, self.retry_at) if w]
+                delay = (min(wake_at) - dt.datetime.now(TZ)).total_seconds() if wake_at else self.MAX_SLEEP
+            except Exception as e:
+                METRICS.error("reminders", e)
+                delay = 60
+            if self.wake.wait(max(0.0, min(delay, self.MAX_SLEEP))):
+                self.wake.clear()
+
+REMINDERS = ReminderScheduler()
+
+# === Archive & maintenance
+# Завершённые события старше ARCHIVE_AFTER_DAYS дней вместе с записями, отчётами, итогами и
+# отметками напоминаний переезжают в файл ARCHIVE_DB, и горячие таблицы не растут годами.
+# Из основной БД удаляется только строка events, остальное уходит каскадом. В архив пишется
+# INSERT OR REPLACE по ключам таблиц, поэтому повтор после сбоя безопасен.
+ARCHIVE_KEYS = {
+    "events": ("id",),
+    "signups": ("event_id", "tg_user_id"),
+    "reports": ("event_id", "tg_user_id", "date"),
+    "standings": ("event_id", "tg_user_id"),
+    "notifications_sent": ("event_id", "tg_user_id", "kind"),
+    "report_photos": ("event_id", "tg_user_id", "date", "pos"),
+}
+
+def _archive_columns(cur, table: str) -> str:
+    # архивная таблица повторяет колонки основной; новые колонки после миграций дописываются
+    cur.execute(f"PRAGMA main.table_info({table})")
+    cols = [row[1] for row in cur.fetchall()]
+    cur.execute(f"PRAGMA archive.table_info({table})")
+    have = {row[1] for row in cur.fetchall()}
+    if not have:
+        cur.execute(f"CREATE TABLE archive.{table} AS SELECT {','.join(cols)} FROM main.{table} WHERE 0")
+        cur.execute(f"CREATE UNIQUE INDEX archive.ux_{table} ON {table}({','.join(ARCHIVE_KEYS[table])})")
+    for c in cols:
+        if have and c not in have:
+            cur.execute(f"ALTER TABLE archive.{table} ADD COLUMN {c}")
+    return ",".join(cols)
+
+def archive_finished(today: dt.date | None = None) -> int:
+    cutoff = ((today or local_today()) - dt.timedelta(days=ARCHIVE_AFTER_DAYS)).strftime("%Y-%m-%d")
+    con = _connect()   # отдельное соединение: ATTACH не должен висеть на рабочих
+    try:
+        con.execute("ATTACH DATABASE ? AS archive", (ARCHIVE_DB,))
+        with con:
+            cur = con.cursor()
+            cur.execute("BEGIN IMMEDIATE")
+            cur.execute("SELECT id FROM main.events WHERE date_end<?", (cutoff,))
+            ids = [row[0] for row in cur.fetchall()]
+            if ids:
+                cur.execute("CREATE TEMP TABLE IF NOT EXISTS archiving(id INTEGER PRIMARY KEY)")
+                cur.execute("DELETE FROM archiving")
+                cur.executemany("INSERT INTO archiving(id) VALUES(?)", [(eid,) for eid in ids])
+                for table in ARCHIVE_KEYS:
+                    cols = _archive_columns(cur, table)
+                    key = "id" if table == "events" else "event_id"
+                    cur.execute(f"""INSERT OR REPLACE INTO archive.{table}({cols})
+                                    SELECT {cols} FROM main.{table} WHERE {key} IN (SELECT id FROM archiving)""")
+                cur.execute("DELETE FROM main.events WHERE id IN (SELECT id FROM archiving)")
+    finally:
+        con.close()
+    if ids:
+        for eid in ids:
+            invalidate_leaderboard(eid)
+        events_changed()
+    return len(ids)
+
+def run_maintenance(vacuum: bool = False) -> str:
+    # архивация, свежая статистика планировщику запросов и VACUUM, если файл заметно «дырявый»
+    moved = archive_finished()
+    con = db()
+    with con:
+        cutoff = (local_today() - dt.timedelta(days=DAILY_LEDGER_DAYS)).strftime("%Y-%m-%d")
+        pruned = con.execute("DELETE FROM daily_notified WHERE day<?", (cutoff,)).rowcount
+    con.execute("ANALYZE")
+    pages = con.execute("PRAGMA page_count").fetchone()[0]
+    free = con.execute("PRAGMA freelist_count").fetchone()[0]
+    vacuumed = vacuum or free > pages // 4
+    if vacuumed:
+        con.execute("VACUUM")
+        con.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    size = os.path.getsize(DB) / 1e6
+    return (f"В архив: {moved} событий\nЖурнал напоминаний: удалено {pruned} строк\nANALYZE ✅\n"
+            f"VACUUM: {'да' if vacuumed else f'не нужен (свободно {free} из {pages} страниц)'}\n"
+            f"Размер БД: {size:.1f} МБ")
+
+def maintenance_loop():
+    h, mnt = MAINTENANCE_AT.split(":")
+    idle = threading.Event()
     while True:
+        now = dt.datetime.now(TZ)
+        when = dt.datetime.combine(now.date(), dt.time(int(h), int(mnt)), tzinfo=TZ)
+        if when <= now:
+            when += dt.timedelta(days=1)
+        idle.wait((when - now).total_seconds())   # Event.wait, а не sleep: профайлер видит поток спящим
         try:
-            today = local_today()
-            plus2 = today + dt.timedelta(days=2)
-            with db() as con:
-                cur=con.cursor()
-                # стартовые напоминания: сегодня и через 2 дня
-                cur.execute("SELECT id,title,emoji,date_start FROM events WHERE is_active=1 AND date_start IN (?,?)",
-                            (today.strftime("%Y-%m-%d"), plus2.strftime("%Y-%m-%d")))
-                for eid,title,emoji,ds in cur.fetchall():
-                    d1 = dt.datetime.strptime(ds,"%Y-%m-%d").date()
-                    kind = "start" if d1==today else "start-2"
-                    cur.execute("SELECT tg_user_id FROM signups WHERE event_id=?", (eid,))
-                    for (uid,) in cur.fetchall():
-                        cur.execute("SELECT 1 FROM notifications_sent WHERE event_id=? AND tg_user_id=? AND kind=?", (eid,uid,kind))
-                        if cur.fetchone(): continue
-                        emj = (emoji or "🏅").strip() or "🏅"
-                        try:
-                            bot.send_message(uid, f"{emj} Напоминание: «<b>{title}</b>» стартует {'сегодня' if kind=='start' else 'через 2 дня'}.")
-                        except:
-                            pass
-                        cur.execute("INSERT OR IGNORE INTO notifications_sent(event_id,tg_user_id,kind,sent_at) VALUES(?,?,?,?)",
-                                    (eid,uid,kind,dt.datetime.utcnow().isoformat()))
-                # отчёты: daily — каждый день в диапазоне; final — в день окончания
-                cur.execute("SELECT id,title,emoji,date_start,date_end,report_required,report_schedule FROM events WHERE is_active=1")
-                for eid,title,emoji,ds,de,req,sched in cur.fetchall():
-                    if not req: continue
-                    d1 = dt.datetime.strptime(ds,"%Y-%m-%d").date()
-                    d2 = dt.datetime.strptime(de,"%Y-%m-%d").date()
-                    if sched=="daily" and d1 <= today <= d2:
-                        kind="report-daily"
-                    elif sched=="final" and today == d2:
-                        kind="report-final"
-                    else:
-                        continue
-                    cur.execute("SELECT tg_user_id FROM signups WHERE event_id=?", (eid,))
-                    users = [u[0] for u in cur.fetchall()]
-                    for uid in users:
-                        if kind=="report-daily":
-                            cur.execute("SELECT 1 FROM reports WHERE event_id=? AND tg_user_id=? AND date=?",
-                                        (eid,uid,today.strftime("%Y-%m-%d")))
-                            if cur.fetchone(): continue
-                        cur.execute("SELECT 1 FROM notifications_sent WHERE event_id=? AND tg_user_id=? AND kind=?", (eid,uid,kind))
-                        if cur.fetchone(): continue
-                        emj = (emoji or "🏅").strip() or "🏅"
-                        try:
-                            bot.send_message(uid, f"{emj} Напомню: пришли отчёт по «<b>{title}</b>» — нажми «📥 Отчёт» в карточке.")
-                        except:
-                            pass
-                        cur.execute("INSERT OR IGNORE INTO notifications_sent(event_id,tg_user_id,kind,sent_at) VALUES(?,?,?,?)",
-                                    (eid,uid,kind,dt.datetime.utcnow().isoformat()))
-                con.commit()
-        except:
-            pass
-        time.sleep(1800)  # каждые ~30 минут
+            run_maintenance()
+        except Exception as e:
+            METRICS.error("maintenance", e)
+            idle.wait(60)
+
+@router.command("maintenance")
+def maintenance_cmd(m):
+    if not is_admin(m.from_user.id):
+        bot.reply_to(m,"Только для админов."); return
+    vacuum = "vacuum" in (m.text or "").lower()
+    bot.reply_to(m,"Обслуживаю БД, это может занять время…")
+    bot.reply_to(m, run_maintenance(vacuum))
+
+# === Metrics endpoint & profiler
+METRICS.gauges.update({
+    "sportsbot_outbox_queue": lambda: OUTBOX.queue.qsize(),
+    "sportsbot_event_cache_hits": lambda: EVENTS.stats["hits"],
+    "sportsbot_event_cache_misses": lambda: EVENTS.stats["misses"],
+    "sportsbot_db_connections": lambda: DB_STATS["opened"],
+    "sportsbot_startup_seconds": lambda: APP.timings.get("total", 0),
+})
+
+class MetricsServer:
+    def __init__(self, listen: str, port: int):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", 1)[0] != "/metrics":
+                    self.send_response(404); self.end_headers(); return
+                body = METRICS.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+        self.httpd = ThreadingHTTPServer((listen, port), Handler)
+        self.httpd.daemon_threads = True
+
+    @property
+    def port(self) -> int:
+        return self.httpd.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, name="metrics-http", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown(); self.httpd.server_close()
+
+# Сэмплирующий профайлер: раз в interval секунд снимает стеки всех потоков (sys._current_frames).
+# Потоки, которые просто ждут (очереди, сокеты, Event.wait), не считаются.
+class SamplingProfiler:
+    IDLE_FILES = ("threading.py", "queue.py", "selectors.py", "socket.py", "ssl.py", "socketserver.py",
+                  "connection.py", "thread.py", "base_events.py")
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.thread = None
+        self.stop_flag = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self.thread is not None
+
+    def start(self):
+        self.own = Counter()        # самая внутренняя функция стека
+        self.inclusive = Counter()  # функции бота где угодно в стеке
+        self.samples = 0
+        self.started = time.monotonic()
+        self.stop_flag.clear()
+        self.thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self) -> str:
+        self.stop_flag.set(); self.thread.join(); self.thread = None
+        return self.report()
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self.stop_flag.wait(self.interval):
+            for tid, frame in sys._current_frames().items():
+                if tid == me or frame.f_code.co_filename.endswith(self.IDLE_FILES):
+                    continue
+                self.samples += 1
+                code = frame.f_code
+                self.own[f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}"] += 1
+                seen = set()
+                while frame is not None:
+                    if frame.f_code.co_filename == __file__ and frame.f_code.co_name not in seen:
+                        seen.add(frame.f_code.co_name)
+                        self.inclusive[frame.f_code.co_name] += 1
+                    frame = frame.f_back
+
+    def report(self, top: int = 10) -> str:
+        if not self.samples:
+            return "Профайлер не поймал ни одного рабочего стека — бот простаивал."
+        pct = lambda n: f"{100 * n / self.samples:.1f}%"
+        lines = [f"Сэмплов: {self.samples} за {time.monotonic() - self.started:.0f} с", "", "Горячие функции бота (включая вызовы):"]
+        lines += [f"{pct(n)}  {name}" for name, n in self.inclusive.most_common(top)]
+        lines += ["", "Где стоял поток (собственное время):"]
+        lines += [f"{pct(n)}  {name}" for name, n in self.own.most_common(top)]
+        return "\n".join(lines)
+
+PROFILER = SamplingProfiler()
+
+@router.command("profile")
+def profile_cmd(m):
+    if not is_admin(m.from_user.id):
+        bot.reply_to(m,"Только для админов."); return
+    if not PROFILER.running:
+        PROFILER.start()
+        bot.reply_to(m,"Профайлер запущен. Повтори /profile, чтобы остановить и получить отчёт.")
+        return
+    bot.reply_to(m, f"<pre>{html.escape(PROFILER.stop())}</pre>"[:TG_TEXT_LIMIT])
+
+def start_metrics_server():
+    if METRICS_PORT:
+        try:
+            MetricsServer(METRICS_LISTEN, METRICS_PORT).start()
+        except OSError as e:
+            METRICS.error("metrics-http", e)
+
+# === Webhook
+# Приём апдейтов по HTTP: проверяем секрет, кладём апдейт в очередь воркера и сразу отвечаем 200,
+# так что медленные обработчики не тормозят приём. Воркер выбирается по user_id — шаги мастера
+# одного пользователя обрабатываются по порядку. Очереди ограничены: при переполнении отвечаем 503,
+# Telegram повторит доставку позже.
+class WebhookServer:
+    MAX_BODY = 1 << 20
+
+    def __init__(self, tbot, host: str, port: int, secret: str, workers: int = 8, maxsize: int = 1000):
+        if not secret:
+            raise ValueError("WebhookServer: без секрета апдейт может прислать кто угодно")
+        self.bot = tbot; self.secret = secret
+        self.queues = [queue.Queue(maxsize) for _ in range(workers)]
+        self.stats = {"accepted": 0, "rejected": 0, "processed": 0, "errors": 0}
+        self.httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self.httpd.daemon_threads = True
+
+    def _handler_class(self):
+        server = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if not hmac.compare_digest(self.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), server.secret):
+                    return self._reply(403)
+                try:
+                    size = int(self.headers.get("Content-Length") or 0)
+                except ValueError:
+                    return self._reply(400)
+                if size <= 0 or size > server.MAX_BODY:
+                    return self._reply(400 if size <= 0 else 413)
+                try:
+                    update = Update.de_json(self.rfile.read(size).decode("utf-8"))
+                except Exception:
+                    return self._reply(400)
+                self._reply(200 if server.enqueue(update) else 503)
+
+            def _reply(self, code: int):
+                self.send_response(code)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+        return Handler
+
+    @staticmethod
+    def _owner(update) -> int:
+        for part in (update.message, update.callback_query, update.edited_message):
+            if part is not None and part.from_user is not None:
+                return part.from_user.id
+        return update.update_id
+
+    def enqueue(self, update) -> bool:
+        try:
+            self.queues[self._owner(update) % len(self.queues)].put_nowait(update)
+        except queue.Full:
+            self.stats["rejected"] += 1
+            return False
+        self.stats["accepted"] += 1
+        return True
+
+    def _worker(self, q):
+        while True:
+            update = q.get()
+            try:
+                self.bot.process_new_updates([update])
+                self.stats["processed"] += 1
+            except Exception as e:
+                self.stats["errors"] += 1
+                METRICS.error("webhook", e)
+
+    @property
+    def port(self) -> int:
+        return self.httpd.server_address[1]
+
+    def start(self):
+        for i, q in enumerate(self.queues):
+            threading.Thread(target=self._worker, args=(q,), name=f"webhook-{i}", daemon=True).start()
+        threading.Thread(target=self.httpd.serve_forever, name="webhook-http", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+
+# === Async runtime (BOT_MODE=async)
+# Апдейты принимает AsyncTeleBot, горячие обработчики — корутины: вызовы Telegram не держат поток,
+# независимые вызовы идут параллельно. Все их обращения к SQLite — через один выделенный поток
+# (DbExecutor), событийный цикл на диске не блокируется. Редкие сценарии (мастера, админка, отчёты)
+# выполняются прежними синхронными обработчиками в пуле потоков. Апдейты одного пользователя — по очереди.
+class DbExecutor:
+    def __init__(self):
+        self.pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+
+    async def __call__(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.pool, fn, *args)
+
+class AsyncRuntime:
+    def __init__(self, abot, sync_workers: int = 16):
+        self.bot = abot
+        self.db = DbExecutor()
+        self.sync_pool = ThreadPoolExecutor(max_workers=sync_workers, thread_name_prefix="sync-handler")
+        self.user_locks = {}
+        self.overrides = {
+            start_cmd: self.start_cmd,
+            list_events: self.list_events, btn_events: self.list_events,
+            my_signups: self.my_signups, btn_my: self.my_signups,
+            cb_join: self.cb_join, cb_leave: self.cb_leave,
+            cb_leaderboard: self.cb_leaderboard,
+        }
+        abot.register_message_handler(self.dispatch_message, content_types=["text","photo","document"])
+        abot.register_callback_query_handler(self.dispatch_callback, func=None)
+
+    async def _serial(self, uid: int, coro_fn, *args):
+        entry = self.user_locks.setdefault(uid, [asyncio.Lock(), 0])  # [lock, сколько ждут]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                return await coro_fn(*args)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                self.user_locks.pop(uid, None)
+
+    async def _timed(self, override, *args):
+        # запросы к БД здесь идут в потоке DbExecutor, поэтому на апдейт считается только время
+        with METRICS.timer("sportsbot_handler_seconds", override.__name__, handler=override.__name__):
+            return await override(*args)
+
+    async def _sync(self, handler, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.sync_pool, handler, *args)
+
+    async def dispatch_message(self, m):
+        loop = asyncio.get_running_loop()
+        if m.media_group_id and ALBUMS.add(m, lambda first: asyncio.run_coroutine_threadsafe(self.dispatch_message(first), loop),
+                                           await self.db(STATE.mode, m.from_user.id) == "report"):
+            return
+        for first in ALBUMS.take_user(m.from_user.id):
+            await self.dispatch_message(first)
+        # режим мастера читается из conv_state — только через поток БД, не в event loop
+        handler = router.resolve_static(m) or router.modes.get(await self.db(STATE.mode, m.from_user.id))
+        if handler is None:
+            return
+        override = self.overrides.get(handler)
+        if override:
+            await self._serial(m.from_user.id, self._timed, override, m)
+        else:
+            await self._serial(m.from_user.id, self._sync, instrumented, handler, m)
+
+    async def dispatch_callback(self, c):
+        route = router.resolve_callback(c)
+        if route is None:
+            return
+        handler, args = route
+        if args is None:
+            await self.bot.answer_callback_query(c.id,"Ошибка."); return
+        override = self.overrides.get(handler)
+        if override:
+            await self._serial(c.from_user.id, self._timed, override, c, *args)
+        else:
+            await self._serial(c.from_user.id, self._sync, instrumented, handler, c, *args)
+
+    async def start_cmd(self, m):
+        await self.bot.send_message(m.chat.id, WELCOME_TEXT, reply_markup=main_menu_kb(is_admin(m.from_user.id)))
+
+    async def _send_page(self, m, page, empty_text):
+        text, kb = page
+        if text is None:
+            await self.bot.send_message(m.chat.id, empty_text, reply_markup=main_menu_kb(is_admin(m.from_user.id)))
+            return
+        await self.bot.send_message(m.chat.id, text, reply_markup=kb)
+
+    async def list_events(self, m):
+        await self._send_page(m, await self.db(events_page, 0), "Сейчас нет активных событий.")
+
+    async def my_signups(self, m):
+        await self._send_page(m, await self.db(my_page, m.from_user.id, 0), "У тебя пока нет активных регистраций.")
+
+    async def cb_join(self, c, eid: int):
+        await self._answer_join_leave(c, eid, await self.db(join_event, eid, c.from_user))
+
+    async def cb_leave(self, c, eid: int):
+        await self._answer_join_leave(c, eid, await self.db(leave_event, eid, c.from_user.id))
+
+    async def _answer_join_leave(self, c, eid: int, outcome: str):
+        if outcome not in {"joined","left"}:
+            await self.bot.answer_callback_query(c.id, JOIN_ANSWERS[outcome]); return
+        invalidate_leaderboard(eid)
+        async def refresh():
+            kb = keep_back_button(await self.db(event_keyboard, eid, c.from_user.id), c.message)
+            await self.bot.edit_message_reply_markup(chat_id=c.message.chat.id, message_id=c.message.message_id, reply_markup=kb)
+        await asyncio.gather(self.bot.answer_callback_query(c.id, JOIN_ANSWERS[outcome]), refresh(), return_exceptions=True)
+
+    async def cb_leaderboard(self, c, eid: int):
+        text = await self.db(leaderboard_text, eid)
+        await asyncio.gather(self.bot.answer_callback_query(c.id,"Показываю рейтинг"),
+                             self.bot.send_message(c.message.chat.id, text))
+
+def _time_async_api():
+    from telebot import asyncio_helper
+    process = asyncio_helper._process_request
+    if getattr(process, "timed", False):
+        return
+    async def timed(token, url, *args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return await process(token, url, *args, **kwargs)
+        except Exception as e:
+            METRICS.inc("sportsbot_telegram_errors_total", method=url,
+                        type=str(getattr(e, "error_code", "") or type(e).__name__))
+            raise
+        finally:
+            METRICS.observe("sportsbot_telegram_seconds", time.perf_counter() - t0, method=url)
+    timed.timed = True
+    asyncio_helper._process_request = timed
+
+def make_async_runtime() -> AsyncRuntime:
+    from telebot.async_telebot import AsyncTeleBot  # опционально: требует aiohttp
+    _time_async_api()
+    return AsyncRuntime(AsyncTeleBot(BOT_TOKEN, parse_mode="HTML"))
+
+def run_async():
+    runtime = make_async_runtime()
+    asyncio.run(runtime.bot.infinity_polling(timeout=30, request_timeout=40))
+
+def run_polling():
+    bot.infinity_polling(timeout=30, long_polling_timeout=30)
+
+def run_webhook():
+    # обработчики выполняются в воркерах WebhookServer, а не в пуле telebot (APP.threaded=False).
+    # Без секрета не стартуем: если вебхук регистрируем сами — придумываем случайный и отдаём его
+    # Telegram в set_webhook; если регистрирует кто-то другой, секрет обязан прийти из окружения.
+    secret = WEBHOOK_SECRET
+    if not secret:
+        if not WEBHOOK_URL:
+            raise RuntimeError("BOT_MODE=webhook: задай WEBHOOK_SECRET (или WEBHOOK_URL, тогда секрет сгенерируется)")
+        secret = secrets.token_urlsafe(32)
+    WebhookServer(bot, WEBHOOK_LISTEN, WEBHOOK_PORT, secret, WEBHOOK_WORKERS, WEBHOOK_QUEUE).start()
+    if WEBHOOK_URL:
+        bot.set_webhook(url=WEBHOOK_URL, secret_token=secret, drop_pending_updates=False)
+    threading.Event().wait()
 
-threading.Thread(target=reminders_loop, daemon=True).start()
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    APP.start(BOT_MODE)
+    print("Bot is running...")
+    {"webhook": run_webhook, "async": run_async}.get(BOT_MODE, run_polling)()
 
-print("Bot is running...")
-bot.infinity_polling(timeout=30, long_polling_timeout=30)
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+# Тесты гоняют настоящие функции bot.py на временной БД. Окружение задаётся до импорта bot:
+# импорт без побочных эффектов (см. App), схема создаётся при первом db().
+import os, sys, itertools, tempfile
+import datetime as dt
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="sportsbot-test-"), "test.db")
+os.environ["ADMIN_IDS"] = "1"
+os.environ["METRICS_PORT"] = "0"
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+
+import bot as B  # noqa: E402
+
+_titles = itertools.count(1)
+
+class User:
+    def __init__(self, uid: int):
+        self.id = uid; self.username = f"u{uid}"; self.first_name = f"U{uid}"; self.last_name = None
+
+@pytest.fixture
+def bot_module():
+    return B
+
+@pytest.fixture
+def make_event():
+    def make(capacity=None, days_before=1, days_after=5, schedule="daily"):
+        today = B.local_today()
+        con = B.db()
+        with con:
+            cur = con.execute("""INSERT INTO events(emoji,title,date_start,date_end,capacity,report_required,
+                                                   report_schedule,report_unit,is_active)
+                                 VALUES('🏃',?,?,?,?,1,?,'км',1)""",
+                              (f"Тест {next(_titles)}", (today - dt.timedelta(days=days_before)).isoformat(),
+                               (today + dt.timedelta(days=days_after)).isoformat(), capacity, schedule))
+        B.events_changed(cur.lastrowid)
+        return cur.lastrowid
+    return make
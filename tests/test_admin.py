@@ -0,0 +1,25 @@
+# Админские команды не держат транзакцию (и лок записи WAL) во время запроса к Telegram.
+import pytest
+
+from conftest import User
+
+class Msg:
+    def __init__(self, text, uid=1):   # 1 — в ADMIN_IDS (conftest)
+        self.text = text; self.from_user = User(uid)
+
+class StubBot:
+    def __init__(self, B):
+        self.B = B; self.replies = []
+    def reply_to(self, m, text, **kw):
+        self.replies.append((text, self.B.db().in_transaction))
+
+@pytest.mark.parametrize("existing", [True, False])
+def test_toggle_replies_outside_transaction(bot_module, make_event, monkeypatch, existing):
+    B = bot_module
+    eid = make_event() if existing else 10 ** 9
+    stub = StubBot(B)
+    monkeypatch.setattr(B, "bot", stub)
+    B.toggle_event(Msg(f"/toggle {eid}"))
+    (text, in_transaction), = stub.replies
+    assert not in_transaction, text
+    assert ("выключено" in text) if existing else (text == "Не нашла событие.")
@@ -0,0 +1,45 @@
+# Альбомы склеиваются только в режиме отчёта: пачка файлов в /import — отдельные сообщения.
+import threading
+
+from telebot.types import Message
+
+def group_message(uid, n, gid, **content):
+    return Message.de_json({"message_id": n, "date": 0, "media_group_id": gid, **content,
+                            "chat": {"id": uid, "type": "private"},
+                            "from": {"id": uid, "is_bot": False, "first_name": f"U{uid}"}})
+
+def document(uid, n, gid):
+    return group_message(uid, n, gid, document={"file_id": f"f{n}", "file_unique_id": f"f{n}",
+                                                "file_name": f"part{n}.csv", "mime_type": "text/csv"})
+
+def photo(uid, n, gid):
+    return group_message(uid, n, gid, photo=[{"file_id": f"p{n}", "file_unique_id": f"p{n}", "width": 1, "height": 1}])
+
+def recorder(seen, done=None):
+    def handler(m):
+        seen.append(m)
+        if done: done.set()
+    return handler
+
+def test_document_group_in_import_mode_is_not_merged(bot_module, monkeypatch):
+    B = bot_module
+    seen = []
+    monkeypatch.setitem(B.router.modes, "import", recorder(seen))
+    B.STATE[801] = {"mode": "import", "event_id": 1}
+    for n in (1, 2, 3):
+        B.router.dispatch_message(document(801, n, "docs-801"))
+    assert [m.document.file_name for m in seen] == ["part1.csv", "part2.csv", "part3.csv"]
+    assert all(getattr(m, "album", None) is None for m in seen)
+    B.reset_state(801)
+
+def test_photo_album_in_report_mode_is_merged(bot_module, monkeypatch):
+    B = bot_module
+    seen, done = [], threading.Event()
+    monkeypatch.setitem(B.router.modes, "report", recorder(seen, done))
+    monkeypatch.setattr(B.ALBUMS, "window", 0.05)
+    B.STATE[802] = {"mode": "report", "event_id": 1, "step": 1}
+    for n in (3, 1, 2):
+        B.router.dispatch_message(photo(802, n, "album-802"))
+    assert done.wait(5)
+    assert len(seen) == 1 and seen[0].message_id == 1 and seen[0].album == ["p1", "p2", "p3"]
+    B.reset_state(802)
@@ -0,0 +1,25 @@
+# AsyncRuntime: всё, что ходит в SQLite, выполняется в потоке DbExecutor, а не в event loop.
+import asyncio, threading
+
+import pytest
+from telebot.types import Message
+
+pytest.importorskip("aiohttp")
+
+def text_message(uid, text):
+    return Message.de_json({"message_id": 1, "date": 0, "text": text,
+                            "chat": {"id": uid, "type": "private"},
+                            "from": {"id": uid, "is_bot": False, "first_name": f"U{uid}"}})
+
+def test_mode_lookup_runs_in_db_thread(bot_module, monkeypatch):
+    B = bot_module
+    store = B.SqliteStateStore()
+    threads = []
+    real_load = store._load
+    def load(uid):
+        threads.append(threading.current_thread().name); return real_load(uid)
+    monkeypatch.setattr(store, "_load", load)
+    monkeypatch.setattr(B, "STATE", store)
+    runtime = B.make_async_runtime()
+    asyncio.run(runtime.dispatch_message(text_message(900, "просто текст")))
+    assert threads and all(name.startswith("db") for name in threads), threads
@@ -0,0 +1,36 @@
+# Длинная карточка в списке обрезается, но HTML страницы должен оставаться целым:
+# разорванный тег или сущность — «can't parse entities» и пустой ответ на каждое нажатие.
+from html.parser import HTMLParser
+
+class TagBalance(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=False); self.stack = []; self.broken = []
+    def handle_starttag(self, tag, attrs):
+        self.stack.append(tag)
+    def handle_endtag(self, tag):
+        if not self.stack or self.stack.pop() != tag:
+            self.broken.append(tag)
+
+def assert_html_whole(text):
+    assert "<" not in text.rsplit(">", 1)[-1], text[-80:]
+    parser = TagBalance(); parser.feed(text); parser.close()
+    assert parser.stack == [] and parser.broken == [], text[-200:]
+
+def test_list_page_never_splits_tags(bot_module, make_event):
+    B = bot_module
+    for pad in range(500, 700, 4):   # сдвигаем ссылку через границу обрезки
+        eid = make_event()
+        desc = "x" * pad + ' <a href="https://example.com/rules">правила</a> &amp; <i>детали</i>'
+        con = B.db()
+        with con:
+            con.execute("UPDATE events SET description=? WHERE id=?", (desc, eid))
+        B.events_changed(eid)
+        text, _ = B.cards_page([B.EVENTS.get(eid)], 0, "h", "card", "evp")
+        assert len(text) < B.TG_TEXT_LIMIT
+        assert ("…" in text) == (len(B.fmt_event_row(B.EVENTS.get(eid))) > B.CARD_IN_LIST_LIMIT)
+        assert_html_whole(text)
+
+def test_html_cut_keeps_short_cards(bot_module):
+    B = bot_module
+    card = "<b>Бег</b> | " + "a" * 100
+    assert B.html_cut(card, 700) == card
@@ -0,0 +1,16 @@
+import json
+
+import pytest
+
+@pytest.mark.parametrize("payload", [5, "отчёты", None, {"reports": 5}, {"reports": {"user": 1}}])
+def test_json_top_level_must_be_a_list(bot_module, payload):
+    B = bot_module
+    with pytest.raises(ValueError):
+        list(B.import_rows(json.dumps(payload).encode(), "reports.json"))
+
+def test_json_list_and_object(bot_module):
+    B = bot_module
+    row = {"user": "@u1", "date": "2030-01-01", "value": 5}
+    for payload in ([row], {"reports": [row]}):
+        assert list(B.import_rows(json.dumps(payload).encode(), "reports.json")) == \
+            [(1, {"user": "@u1", "date": "2030-01-01", "value": 5})]
@@ -0,0 +1,31 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
+
+from conftest import User
+
+def test_concurrent_joins_respect_capacity(bot_module, make_event):
+    B = bot_module
+    eid = make_event(capacity=20)
+    with ThreadPoolExecutor(32) as pool:
+        outcomes = Counter(pool.map(lambda uid: B.join_event(eid, User(uid)), range(1000, 4000)))
+    assert outcomes == {"joined": 20, "full": 2980}
+    con = B.db()
+    signups = con.execute("SELECT COUNT(*) FROM signups WHERE event_id=?", (eid,)).fetchone()[0]
+    capacity, taken = con.execute("SELECT capacity, taken FROM events WHERE id=?", (eid,)).fetchone()
+    assert signups == capacity == taken == 20
+    assert B.check_taken() == []
+
+def test_concurrent_join_and_leave_keep_taken_in_sync(bot_module, make_event):
+    B = bot_module
+    eid = make_event(capacity=20)
+    def churn(uid):
+        for _ in range(5):
+            B.join_event(eid, User(uid)); B.leave_event(eid, uid)
+        return B.join_event(eid, User(uid))
+    with ThreadPoolExecutor(16) as pool:
+        list(pool.map(churn, range(5000, 5100)))
+    con = B.db()
+    signups = con.execute("SELECT COUNT(*) FROM signups WHERE event_id=?", (eid,)).fetchone()[0]
+    taken = con.execute("SELECT taken FROM events WHERE id=?", (eid,)).fetchone()[0]
+    assert signups == taken <= 20
+    assert B.check_taken() == []
@@ -0,0 +1,85 @@
+# Outbox против поддельного send: 429 ждёт retry_after, 5xx и сеть — экспоненциальная пауза,
+# 400/403 — без повторов; reminders_tick отмечает только доставленных и безнадёжных.
+import datetime as dt
+
+import pytest
+import requests
+from telebot.apihelper import ApiTelegramException
+
+from conftest import User
+
+def api_error(code, retry_after=None):
+    body = {"ok": False, "error_code": code, "description": f"error {code}"}
+    if retry_after is not None:
+        body["parameters"] = {"retry_after": retry_after}
+    return ApiTelegramException("sendMessage", None, body)
+
+class FakeSend:
+    # script: chat_id -> список исходов по попыткам; исключение — бросить, иначе вернуть; последний повторяется
+    def __init__(self, script):
+        self.script = script; self.calls = {}
+    def __call__(self, chat_id, text, **kw):
+        n = self.calls[chat_id] = self.calls.get(chat_id, 0) + 1
+        outcomes = self.script.get(chat_id, ["ok"])
+        outcome = outcomes[min(n, len(outcomes)) - 1]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+@pytest.fixture
+def sleeps(bot_module, monkeypatch):
+    waits = []
+    monkeypatch.setattr(bot_module.time, "sleep", lambda s: waits.append(s) if s > 0 else None)
+    return waits
+
+def outbox(B, send, retries=3):
+    return B.Outbox(send, workers=2, global_rate=1e6, chat_rate=1e6, retries=retries)
+
+def test_429_waits_retry_after(bot_module, sleeps):
+    B = bot_module
+    send = FakeSend({1: [api_error(429, retry_after=7), "ok"]})
+    box = outbox(B, send)
+    assert box.submit(1, "hi").result(5) == "ok"
+    assert send.calls[1] == 2 and box.stats["rate_limited"] == 1
+    assert [round(w) for w in sleeps] == [7]
+
+def test_5xx_and_network_back_off_then_give_up(bot_module, sleeps):
+    B = bot_module
+    send = FakeSend({2: [api_error(502), requests.exceptions.ConnectionError("reset"), api_error(500)]})
+    box = outbox(B, send, retries=3)
+    with pytest.raises(RuntimeError):
+        box.submit(2, "hi").result(5)
+    assert send.calls[2] == 4                            # первая попытка и 3 повтора
+    assert [int(w * 10) for w in sleeps] == [5, 10, 20]  # 0.5, 1, 2 с (+ до 0.1 с разброса)
+
+@pytest.mark.parametrize("code", [400, 403])
+def test_terminal_errors_are_not_retried(bot_module, sleeps, code):
+    B = bot_module
+    send = FakeSend({3: [api_error(code)]})
+    with pytest.raises(ApiTelegramException):
+        outbox(B, send).submit(3, "hi").result(5)
+    assert send.calls[3] == 1 and sleeps == []
+
+def test_reminders_marked_only_after_delivery(bot_module, make_event, sleeps, monkeypatch):
+    B = bot_module
+    start = make_event(days_before=0, schedule="final")  # начинается сегодня: «start»
+    daily = make_event(days_before=1)                    # идёт, ежедневные отчёты: «report-daily»
+    ok, blocked, down, limited = 601, 602, 603, 604
+    for eid in (start, daily):
+        for uid in (ok, blocked, down, limited):
+            B.join_event(eid, User(uid))
+    send = FakeSend({blocked: [api_error(403)], down: [api_error(502)], limited: [api_error(429, retry_after=1), "ok"]})
+    monkeypatch.setattr(B, "OUTBOX", outbox(B, send, retries=2))
+    today = B.local_today()
+    assert B.reminders_tick(today, kinds=["start", "report-daily"]) == 2   # down — по разу на каждый вид
+    con = B.db()
+    notified = {u for (u,) in con.execute("SELECT tg_user_id FROM notifications_sent WHERE event_id=? AND kind='start'", (start,))}
+    daily_done = {u for (u,) in con.execute("SELECT tg_user_id FROM daily_notified WHERE event_id=? AND day=?",
+                                            (daily, today.isoformat()))}
+    assert notified == daily_done == {ok, blocked, limited}
+    # следующий тик повторяет только временный сбой
+    send.script[down] = ["ok"]
+    calls = dict(send.calls)
+    assert B.reminders_tick(today, kinds=["start", "report-daily"]) == 0
+    assert {u for u in send.calls if send.calls[u] != calls.get(u)} == {down}
+    assert down in {u for (u,) in con.execute("SELECT tg_user_id FROM notifications_sent WHERE event_id=?", (start,))}
@@ -0,0 +1,29 @@
+# Горячие запросы обработчиков должны идти по индексам: строка плана «SCAN <таблица>» значит
+# полный проход таблицы, и очередная правка схемы не должна тихо вернуть его.
+# Список событий сюда не входит: его целиком держит EventCache, полная загрузка — намеренная.
+import pytest
+
+def hot_queries(B):
+    p = {"kind": "start", "today": "2030-01-01", "plus2": "2030-01-03", "eid": 1}
+    return {
+        "leaderboard": (B.LEADERBOARD_SQL, (1,)),
+        "report-lookup": (B.REPORT_LOOKUP_SQL, (1, 2, "2030-01-01")),
+        "my-events": (B.MY_EVENTS_SQL, (2,)),
+        "event-keyboards": (B.EVENT_KEYBOARDS_SQL.format(marks="?,?,?"), (2, 1, 2, 3)),
+        "participants": (B.PARTICIPANTS_SQL, (1, 50, 0)),
+        "due-start": (B.DUE_REMINDERS_SQL.format(cond=B.REMINDER_CONDITIONS["start"]), p),
+        "due-start-2": (B.DUE_REMINDERS_SQL.format(cond=B.REMINDER_CONDITIONS["start-2"]), p),
+        "due-report-final": (B.DUE_REMINDERS_SQL.format(cond=B.REMINDER_CONDITIONS["report-final"]), p),
+        "due-daily": (B.DUE_DAILY_SQL, {"eid": 1, "today": "2030-01-01"}),
+    }
+
+@pytest.mark.parametrize("name", ["leaderboard", "report-lookup", "my-events", "event-keyboards", "participants",
+                                  "due-start", "due-start-2", "due-report-final", "due-daily"])
+def test_hot_query_uses_index(bot_module, name):
+    B = bot_module
+    sql, params = hot_queries(B)[name]
+    plan = [row[3] for row in B.db().execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()]
+    tables = [step for step in plan if step.startswith(("SEARCH", "SCAN"))]
+    assert tables, plan
+    for step in tables:
+        assert step.startswith("SEARCH") and ("USING" in step), f"{name}: {step}\n{plan}"
@@ -0,0 +1,97 @@
+# SqliteStateStore: conv_state общая для всех воркеров, копия в памяти — только кэш.
+import threading
+
+from conftest import User
+
+def test_miss_is_not_cached(bot_module):
+    B = bot_module
+    here, there = B.SqliteStateStore(), B.SqliteStateStore()   # два воркера на одной БД
+    assert here.get(700) is None
+    there.save(700, {"mode": "report", "step": 1}); there.flush()
+    assert here.mode(700) == "report"
+
+def test_other_worker_changes_seen_after_cache_ttl(bot_module):
+    B = bot_module
+    here, there = B.SqliteStateStore(cache_ttl=0), B.SqliteStateStore()
+    there.save(701, {"mode": "add", "step": 1}); there.flush()
+    assert here.get(701)["step"] == 1
+    there.save(701, {"mode": "add", "step": 2}); there.flush()
+    assert here.get(701)["step"] == 2
+    there.pop(701); there.flush()
+    assert here.get(701) is None
+
+def test_get_does_not_overwrite_concurrent_save(bot_module):
+    B = bot_module
+    loading, saved = threading.Event(), threading.Event()
+    class SlowLoad(B.SqliteStateStore):
+        def _load(self, uid):
+            st = super()._load(uid)
+            loading.set(); saved.wait(5)   # save успевает между чтением БД и записью в кэш
+            return st
+    old = B.SqliteStateStore(); old.save(702, {"mode": "add"}); old.flush()
+    store = SlowLoad()
+    reader = threading.Thread(target=store.get, args=(702,)); reader.start()
+    loading.wait(5)
+    store.save(702, {"mode": "edit"}); saved.set()
+    reader.join()
+    assert store.mode(702) == "edit"
+
+def test_state_visible_while_flush_writes(bot_module, monkeypatch):
+    B = bot_module
+    store = B.SqliteStateStore(cache_ttl=0)
+    store.save(703, {"mode": "report"})
+    seen = []
+    real_write = store._write
+    def write(batch):
+        seen.append(store.get(703)); real_write(batch)
+    monkeypatch.setattr(store, "_write", write)
+    store.flush()
+    assert seen == [{"mode": "report"}]
+    assert store.get(703) == {"mode": "report"}
+
+def test_failed_flush_keeps_batch(bot_module, monkeypatch):
+    B = bot_module
+    store = B.SqliteStateStore()
+    store.save(704, {"mode": "add"})
+    def boom(batch): raise B.sqlite3.OperationalError("database is locked")
+    monkeypatch.setattr(store, "_write", boom)
+    try:
+        store.flush()
+    except B.sqlite3.OperationalError:
+        pass
+    monkeypatch.undo()
+    store.flush()
+    assert B.SqliteStateStore().mode(704) == "add"
+
+class Msg:
+    def __init__(self, uid):
+        self.from_user = User(uid)
+
+def test_step_saved_when_cache_expires_mid_step(bot_module, monkeypatch):
+    B = bot_module
+    store = B.SqliteStateStore(cache_ttl=0)
+    monkeypatch.setattr(B, "STATE", store)
+    store.save(705, {"mode": "add", "step": 1}); store.flush()
+    @B.keeps_state
+    def step(m, st):
+        store.flush()                       # флашер успел записать, копия в памяти истекла —
+        assert store.get(705) is not st     # обработчик ещё ждёт ответа Telegram, а из БД уже новый словарь
+        st["step"] += 1
+    step(Msg(705))
+    store.flush()
+    assert B.SqliteStateStore().get(705)["step"] == 2
+
+def test_step_reset_or_replaced_is_not_overwritten(bot_module, monkeypatch):
+    B = bot_module
+    store = B.SqliteStateStore(cache_ttl=0)
+    monkeypatch.setattr(B, "STATE", store)
+    @B.keeps_state
+    def cancel(m, st):
+        st["step"] += 1; B.reset_state(m.from_user.id)
+    @B.keeps_state
+    def restart(m, st):
+        st["step"] += 1; B.STATE[m.from_user.id] = {"mode": "report", "step": 1}
+    for uid, fn, expected in ((706, cancel, None), (707, restart, {"mode": "report", "step": 1})):
+        store.save(uid, {"mode": "add", "step": 5})
+        fn(Msg(uid)); store.flush()
+        assert B.SqliteStateStore().get(uid) == expected
@@ -0,0 +1,106 @@
+import random
+import datetime as dt
+
+import pytest
+
+from conftest import User
+
+@pytest.fixture
+def event_with_reports(bot_module, make_event):
+    B = bot_module
+    eid = make_event(days_before=3)
+    rnd = random.Random(7)
+    today = B.local_today()
+    days = [(today - dt.timedelta(days=k)).isoformat() for k in range(3)]
+    for uid in range(100, 130):
+        B.join_event(eid, User(uid))
+    for _ in range(300):
+        photos = [f"p{rnd.random()}" for _ in range(rnd.choice([0, 1, 3]))]
+        B.upsert_report(eid, User(rnd.randint(100, 129)), rnd.choice(days), rnd.choice([None, 0.1, rnd.uniform(0, 100)]), "", photos)
+    return eid, days
+
+def day_row(B, eid, day):
+    return B.db().execute("SELECT reporters,total,max_value,photos FROM event_day_stats WHERE event_id=? AND date=?",
+                          (eid, day)).fetchone()
+
+def test_upserts_match_recompute(bot_module, event_with_reports):
+    B = bot_module
+    assert B.check_stats() == []
+
+def test_lowering_the_max_recomputes_it(bot_module, event_with_reports):
+    B = bot_module
+    eid, days = event_with_reports
+    B.upsert_report(eid, User(100), days[0], 10_000, "", ["a", "b"])
+    assert day_row(B, eid, days[0])[2] == 10_000
+    B.upsert_report(eid, User(100), days[0], 1, "", [])          # update-of-value и удаление фото
+    assert day_row(B, eid, days[0])[2] < 10_000
+    assert B.check_stats(eid) == []
+
+def test_report_delete(bot_module, event_with_reports):
+    B = bot_module
+    eid, days = event_with_reports
+    con = B.db()
+    with con:
+        con.execute("""DELETE FROM reports WHERE event_id=? AND date=? AND value=(
+                           SELECT MAX(value) FROM reports WHERE event_id=? AND date=?)""", (eid, days[1], eid, days[1]))
+    assert B.check_stats(eid) == []
+
+def test_users_only_report_removed(bot_module, event_with_reports):
+    B = bot_module
+    eid, days = event_with_reports
+    B.upsert_report(eid, User(150), days[0], 3, "", [])          # у 150 нет других отчётов
+    con = B.db()
+    reporters = lambda: con.execute("SELECT reporters FROM event_stats WHERE event_id=?", (eid,)).fetchone()[0]
+    before = reporters()
+    with con:
+        con.execute("DELETE FROM reports WHERE event_id=? AND tg_user_id=150", (eid,))
+    assert reporters() == before - 1
+    assert B.check_stats(eid) == []
+
+def test_event_rollup_drift_is_caught(bot_module, event_with_reports):
+    B = bot_module
+    eid, _ = event_with_reports
+    con = B.db()
+    with con:
+        con.execute("UPDATE event_stats SET reporters=reporters+1 WHERE event_id=?", (eid,))
+    assert B.check_stats() == [eid]
+    assert B.check_stats(fix=True) == [eid]
+    assert B.check_stats() == []
+
+def test_import_upsert(bot_module, event_with_reports):
+    B = bot_module
+    eid, days = event_with_reports
+    rows = [{"user": str(uid), "date": day, "value": str(uid % 7)} for uid in range(100, 130) for day in days[:2]]
+    good, errors = B.validate_reports(eid, enumerate(rows, 1))
+    assert errors == []
+    B.import_reports(eid, good)
+    assert B.check_stats(eid) == []
+
+def test_event_delete_cascades(bot_module, event_with_reports):
+    B = bot_module
+    eid, _ = event_with_reports
+    con = B.db()
+    with con:
+        con.execute("DELETE FROM events WHERE id=?", (eid,))
+    assert con.execute("SELECT COUNT(*) FROM event_day_stats WHERE event_id=?", (eid,)).fetchone()[0] == 0
+    assert con.execute("SELECT COUNT(*) FROM event_stats WHERE event_id=?", (eid,)).fetchone()[0] == 0
+    assert B.check_stats() == []
+
+def test_archive_cascades(bot_module, make_event):
+    B = bot_module
+    eid = make_event(days_before=B.ARCHIVE_AFTER_DAYS + 30, days_after=-(B.ARCHIVE_AFTER_DAYS + 10))
+    day = (B.local_today() - dt.timedelta(days=B.ARCHIVE_AFTER_DAYS + 20)).isoformat()
+    B.upsert_report(eid, User(100), day, 5, "", ["x"])
+    assert B.archive_finished() >= 1
+    assert B.db().execute("SELECT COUNT(*) FROM event_day_stats WHERE event_id=?", (eid,)).fetchone()[0] == 0
+    assert B.check_stats() == []
+
+def test_recount_repairs_drift(bot_module, event_with_reports):
+    B = bot_module
+    eid, days = event_with_reports
+    con = B.db()
+    with con:
+        con.execute("UPDATE event_day_stats SET total=total+1 WHERE event_id=? AND date=?", (eid, days[0]))
+    assert B.check_stats() == [eid]
+    assert B.check_stats(fix=True) == [eid]
+    assert B.check_stats() == []
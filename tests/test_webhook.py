@@ -0,0 +1,64 @@
+# WebhookServer на свободном порту: записанный апдейт Telegram, проверка секрета и переполнение очереди.
+import http.client, json, threading
+
+import pytest
+
+UPDATE = {"update_id": 1, "message": {"message_id": 1, "date": 0, "text": "/start",
+                                      "chat": {"id": 42, "type": "private"},
+                                      "from": {"id": 42, "is_bot": False, "first_name": "U"}}}
+
+class StubBot:
+    def __init__(self):
+        self.seen = []; self.release = threading.Event()
+    def process_new_updates(self, updates):
+        self.release.wait(5)   # держим воркер, чтобы очередь заполнилась
+        self.seen.extend(updates)
+
+@pytest.fixture
+def server(bot_module):
+    stub = StubBot()
+    srv = bot_module.WebhookServer(stub, "127.0.0.1", 0, "s3cret", workers=1, maxsize=1).start()
+    yield srv, stub
+    stub.release.set(); srv.stop()
+
+def post(srv, body, secret="s3cret", headers=None):
+    con = http.client.HTTPConnection("127.0.0.1", srv.port, timeout=5)
+    con.request("POST", "/", body=body, headers={"X-Telegram-Bot-Api-Secret-Token": secret, **(headers or {})})
+    status = con.getresponse().status
+    con.close()
+    return status
+
+def test_accepts_recorded_update(server):
+    srv, stub = server
+    assert post(srv, json.dumps(UPDATE)) == 200
+    stub.release.set()
+    for _ in range(100):
+        if stub.seen: break
+        threading.Event().wait(0.02)
+    assert [u.message.text for u in stub.seen] == ["/start"]
+
+def test_rejects_bad_secret(server):
+    srv, _ = server
+    assert post(srv, json.dumps(UPDATE), secret="wrong") == 403
+    assert srv.stats["accepted"] == 0
+
+def test_full_queue_answers_503(server):
+    srv, _ = server
+    assert post(srv, json.dumps(UPDATE)) == 200
+    for _ in range(100):   # первый апдейт забрал воркер и висит в обработке
+        if srv.queues[0].empty(): break
+        threading.Event().wait(0.02)
+    codes = [post(srv, json.dumps(dict(UPDATE, update_id=i))) for i in range(2, 5)]
+    assert codes == [200, 503, 503]   # одно место в очереди, дальше — 503
+    assert srv.stats["rejected"] == 2
+
+@pytest.mark.parametrize("length", ["abc", "-5"])
+def test_bad_content_length_answers_400(server, length):
+    srv, _ = server
+    con = http.client.HTTPConnection("127.0.0.1", srv.port, timeout=5)
+    con.putrequest("POST", "/")
+    con.putheader("X-Telegram-Bot-Api-Secret-Token", "s3cret")
+    con.putheader("Content-Length", length)
+    con.endheaders()
+    assert con.getresponse().status == 400
+    con.close()